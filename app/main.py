@@ -1,28 +1,38 @@
+import asyncio
+import atexit
 import logging
 from base64 import b64encode as b64enc
 from calendar import timegm
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, UTC
 from hashlib import sha256
+from math import ceil
 from json import loads as json_loads, dumps as json_dumps
-from os import getenv as env
+from os import getenv as env, register_at_fork
 from os.path import join, dirname
-from textwrap import wrap
-from uuid import uuid4
+from tempfile import gettempdir
+from time import perf_counter
+from typing import Any, Callable
+from uuid import uuid4, UUID
 
 from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.requests import Request
 from fastapi.responses import Response, RedirectResponse, StreamingResponse
-from jose import jws, jwk, jwt, JWTError
+from jose import jws, jwt, JWTError
 from jose.constants import ALGORITHMS
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 
-from orm import Origin, Lease, init as db_init, migrate
-from util import CASetup, PrivateKey, Cert, ProductMapping, load_file
+from orm import Origin, Lease, LeaseCache, LeaseUsage, MemoryStore, RenewalQueue, DatabaseLock, create_tuned_engine, keyset_cursor, init as db_init, migrate, observe_queries
+from util import CASetup, DriverMatrix, FileLock, ProductMapping, OfflineLeasePolicy, RateLimiter, RecentKeys, SingleFlight, \
+    EventBroadcaster, CompressionMiddleware, KeyContext, KeyWatcher, Metrics, SamplingFilter, load_file, parse_nodes, setup_logging, \
+    Tracer, TracingMiddleware, RingBufferExporter, JsonLinesExporter, span
+
+# Startup timings, reported when application is ready
+STARTUP_TIMINGS, STARTUP_BEGIN = {}, perf_counter()
 
 # Load variables
 load_dotenv('../version.env')
@@ -33,9 +43,55 @@ TZ = datetime.now().astimezone().tzinfo
 # Load basic variables
 VERSION, COMMIT, DEBUG = env('VERSION', 'unknown'), env('COMMIT', 'unknown'), bool(env('DEBUG', False))
 
-# Database connection
-db = create_engine(str(env('DATABASE', 'sqlite:///db.sqlite')))
-db_init(db), migrate(db)
+# Logging
+LOG_LEVEL = logging.DEBUG if DEBUG else logging.INFO
+LOG_FORMAT = str(env('LOG_FORMAT', 'text'))  # "text" or "json"
+LOG_QUEUE_SIZE = int(env('LOG_QUEUE_SIZE', 10000))
+LOG_SAMPLING = SamplingFilter.parse(env('LOG_SAMPLING'))  # per route, e.g. "leases=0.1,renew=0.5"
+log_listener, log_handler = setup_logging(json=LOG_FORMAT == 'json', queue_size=LOG_QUEUE_SIZE, sampling=LOG_SAMPLING)
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+logging.getLogger('util').setLevel(LOG_LEVEL)
+logging.getLogger('NV').setLevel(LOG_LEVEL)
+
+# Tracing of license protocol requests, per process (see "/-/debug/traces")
+TRACE_SAMPLING = float(env('TRACE_SAMPLING', 0))  # fraction of requests which are exported, "0" disables
+TRACE_SLOW_MS = float(env('TRACE_SLOW_MS', 0))  # requests slower than this are always exported and kept, "0" disables
+TRACE_FILE = env('TRACE_FILE')  # json lines, if not set exported traces are kept in memory
+TRACE_HISTORY = int(env('TRACE_HISTORY', 100))
+TRACER = Tracer(sampling=TRACE_SAMPLING, slow=TRACE_SLOW_MS, history=TRACE_HISTORY)
+if TRACER.enabled:
+    TRACER.exporter = JsonLinesExporter(TRACE_FILE) if TRACE_FILE else RingBufferExporter(TRACE_HISTORY)
+
+# Metrics, per process (see "/-/metrics")
+METRICS = Metrics()
+METRICS.describe('fastapi_dls_database_queries_total', 'Database queries by engine ("primary" or "replica") and statement')
+
+# Database connection (pooled), tables are created and migrated on startup (see "lifespan")
+DATABASE = str(env('DATABASE', 'sqlite:///db.sqlite'))
+DATABASE_READ = env('DATABASE_READ')  # optional read replica for admin and listing queries, "db_read" falls back to "db"
+DATABASE_LOCK = join(gettempdir(), f'fastapi-dls-{sha256(DATABASE.encode("utf-8")).hexdigest()[:16]}.lock')
+MEMORY_SNAPSHOT_INTERVAL = float(env('MEMORY_SNAPSHOT_INTERVAL', 300))
+if DATABASE.startswith(MemoryStore.SCHEME):
+    db, DATABASE_TUNING = MemoryStore.from_url(DATABASE), {'profile': 'none', 'dialect': 'memory', 'settings': {}}
+else:
+    db, DATABASE_TUNING = create_tuned_engine(DATABASE, profile=str(env('DATABASE_TUNING', 'none')))
+
+    # uvicorn spawns its workers (each creates its own engine on import), but other process managers (e.g. gunicorn with
+    # "--preload") fork an already imported app. Pooled connections must not be shared with a forked process.
+    register_at_fork(after_in_child=lambda: db.dispose(close=False))
+    observe_queries(db, lambda statement: METRICS.inc('fastapi_dls_database_queries_total', engine='primary', statement=statement))
+
+# Read-only queries which do not need to see the latest writes (admin endpoints, listings, stats) use "db_read". Leasing
+# and everything which reads its own writes (e.g. renewal after lookup) always uses "db" (primary).
+db_read = db
+if DATABASE_READ:
+    if isinstance(db, MemoryStore):
+        raise RuntimeError('"DATABASE_READ" requires a database, "memory://" is not supported.')
+    db_read, _ = create_tuned_engine(str(DATABASE_READ), profile=str(env('DATABASE_TUNING', 'none')))
+    register_at_fork(after_in_child=lambda: db_read.dispose(close=False))
+    observe_queries(db_read, lambda statement: METRICS.inc('fastapi_dls_database_queries_total', engine='replica', statement=statement))
 
 # Load DLS variables (all prefixed with "INSTANCE_*" is used as "SERVICE_INSTANCE_*" or "SI_*" in official dls service)
 DLS_URL = str(env('DLS_URL', 'localhost'))
@@ -47,38 +103,132 @@ ALLOTMENT_REF = str(env('ALLOTMENT_REF', '20000000-0000-0000-0000-000000000001')
 TOKEN_EXPIRE_DELTA = relativedelta(days=int(env('TOKEN_EXPIRE_DAYS', 1)), hours=int(env('TOKEN_EXPIRE_HOURS', 0)))
 LEASE_EXPIRE_DELTA = relativedelta(days=int(env('LEASE_EXPIRE_DAYS', 90)), hours=int(env('LEASE_EXPIRE_HOURS', 0)))
 LEASE_RENEWAL_PERIOD = float(env('LEASE_RENEWAL_PERIOD', 0.15))
+LEASE_RENEWAL_JITTER = float(env('LEASE_RENEWAL_JITTER', 0))
 LEASE_RENEWAL_DELTA = timedelta(days=int(env('LEASE_EXPIRE_DAYS', 90)), hours=int(env('LEASE_EXPIRE_HOURS', 0)))
+OFFLINE_LEASE_POLICY = OfflineLeasePolicy.from_strings(env('OFFLINE_LEASE_ORIGINS'), env('OFFLINE_LEASE_HOSTNAMES'), env('OFFLINE_LEASE_PRODUCTS'))
+OFFLINE_LEASE_EXPIRE_DELTA = relativedelta(days=int(env('OFFLINE_LEASE_EXPIRE_DAYS', 365)))
+OFFLINE_LEASE_RENEWAL_PERIOD = float(env('OFFLINE_LEASE_RENEWAL_PERIOD', 0.1))  # ~36 days of 365, revocations apply then
+OFFLINE_LEASE_RENEWAL_DELTA = timedelta(days=int(env('OFFLINE_LEASE_EXPIRE_DAYS', 365)))
 CLIENT_TOKEN_EXPIRE_DELTA = relativedelta(years=12)
 CORS_ORIGINS = str(env('CORS_ORIGINS', '')).split(',') if (env('CORS_ORIGINS')) else [f'https://{DLS_URL}']
+COMPRESSION = [_.strip() for _ in str(env('COMPRESSION', 'br,gzip')).split(',') if _.strip()]  # for "/-/*" routes, empty disables
+COMPRESSION_MIN_SIZE = int(env('COMPRESSION_MIN_SIZE', 1024))  # bytes
+RATE_LIMIT_MAX_ORIGINS = int(env('RATE_LIMIT_MAX_ORIGINS', 10000))
+RATE_LIMITS = {  # per route family and "origin_ref", disabled if not set
+    'origin': RateLimiter.from_string(env('RATE_LIMIT_ORIGIN'), max_keys=RATE_LIMIT_MAX_ORIGINS),
+    'auth': RateLimiter.from_string(env('RATE_LIMIT_AUTH'), max_keys=RATE_LIMIT_MAX_ORIGINS),
+    'leasing': RateLimiter.from_string(env('RATE_LIMIT_LEASING'), max_keys=RATE_LIMIT_MAX_ORIGINS),
+}
+KNOWN_ORIGINS = RecentKeys(max_keys=RATE_LIMIT_MAX_ORIGINS)  # registered or authenticated here, others are limited per client address
+SINGLE_FLIGHT_ORIGIN_TTL = float(env('SINGLE_FLIGHT_ORIGIN_TTL', 2))
+LEASE_CACHE_SIZE = int(env('LEASE_CACHE_SIZE', 0))  # origins, "0" disables (in-memory store is not cached)
+LEASE_CACHE_TTL = float(env('LEASE_CACHE_TTL', 30))  # seconds
+LEASE_CACHE = LeaseCache(max_origins=0 if isinstance(db, MemoryStore) else LEASE_CACHE_SIZE, ttl=LEASE_CACHE_TTL)
+RENEWAL_FLUSH_INTERVAL = float(env('RENEWAL_FLUSH_INTERVAL', 0))  # seconds renewals are queued at most, "0" writes immediately
+RENEWAL_FLUSH_SIZE = int(env('RENEWAL_FLUSH_SIZE', 1000))  # queued renewals which are written without waiting
+RENEWALS = RenewalQueue(db, interval=RENEWAL_FLUSH_INTERVAL, max_size=RENEWAL_FLUSH_SIZE)
+LEASE_REAPER_INTERVAL = float(env('LEASE_REAPER_INTERVAL', 300))  # seconds between deleting expired leases, "0" disables
+SINGLE_FLIGHT = SingleFlight()  # coalesces concurrent identical requests per (route, origin_ref, body)
+EVENTS_HISTORY, EVENTS_QUEUE_SIZE = int(env('EVENTS_HISTORY', 1000)), int(env('EVENTS_QUEUE_SIZE', 100))
+EVENTS = EventBroadcaster(history=EVENTS_HISTORY, queue_size=EVENTS_QUEUE_SIZE)  # lease and origin changes for "/-/events"
+EVENTS_KEEPALIVE = 15  # seconds
+HEALTH_CACHE_TTL = float(env('HEALTH_CACHE_TTL', 5))  # seconds a readiness result is reused (see "/-/health/ready")
+HEALTH_TIMEOUT = float(env('HEALTH_TIMEOUT', 2))  # seconds per check (and maximum event loop lag) until not ready
+CLUSTER_NODES = parse_nodes(str(env('CLUSTER_NODES')), default_port=DLS_PORT) if env('CLUSTER_NODES') else [(DLS_URL, DLS_PORT)]
 DT_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 PRODUCT_MAPPING = ProductMapping(filename=join(dirname(__file__), 'static/product_mapping.json'))
 
-# Create certificate chain and signing keys
+# Cluster mode: all nodes share one database and one "CERT_PATH", this is not possible with in-memory store
+if len(CLUSTER_NODES) > 1 and isinstance(db, MemoryStore):
+    raise RuntimeError('"CLUSTER_NODES" requires a database shared between all nodes, "memory://" is not supported.')
+
+# Create certificate chain and signing keys, replaced as a whole on reload (see "reload_keys"). Handlers take a reference
+# ("keys = KEYS") once, so they use consistent keys even if they are swapped while the request is processed.
+_ = perf_counter()
 ca_setup = CASetup(service_instance_ref=INSTANCE_REF, cert_path=CERT_PATH)
-my_root_private_key = PrivateKey.from_file(ca_setup.root_private_key_filename)
-my_root_public_key = my_root_private_key.public_key()
-my_root_certificate = Cert.from_file(ca_setup.root_certificate_filename)
-my_ca_certificate = Cert.from_file(ca_setup.ca_certificate_filename)
-my_si_certificate = Cert.from_file(ca_setup.si_certificate_filename)
-my_si_private_key = PrivateKey.from_file(ca_setup.si_private_key_filename)
-my_si_public_key = my_si_private_key.public_key()
+KEYS = KeyContext.load(ca_setup)
+KEY_RELOAD_INTERVAL = float(env('KEY_RELOAD_INTERVAL', 0))  # seconds between checks of key files, "0" disables
+STARTUP_TIMINGS['keys'] = perf_counter() - _
 
-jwt_encode_key = jwk.construct(my_si_private_key.pem(), algorithm=ALGORITHMS.RS256)
-jwt_decode_key = jwk.construct(my_si_private_key.public_key().pem(), algorithm=ALGORITHMS.RS256)
 
-# Logging
-LOG_LEVEL = logging.DEBUG if DEBUG else logging.INFO
-logging.basicConfig(format='[{levelname:^7}] [{module:^15}] {message}', style='{')
-logger = logging.getLogger(__name__)
-logger.setLevel(LOG_LEVEL)
-logging.getLogger('util').setLevel(LOG_LEVEL)
-logging.getLogger('NV').setLevel(LOG_LEVEL)
+def warm_up():
+    """
+    Primes everything which is otherwise initialized lazily on the first client request (database connection pool,
+    RSA blinding of signing keys, jose key objects, driver matrix), so the first request is as fast as all others.
+    Called within "lifespan", which completes before the webserver opens its port.
+    """
+    for engine in {db, db_read}:
+        if not isinstance(engine, MemoryStore):
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+
+    KEYS.warm_up()
+
+    DriverMatrix()
+
+
+async def reload_keys() -> tuple[KeyContext, bool]:
+    """
+    Loads and validates certificates and keys from "CERT_PATH" and swaps them atomically, requests already processed
+    keep the keys they started with. Loading, validation and warm-up run in a threadpool to not block the event loop.
+    Raises "ValueError" if the files are invalid, in this case the current keys remain in use.
+    Returns the keys in use and whether they changed.
+    """
+    global KEYS
+
+    def load() -> KeyContext:
+        keys = KeyContext.load(ca_setup)
+        keys.warm_up()
+        return keys
+
+    keys = await run_in_threadpool(load)
+    changed = keys.fingerprint != KEYS.fingerprint
+    KEYS = keys
+    if changed:
+        logger.info(f'Reloaded certificates and keys (fingerprint: {keys.fingerprint}).')
+        EVENTS.publish('keys.reloaded', {'fingerprint': keys.fingerprint})
+    return keys, changed
 
 
 # FastAPI
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     # on startup
+    begin = perf_counter()
+    with FileLock(DATABASE_LOCK) as lock, DatabaseLock(db, 'fastapi-dls-migrate') as db_lock:
+        # the first worker acquiring the lock is the leader and migrates, all others wait until migrations are done. The
+        # file lock serializes workers of this host, the database lock (postgres and mysql only) all cluster nodes.
+        if lock.contended or db_lock.contended:
+            logger.info('Database was initialized and migrated by another worker or node.')
+        else:
+            db_init(db), migrate(db)
+    if isinstance(db, MemoryStore):
+        db.start(interval=MEMORY_SNAPSHOT_INTERVAL)
+    STARTUP_TIMINGS['database'] = perf_counter() - begin
+
+    begin = perf_counter()
+    warm_up()
+    STARTUP_TIMINGS['warm-up'] = perf_counter() - begin
+
+    RENEWALS.start()
+
+    async def reap():
+        # expired leases count as active (e.g. in "/-/stats") until they are deleted, clients may just go away
+        while True:
+            await asyncio.sleep(LEASE_REAPER_INTERVAL)
+            try:
+                if (deletions := await __delete_expired_leases()) > 0:
+                    logger.info(f'Deleted {deletions} expired leases.')
+            except Exception as e:
+                logger.warning(f'Deleting expired leases failed, retrying in {LEASE_REAPER_INTERVAL}s: {e}')
+
+    reaper = asyncio.create_task(reap()) if LEASE_REAPER_INTERVAL > 0 else None
+
+    key_watcher = None
+    if KEY_RELOAD_INTERVAL > 0:
+        key_watcher = KeyWatcher(KeyContext.filenames(ca_setup), interval=KEY_RELOAD_INTERVAL, on_change=reload_keys)
+        key_watcher.start()
+
     logger.info(f'''
     
     Using timezone: {str(TZ)}. Make sure this is correct and match your clients!
@@ -91,10 +241,21 @@ async def lifespan(_: FastAPI):
 
     logger.info(f'Debug is {"enabled" if DEBUG else "disabled"}.')
 
+    timings = ', '.join(f'{k}: {v:.3f}s' for k, v in STARTUP_TIMINGS.items())
+    logger.info(f'Startup took {perf_counter() - STARTUP_BEGIN:.3f}s ({timings}).')
+
     yield
 
     # on shutdown
     logger.info(f'Shutting down ...')
+    if reaper is not None:
+        reaper.cancel()
+    if key_watcher is not None:
+        await key_watcher.stop()
+    await run_in_threadpool(RENEWALS.close)  # writes queued renewals
+    TRACER.close()
+    if isinstance(db, MemoryStore):
+        db.close()
 
 
 config = dict(openapi_url=None, docs_url=None, redoc_url=None)  # dict(openapi_url='/-/openapi.json', docs_url='/-/docs', redoc_url='/-/redoc')
@@ -108,13 +269,112 @@ app.add_middleware(
     allow_methods=['*'],
     allow_headers=['*'],
 )
+if len(COMPRESSION) > 0:
+    # only admin routes ("/-/*"), license protocol responses are small and signed, compressing them only adds latency
+    app.add_middleware(CompressionMiddleware, prefixes=['/-/'], encodings=COMPRESSION, minimum_size=COMPRESSION_MIN_SIZE)
+
+app.add_middleware(TracingMiddleware, tracer=TRACER, prefixes=['/auth/', '/leasing/'])
 
 
 # Helper
 def __get_token(request: Request) -> dict:
     authorization_header = request.headers.get('authorization')
     token = authorization_header.split(' ')[1]
-    return jwt.decode(token=token, key=jwt_decode_key, algorithms=ALGORITHMS.RS256, options={'verify_aud': False})
+    token = jwt.decode(token=token, key=KEYS.jwt_decode_key, algorithms=ALGORITHMS.RS256, options={'verify_aud': False})
+    KNOWN_ORIGINS.add(token.get('origin_ref'))
+    return token
+
+
+def __get_unverified_origin_ref(token: str | None) -> str | None:
+    # only used as rate limit key, so requests can be rejected without verifying the signature
+    try:
+        return jwt.get_unverified_claims(token.split(' ')[-1]).get('origin_ref')
+    except Exception:
+        return None
+
+
+def __lease_renewal(offline: bool | None) -> dict:
+    """ renewal settings of online or offline leases (see "Lease.serialize") """
+    if offline:
+        return dict(renewal_period=OFFLINE_LEASE_RENEWAL_PERIOD, renewal_delta=OFFLINE_LEASE_RENEWAL_DELTA, renewal_jitter=LEASE_RENEWAL_JITTER)
+    return dict(renewal_period=LEASE_RENEWAL_PERIOD, renewal_delta=LEASE_RENEWAL_DELTA, renewal_jitter=LEASE_RENEWAL_JITTER)
+
+
+def __rate_limit(family: str, request: Request, origin_ref: str | None) -> Response | None:
+    """
+    returns a "400" response without "origin_ref" and a "429" response if it exceeded the rate limit of "family", this
+    has to be checked first. Origins not known to this process (see "KNOWN_ORIGINS") share one bucket per client address,
+    so made up "origin_ref"s do not get a fresh bucket each.
+    """
+    if not isinstance(origin_ref, str) or len(origin_ref) == 0:
+        response = {'status': 400, 'detail': 'missing "origin_ref"'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+    limiter = RATE_LIMITS.get(family)
+    if limiter is None:
+        return None
+    key = origin_ref if origin_ref in KNOWN_ORIGINS else f'address:{request.client.host if request.client else None}'
+    retry_after = limiter.acquire(key)
+    if retry_after == 0:
+        return None
+    logger.debug('> [ limited  ]: %s: exceeded rate limit for "%s"', key, family, extra={'route': 'limited', 'origin_ref': origin_ref})
+    response = {'status': 429, 'detail': 'too many requests'}
+    headers = {'Retry-After': str(ceil(retry_after))}
+    return Response(content=json_dumps(response), media_type='application/json', status_code=429, headers=headers)
+
+
+async def __delete_expired_leases() -> int:
+    """ deletes leases expired by now, queued renewals are written first (these leases were renewed in time) """
+    cur_time = datetime.now(UTC)
+    await run_in_threadpool(RENEWALS.flush)
+    expired = await run_in_threadpool(Lease.delete_expired, db, cur_time)
+    LEASE_CACHE.expire(cur_time)
+    for lease_ref, origin_ref in expired:
+        EVENTS.publish('lease.expired', {'lease_ref': lease_ref, 'origin_ref': origin_ref})
+    return len(expired)
+
+
+async def __health_check(check: Callable[[], Any]) -> dict:
+    """ runs blocking "check" in threadpool, it is "down" on error or if it takes longer than "HEALTH_TIMEOUT" """
+    begin, detail = perf_counter(), None
+    try:
+        await asyncio.wait_for(run_in_threadpool(check), timeout=HEALTH_TIMEOUT)
+    except asyncio.TimeoutError:
+        detail = f'timeout after {HEALTH_TIMEOUT}s'
+    except Exception as e:
+        detail = str(e)
+    result = {'status': 'up' if detail is None else 'down', 'latency_ms': round((perf_counter() - begin) * 1000, 3)}
+    if detail is not None:
+        result['detail'] = detail
+    return result
+
+
+async def __event_loop_lag() -> float:
+    """ seconds until the event loop runs a new callback, i.e. how long pending callbacks block the loop """
+    loop = asyncio.get_running_loop()
+    begin, future = loop.time(), loop.create_future()
+    loop.call_soon(lambda: future.set_result(loop.time()))
+    return await future - begin
+
+
+async def __readiness() -> (bool, str):
+    """ checks database round trip, signing key and event loop lag, returns whether all are "up" and the response """
+    keys = KEYS
+
+    def ping(engine):
+        if not isinstance(engine, MemoryStore):
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+
+    lag = await __event_loop_lag()
+    checks = {'database': __health_check(lambda: ping(db)), 'keys': __health_check(lambda: keys.si_private_key.generate_signature(b'health'))}
+    if db_read is not db:
+        checks['database_read'] = __health_check(lambda: ping(db_read))
+    checks = dict(zip(checks.keys(), await asyncio.gather(*checks.values())))
+    checks['event_loop'] = {'status': 'up' if lag < HEALTH_TIMEOUT else 'down', 'lag_ms': round(lag * 1000, 3)}
+
+    ready = all(_.get('status') == 'up' for _ in checks.values())
+    response = {'status': 'up' if ready else 'down', 'checked': datetime.now(UTC).isoformat(), 'checks': checks}
+    return ready, json_dumps(response)
 
 
 # Endpoints
@@ -130,10 +390,38 @@ async def _index():
 
 
 @app.get('/-/health', summary='* Health')
+@app.get('/-/health/live', summary='* Liveness', description='process is running and serving requests, nothing else is checked')
 async def _health():
     return Response(content=json_dumps({'status': 'up'}), media_type='application/json', status_code=200)
 
 
+@app.get('/-/health/ready', summary='* Readiness', description='database, signing key and event loop are healthy (with latencies)')
+async def _health_ready():
+    # concurrent and frequent probes (e.g. docker and a load balancer) are answered from one check per "HEALTH_CACHE_TTL"
+    ready, content = await SINGLE_FLIGHT.do(('health',), __readiness, ttl=HEALTH_CACHE_TTL)
+    return Response(content=content, media_type='application/json', status_code=200 if ready else 503)
+
+
+@app.get('/-/metrics', summary='* Metrics', description='metrics of this worker in Prometheus text format')
+async def _metrics():
+    return Response(content=METRICS.render(), media_type='text/plain; version=0.0.4', status_code=200)
+
+
+@app.get('/-/debug/traces', summary='* Traces', description='slow (or with "sampled" also sampled) request traces of this worker, newest first')
+async def _debug_traces(sampled: bool = False, limit: int = 20):
+    if not TRACER.enabled:
+        response = {'status': 404, 'detail': 'tracing is disabled, set "TRACE_SAMPLING" or "TRACE_SLOW_MS"'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=404)
+    if sampled and not isinstance(TRACER.exporter, RingBufferExporter):
+        response = {'status': 400, 'detail': f'sampled traces are written to "{TRACE_FILE}"'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    limit = min(max(limit, 1), TRACE_HISTORY)
+    traces = list(TRACER.exporter.traces if sampled else TRACER.slow_traces)[::-1][:limit]
+    response = {'slow_ms': TRACER.slow, 'sampling': TRACER.sampling, 'traced': TRACER.traced, 'traces': traces}
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
 @app.get('/-/config', summary='* Config', description='returns environment variables.')
 async def _config():
     response = {
@@ -142,13 +430,34 @@ async def _config():
         'DEBUG': str(DEBUG),
         'DLS_URL': str(DLS_URL),
         'DLS_PORT': str(DLS_PORT),
+        'CLUSTER_NODES': [f'{host}:{port}' for host, port in CLUSTER_NODES],
         'SITE_KEY_XID': str(SITE_KEY_XID),
         'INSTANCE_REF': str(INSTANCE_REF),
         'ALLOTMENT_REF': [str(ALLOTMENT_REF)],
         'TOKEN_EXPIRE_DELTA': str(TOKEN_EXPIRE_DELTA),
         'LEASE_EXPIRE_DELTA': str(LEASE_EXPIRE_DELTA),
         'LEASE_RENEWAL_PERIOD': str(LEASE_RENEWAL_PERIOD),
+        'LEASE_RENEWAL_JITTER': str(LEASE_RENEWAL_JITTER),
+        'OFFLINE_LEASE_POLICY': OFFLINE_LEASE_POLICY.serialize(),
+        'OFFLINE_LEASE_EXPIRE_DELTA': str(OFFLINE_LEASE_EXPIRE_DELTA),
+        'OFFLINE_LEASE_RENEWAL_PERIOD': str(OFFLINE_LEASE_RENEWAL_PERIOD),
+        'DATABASE_TUNING': DATABASE_TUNING,
+        'DATABASE_READ_REPLICA': str(db_read is not db),
+        'SINGLE_FLIGHT_ORIGIN_TTL': str(SINGLE_FLIGHT_ORIGIN_TTL),
+        'LEASE_CACHE': {'max_origins': LEASE_CACHE.max_origins, 'ttl': LEASE_CACHE.ttl, 'hits': LEASE_CACHE.hits, 'misses': LEASE_CACHE.misses},
+        'LEASE_REAPER_INTERVAL': str(LEASE_REAPER_INTERVAL),
+        'RENEWAL_QUEUE': {'interval': RENEWALS.interval, 'max_size': RENEWALS.max_size, 'enabled': RENEWALS.enabled, 'pending': len(RENEWALS), 'flushed': RENEWALS.flushed, 'batches': RENEWALS.batches},
+        'HEALTH_CACHE_TTL': str(HEALTH_CACHE_TTL),
+        'HEALTH_TIMEOUT': str(HEALTH_TIMEOUT),
+        'KEY_RELOAD_INTERVAL': str(KEY_RELOAD_INTERVAL),
+        'KEY_FINGERPRINT': KEYS.fingerprint,
+        'LOG_FORMAT': str(LOG_FORMAT),
+        'LOG_SAMPLING': LOG_SAMPLING,
+        'TRACING': {'sampling': TRACER.sampling, 'slow_ms': TRACER.slow, 'exporter': repr(TRACER.exporter), 'traced': TRACER.traced, 'exported': TRACER.exported},
+        'RATE_LIMITS': {k: f'{v.rate}/{v.burst}' if v is not None else None for k, v in RATE_LIMITS.items()},
         'CORS_ORIGINS': str(CORS_ORIGINS),
+        'COMPRESSION': CompressionMiddleware.available(COMPRESSION),
+        'COMPRESSION_MIN_SIZE': str(COMPRESSION_MIN_SIZE),
         'TZ': str(TZ),
     }
 
@@ -157,7 +466,20 @@ async def _config():
 
 @app.get('/-/config/root-certificate', summary='* Root Certificate', description='returns Root--Certificate needed for patching nvidia-gridd')
 async def _config():
-    return Response(content=my_root_certificate.pem().decode('utf-8').strip(), media_type='text/plain')
+    return Response(content=KEYS.root_certificate.pem().decode('utf-8').strip(), media_type='text/plain')
+
+
+@app.post('/-/keys/reload', summary='* Reload Keys', description='reloads certificates and keys from "CERT_PATH" (of this worker)')
+async def _keys_reload():
+    try:
+        keys, changed = await reload_keys()
+    except (OSError, ValueError) as e:
+        logger.warning(f'Reloading certificates and keys failed, keeping current ones: {e}')
+        response = {'status': 400, 'detail': f'invalid certificates or keys: {e}'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    response = {'fingerprint': keys.fingerprint, 'changed': changed, 'loaded': keys.loaded.isoformat()}
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
 
 
 @app.get('/-/readme', summary='* Readme')
@@ -170,87 +492,289 @@ async def _readme():
 
 @app.get('/-/manage', summary='* Management UI')
 async def _manage(request: Request):
-    response = '''
-    <!DOCTYPE html>
-    <html>
-        <head>
-            <title>FastAPI-DLS Management</title>
-        </head>
-        <body>
-            <button onclick="deleteOrigins()">delete ALL origins and their leases</button>
-            <button onclick="deleteLease()">delete specific lease</button>
-            
-            <script>
-                function deleteOrigins() {
-                    const response = confirm('Are you sure you want to delete all origins and their leases?');
-
-                    if (response) {
-                        var xhr = new XMLHttpRequest();
-                        xhr.open("DELETE", '/-/origins', true);
-                        xhr.send();
-                    }
-                }
-                function deleteLease(lease_ref) {
-                    if(lease_ref === undefined)
-                        lease_ref = window.prompt("Please enter 'lease_ref' which should be deleted");
-                    if(lease_ref === null || lease_ref === "")
-                        return
-                    var xhr = new XMLHttpRequest();
-                    xhr.open("DELETE", `/-/lease/${lease_ref}`, true);
-                    xhr.send();
-                }
-            </script>
-        </body>
-    </html>
-    '''
+    response = load_file(join(dirname(__file__), 'static/manage.html')).decode('utf-8')
     return Response(response, media_type='text/html', status_code=200)
 
 
 @app.get('/-/origins', summary='* Origins')
 async def _origins(request: Request, leases: bool = False):
-    session = sessionmaker(bind=db)()
+    by_origin = {}
+    if leases:  # one query for all leases instead of one per origin
+        for lease in map(RENEWALS.get, Lease.find_all(db_read)):
+            by_origin.setdefault(lease.origin_ref, []).append(lease.serialize(**__lease_renewal(lease.offline)))
+
     response = []
-    for origin in session.query(Origin).all():
+    for origin in Origin.find_all(db_read):
         x = origin.serialize()
         if leases:
-            serialize = dict(renewal_period=LEASE_RENEWAL_PERIOD, renewal_delta=LEASE_RENEWAL_DELTA)
-            x['leases'] = list(map(lambda _: _.serialize(**serialize), Lease.find_by_origin_ref(db, origin.origin_ref)))
+            x['leases'] = by_origin.get(origin.origin_ref, [])
         response.append(x)
-    session.close()
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
+@app.get('/-/origins/search', summary='* Origins Search', description='search origins by prefix of hostname, driver and os')
+async def _origins_search(
+        request: Request,
+        hostname: str = None, guest_driver_version: str = None, os_platform: str = None, os_version: str = None,
+        active_after: datetime = None, active_before: datetime = None,
+        fields: str = None, sort: str = 'origin_ref', order: str = 'asc', after: str = None, limit: int = 100,
+):
+    fields = None if fields is None else [_.strip() for _ in fields.split(',') if _.strip()]
+    if fields is not None and not set(fields).issubset([*Origin.FIELDS, 'last_activity']):
+        response = {'status': 400, 'detail': f'unknown fields, use any of {[*Origin.FIELDS, "last_activity"]}'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+    if sort not in Origin.SORT_FIELDS or order not in ['asc', 'desc']:
+        response = {'status': 400, 'detail': f'invalid sort, use any of {list(Origin.SORT_FIELDS)} with order "asc" or "desc"'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    filters = dict(hostname=hostname, guest_driver_version=guest_driver_version, os_platform=os_platform, os_version=os_version)
+    filters = {k: v for k, v in filters.items() if v}
+    active_after = active_after.astimezone(UTC) if active_after is not None else None
+    active_before = active_before.astimezone(UTC) if active_before is not None else None
+    limit = min(max(limit, 1), 1000)
+
+    try:
+        origins = await run_in_threadpool(Origin.search, db_read, filters, active_after, active_before, after, limit, sort, order == 'desc')
+    except ValueError:
+        response = {'status': 400, 'detail': 'invalid "after", use "next" of the previous page with the same sort'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    items = []
+    for origin, last_activity in origins:
+        x = origin.serialize(fields=fields)
+        if fields is None or 'last_activity' in fields:
+            x['last_activity'] = last_activity.replace(tzinfo=UTC).isoformat() if last_activity is not None else None
+        items.append(x)
+
+    response = {
+        'origins': items,
+        'next': keyset_cursor(origins[-1][0], sort, 'origin_ref') if len(origins) == limit else None,  # use as "after" for next page
+    }
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
+@app.post('/-/origins/delete', summary='* Origins Bulk Delete', description='deletes origins (and their leases) matching all given criteria')
+async def _origins_delete_matching(request: Request):
+    j = json_loads((await request.body()).decode('utf-8') or '{}')
+
+    filters = {k: j.get(k) for k in Origin.SEARCH_FIELDS if j.get(k)}
+    origin_refs, active_before = j.get('origin_refs'), j.get('active_before')
+    if len(filters) == 0 and origin_refs is None and active_before is None:
+        response = {'status': 400, 'detail': f'no criteria given, use any of {["origin_refs", *Origin.SEARCH_FIELDS, "active_before"]}'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+    try:
+        active_before = datetime.fromisoformat(active_before).astimezone(UTC) if active_before is not None else None
+    except ValueError:
+        response = {'status': 400, 'detail': 'invalid "active_before", use ISO 8601'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    if active_before is not None:
+        await run_in_threadpool(RENEWALS.flush)  # activity of queued renewals
+    origins, leases = await run_in_threadpool(Origin.delete_matching, db, origin_refs, filters, active_before)
+    LEASE_CACHE.clear()
+    logger.info('Deleted %d origins and %d leases (bulk)', origins, leases)
+    response = {'origins': origins, 'leases': leases}
     return Response(content=json_dumps(response), media_type='application/json', status_code=200)
 
 
 @app.delete('/-/origins', summary='* Origins')
 async def _origins_delete(request: Request):
     Origin.delete(db)
+    LEASE_CACHE.clear()
     return Response(status_code=201)
 
 
 @app.get('/-/leases', summary='* Leases')
 async def _leases(request: Request, origin: bool = False):
-    session = sessionmaker(bind=db)()
+    origins = {_.origin_ref: _ for _ in Origin.find_all(db_read)} if origin else {}  # one query instead of one per lease
+
     response = []
-    for lease in session.query(Lease).all():
-        serialize = dict(renewal_period=LEASE_RENEWAL_PERIOD, renewal_delta=LEASE_RENEWAL_DELTA)
-        x = lease.serialize(**serialize)
-        if origin:
-            lease_origin = session.query(Origin).filter(Origin.origin_ref == lease.origin_ref).first()
-            if lease_origin is not None:
-                x['origin'] = lease_origin.serialize()
+    for lease in map(RENEWALS.get, Lease.find_all(db_read)):
+        x = lease.serialize(**__lease_renewal(lease.offline))
+        if lease.origin_ref in origins:
+            x['origin'] = origins[lease.origin_ref].serialize()
         response.append(x)
-    session.close()
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
+@app.get('/-/leases/page', summary='* Leases Page', description='leases paginated by cursor, sorted and filtered on server')
+async def _leases_page(
+        request: Request,
+        origin_ref: str = None, product_name: str = None, driver_branch: str = None,
+        sort: str = 'lease_ref', order: str = 'asc', after: str = None, limit: int = 100,
+):
+    if sort not in Lease.SORT_FIELDS or order not in ['asc', 'desc']:
+        response = {'status': 400, 'detail': f'invalid sort, use any of {list(Lease.SORT_FIELDS)} with order "asc" or "desc"'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    filters = dict(origin_ref=origin_ref, product_name=product_name, driver_branch=driver_branch)
+    filters = {k: v for k, v in filters.items() if v}
+    limit = min(max(limit, 1), 1000)
+
+    try:
+        leases = await run_in_threadpool(Lease.page, db_read, filters, after, limit, sort, order == 'desc')
+    except ValueError:
+        response = {'status': 400, 'detail': 'invalid "after", use "next" of the previous page with the same sort'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+    cursor = keyset_cursor(leases[-1], sort, 'lease_ref') if len(leases) == limit else None  # of values as written
+    leases = list(map(RENEWALS.get, leases))  # ordered as written, values include queued renewals
+
+    response = {
+        'leases': [_.serialize(**__lease_renewal(_.offline)) for _ in leases],
+        'next': cursor,  # use as "after" for next page
+        'total': await run_in_threadpool(Lease.count, db_read, filters) if after is None else None,  # only on first page
+    }
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
+@app.get('/-/leases/renewals', summary='* Lease Renewals', description='histogram of upcoming lease renewals')
+async def _leases_renewals(request: Request, buckets: int = 24):
+    renewals = sorted(_.calculate_lease_renewal(**__lease_renewal(_.offline)).replace(tzinfo=UTC) for _ in map(RENEWALS.get, Lease.find_all(db_read)))
+
+    histogram = []
+    if len(renewals) > 0:
+        begin, end = renewals[0], renewals[-1]
+        width = max((end - begin) / max(buckets, 1), timedelta(seconds=1))
+        counts = [0] * max(buckets, 1)
+        for renewal in renewals:
+            counts[min(int((renewal - begin) / width), len(counts) - 1)] += 1
+        histogram = [{
+            'from': (begin + width * idx).isoformat(),
+            'to': (begin + width * (idx + 1)).isoformat(),
+            'count': count,
+        } for idx, count in enumerate(counts)]
+
+    response = {
+        'leases': len(renewals),
+        'renewal_period': LEASE_RENEWAL_PERIOD,
+        'renewal_jitter': LEASE_RENEWAL_JITTER,
+        'histogram': histogram,
+    }
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
+@app.get('/-/stats', summary='* Stats', description='active leases per product and driver branch (current, peak and hourly)')
+async def _stats(request: Request, hours: int = 24):
+    cur_time = datetime.now(UTC)
+    since = cur_time - timedelta(hours=max(hours, 1) - 1)  # including current hour
+
+    usage = {}
+    for row in LeaseUsage.find(db_read, since):  # ordered by key and hour
+        x = usage.setdefault((row.product_name, row.driver_branch), {
+            'product_name': row.product_name,
+            'driver_branch': row.driver_branch,
+            'active': 0,
+            'peak': 0,
+            'hourly': [],
+        })
+        x['active'] = row.active
+        if row.hour < LeaseUsage.truncate_hour(since):  # latest row before period, count at begin of period
+            x['peak'] = max(x['peak'], row.active)
+        else:
+            x['peak'] = max(x['peak'], row.peak)
+            x['hourly'].append(row.serialize())
+
+    response = {
+        'hours': max(hours, 1),
+        'since': LeaseUsage.truncate_hour(since).replace(tzinfo=UTC).isoformat(),
+        'usage': list(usage.values()),
+    }
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
+@app.get('/-/events', summary='* Events', description='server-sent events of lease and origin changes')
+async def _events(request: Request, last_event_id: int = None):
+    try:
+        last_event_id = int(request.headers.get('last-event-id')) if 'last-event-id' in request.headers else last_event_id
+    except ValueError:
+        response = {'status': 400, 'detail': 'invalid "Last-Event-ID"'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    subscription = EVENTS.subscribe(last_event_id)
+
+    async def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while not await request.is_disconnected():
+                try:
+                    item = await subscription.next(timeout=EVENTS_KEEPALIVE)
+                except EOFError:
+                    logger.warning('Dropped slow events subscriber, it has to reconnect')
+                    break
+                yield EventBroadcaster.format(*item) if item is not None else ': keepalive\n\n'
+        finally:
+            EVENTS.unsubscribe(subscription)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return StreamingResponse(stream(), media_type='text/event-stream', headers=headers)
+
+
+@app.post('/-/leases/delete', summary='* Leases Bulk Delete', description='deletes leases matching all given criteria')
+async def _leases_delete_matching(request: Request):
+    j = json_loads((await request.body()).decode('utf-8') or '{}')
+
+    lease_refs, origin_refs, updated_before = j.get('lease_refs'), j.get('origin_refs'), j.get('updated_before')
+    if lease_refs is None and origin_refs is None and updated_before is None:
+        response = {'status': 400, 'detail': 'no criteria given, use any of ["lease_refs", "origin_refs", "updated_before"]'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+    try:
+        updated_before = datetime.fromisoformat(updated_before).astimezone(UTC) if updated_before is not None else None
+    except ValueError:
+        response = {'status': 400, 'detail': 'invalid "updated_before", use ISO 8601'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    if updated_before is not None:
+        await run_in_threadpool(RENEWALS.flush)  # "lease_updated" of queued renewals
+    leases = await run_in_threadpool(Lease.delete_matching, db, lease_refs, origin_refs, updated_before)
+    LEASE_CACHE.clear()
+    logger.info('Deleted %d leases (bulk)', leases)
+    response = {'leases': leases}
+    return Response(content=json_dumps(response), media_type='application/json', status_code=200)
+
+
+@app.post('/-/leases/offline', summary='* Offline Leases', description='assigns offline leases to registered origins in advance (e.g. before maintenance of a cluster)')
+async def _leases_offline(request: Request):
+    j, cur_time = json_loads((await request.body()).decode('utf-8') or '{}'), datetime.now(UTC)
+
+    origin_refs, product_name = j.get('origin_refs'), j.get('product_name')
+    try:
+        origin_refs = list(dict.fromkeys(str(UUID(_)) for _ in origin_refs))
+        PRODUCT_MAPPING.get_feature_name(product_name=product_name)
+    except (TypeError, ValueError, AttributeError, StopIteration):
+        response = {'status': 400, 'detail': 'requires "origin_refs" (list of uuids) and a known "product_name"'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=400)
+
+    # leases are picked up by the client itself (lease list on startup), so only for origins which registered
+    registered = await run_in_threadpool(Origin.find_registered, db, origin_refs)
+    if len(unknown := [_ for _ in origin_refs if _ not in registered]) > 0:
+        response = {'status': 404, 'detail': 'origins not registered', 'origin_refs': unknown}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=404)
+
+    expires = cur_time + OFFLINE_LEASE_EXPIRE_DELTA
+    leases = [Lease(origin_ref=_, lease_ref=str(uuid4()), lease_created=cur_time, lease_updated=cur_time, lease_expires=expires, product_name=product_name, offline=True) for _ in origin_refs]
+    items = [{'origin_ref': _.origin_ref, 'lease_ref': _.lease_ref, 'product_name': product_name, 'lease_expires': expires.isoformat()} for _ in leases]
+
+    await run_in_threadpool(Lease.create_many, db, [LeaseCache.copy(_) for _ in leases])
+    for lease in leases:
+        LEASE_CACHE.put(lease)
+    for item in items:
+        EVENTS.publish('lease.created', item)
+    logger.info('Assigned %d offline leases for "%s"', len(items), product_name)
+
+    response = {'leases': items}
     return Response(content=json_dumps(response), media_type='application/json', status_code=200)
 
 
 @app.delete('/-/leases/expired', summary='* Leases')
 async def _lease_delete_expired(request: Request):
-    Lease.delete_expired(db)
+    await __delete_expired_leases()
     return Response(status_code=201)
 
 
 @app.delete('/-/lease/{lease_ref}', summary='* Lease')
 async def _lease_delete(request: Request, lease_ref: str):
     if Lease.delete(db, lease_ref) == 1:
+        LEASE_CACHE.remove_lease(lease_ref)
         return Response(status_code=201)
     response = {'status': 404, 'detail': 'lease not found'}
     return Response(content=json_dumps(response), media_type='application/json', status_code=404)
@@ -259,9 +783,22 @@ async def _lease_delete(request: Request, lease_ref: str):
 # venv/lib/python3.9/site-packages/nls_core_service_instance/service_instance_token_manager.py
 @app.get('/-/client-token', summary='* Client-Token', description='creates a new messenger token for this service instance')
 async def _client_token():
-    cur_time = datetime.now(UTC)
+    keys, cur_time = KEYS, datetime.now(UTC)
     exp_time = cur_time + CLIENT_TOKEN_EXPIRE_DELTA
 
+    # one port set per distinct port, every node (in cluster mode all, otherwise just "DLS_URL") references its port set
+    ports = list(dict.fromkeys(port for _, port in CLUSTER_NODES))
+    svc_port_set_list = [{
+        "idx": idx,
+        "d_name": "DLS",
+        # todo: {"service": "quick_release", "port": 80} - see "shutdown for windows"
+        "svc_port_map": [{"service": "auth", "port": port}, {"service": "lease", "port": port}]
+    } for idx, port in enumerate(ports)]
+    node_url_list = [
+        {"idx": idx, "url": host, "url_qr": host, "svc_port_set_idx": ports.index(port)}
+        for idx, (host, port) in enumerate(CLUSTER_NODES)
+    ]
+
     payload = {
         "jti": str(uuid4()),
         "iss": "NLS Service Instance",
@@ -275,27 +812,20 @@ async def _client_token():
         "fulfillment_class_ref_list": [],
         "service_instance_configuration": {
             "nls_service_instance_ref": INSTANCE_REF,
-            "svc_port_set_list": [
-                {
-                    "idx": 0,
-                    "d_name": "DLS",
-                    # todo: {"service": "quick_release", "port": 80} - see "shutdown for windows"
-                    "svc_port_map": [{"service": "auth", "port": DLS_PORT}, {"service": "lease", "port": DLS_PORT}]
-                }
-            ],
-            "node_url_list": [{"idx": 0, "url": DLS_URL, "url_qr": DLS_URL, "svc_port_set_idx": 0}]
+            "svc_port_set_list": svc_port_set_list,
+            "node_url_list": node_url_list,
         },
         "service_instance_public_key_configuration": {
             "service_instance_public_key_me": {
-                "mod": my_si_public_key.mod(),
-                "exp": my_si_public_key.exp(),
+                "mod": keys.si_public_key.mod(),
+                "exp": keys.si_public_key.exp(),
             },
-            "service_instance_public_key_pem": my_si_public_key.pem().decode('utf-8').strip(),
+            "service_instance_public_key_pem": keys.si_public_key.pem().decode('utf-8').strip(),
             "key_retention_mode": "LATEST_ONLY"
         },
     }
 
-    content = jws.sign(payload, key=jwt_encode_key, headers=None, algorithm=ALGORITHMS.RS256)
+    content = jws.sign(payload, key=keys.jwt_encode_key, headers=None, algorithm=ALGORITHMS.RS256)
 
     response = StreamingResponse(iter([content]), media_type="text/plain")
     filename = f'client_configuration_token_{datetime.now().strftime("%d-%m-%y-%H-%M-%S")}.tok'
@@ -307,72 +837,101 @@ async def _client_token():
 # venv/lib/python3.9/site-packages/nls_services_auth/test/test_origins_controller.py
 @app.post('/auth/v1/origin', description='find or create an origin')
 async def auth_v1_origin(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    with span('parse'):
+        body, cur_time = await request.body(), datetime.now(UTC)
+        j = json_loads(body.decode('utf-8'))
 
     origin_ref = j.get('candidate_origin_ref')
-    logger.info(f'> [  origin  ]: {origin_ref}: {j}')
+    if (response := __rate_limit('origin', request, origin_ref)) is not None:
+        return response
 
-    data = Origin(
-        origin_ref=origin_ref,
-        hostname=j.get('environment').get('hostname'),
-        guest_driver_version=j.get('environment').get('guest_driver_version'),
-        os_platform=j.get('environment').get('os_platform'), os_version=j.get('environment').get('os_version'),
-    )
+    async def upsert() -> str:
+        logger.info('> [  origin  ]: %s: %s', origin_ref, j, extra={'route': 'origin', 'origin_ref': origin_ref})
 
-    Origin.create_or_update(db, data)
+        data = Origin(
+            origin_ref=origin_ref,
+            hostname=j.get('environment').get('hostname'),
+            guest_driver_version=j.get('environment').get('guest_driver_version'),
+            os_platform=j.get('environment').get('os_platform'), os_version=j.get('environment').get('os_version'),
+        )
 
-    environment = {
-        'raw_env': j.get('environment')
-    }
-    environment.update(j.get('environment'))
+        await run_in_threadpool(Origin.create_or_update, db, data)
+        KNOWN_ORIGINS.add(origin_ref)
+        EVENTS.publish('origin.registered', {'origin_ref': origin_ref, 'hostname': j.get('environment').get('hostname'), 'guest_driver_version': j.get('environment').get('guest_driver_version')})
 
-    response = {
-        "origin_ref": origin_ref,
-        "environment": environment,
-        "svc_port_set_list": None,
-        "node_url_list": None,
-        "node_query_order": None,
-        "prompts": None,
-        "sync_timestamp": cur_time.strftime(DT_FORMAT)
-    }
+        environment = {
+            'raw_env': j.get('environment')
+        }
+        environment.update(j.get('environment'))
 
-    return Response(content=json_dumps(response, separators=(',', ':')), media_type='application/json', status_code=200)
+        response = {
+            "origin_ref": origin_ref,
+            "environment": environment,
+            "svc_port_set_list": None,
+            "node_url_list": None,
+            "node_query_order": None,
+            "prompts": None,
+            "sync_timestamp": cur_time.strftime(DT_FORMAT)
+        }
+
+        return json_dumps(response, separators=(',', ':'))
+
+    # clients often send the same request multiple times on startup
+    key = ('origin', origin_ref, sha256(body).hexdigest())
+    content = await SINGLE_FLIGHT.do(key, upsert, ttl=SINGLE_FLIGHT_ORIGIN_TTL)
+
+    return Response(content=content, media_type='application/json', status_code=200)
 
 
 # venv/lib/python3.9/site-packages/nls_services_auth/test/test_origins_controller.py
 @app.post('/auth/v1/origin/update', description='update an origin evidence')
 async def auth_v1_origin_update(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    with span('parse'):
+        body, cur_time = await request.body(), datetime.now(UTC)
+        j = json_loads(body.decode('utf-8'))
 
     origin_ref = j.get('origin_ref')
-    logger.info(f'> [  update  ]: {origin_ref}: {j}')
+    if (response := __rate_limit('origin', request, origin_ref)) is not None:
+        return response
 
-    data = Origin(
-        origin_ref=origin_ref,
-        hostname=j.get('environment').get('hostname'),
-        guest_driver_version=j.get('environment').get('guest_driver_version'),
-        os_platform=j.get('environment').get('os_platform'), os_version=j.get('environment').get('os_version'),
-    )
+    async def upsert() -> str:
+        logger.info('> [  update  ]: %s: %s', origin_ref, j, extra={'route': 'update', 'origin_ref': origin_ref})
 
-    Origin.create_or_update(db, data)
+        data = Origin(
+            origin_ref=origin_ref,
+            hostname=j.get('environment').get('hostname'),
+            guest_driver_version=j.get('environment').get('guest_driver_version'),
+            os_platform=j.get('environment').get('os_platform'), os_version=j.get('environment').get('os_version'),
+        )
 
-    response = {
-        "environment": j.get('environment'),
-        "prompts": None,
-        "sync_timestamp": cur_time.strftime(DT_FORMAT)
-    }
+        await run_in_threadpool(Origin.create_or_update, db, data)
+        KNOWN_ORIGINS.add(origin_ref)
 
-    return Response(content=json_dumps(response, separators=(',', ':')), media_type='application/json', status_code=200)
+        response = {
+            "environment": j.get('environment'),
+            "prompts": None,
+            "sync_timestamp": cur_time.strftime(DT_FORMAT)
+        }
+
+        return json_dumps(response, separators=(',', ':'))
+
+    key = ('origin/update', origin_ref, sha256(body).hexdigest())
+    content = await SINGLE_FLIGHT.do(key, upsert, ttl=SINGLE_FLIGHT_ORIGIN_TTL)
+
+    return Response(content=content, media_type='application/json', status_code=200)
 
 
 # venv/lib/python3.9/site-packages/nls_services_auth/test/test_auth_controller.py
 # venv/lib/python3.9/site-packages/nls_core_auth/auth.py - CodeResponse
 @app.post('/auth/v1/code', description='get an authorization code')
 async def auth_v1_code(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    with span('parse'):
+        j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
 
     origin_ref = j.get('origin_ref')
-    logger.info(f'> [   code   ]: {origin_ref}: {j}')
+    if (response := __rate_limit('auth', request, origin_ref)) is not None:
+        return response
+    logger.info('> [   code   ]: %s: %s', origin_ref, j, extra={'route': 'code', 'origin_ref': origin_ref})
 
     delta = relativedelta(minutes=15)
     expires = cur_time + delta
@@ -386,7 +945,8 @@ async def auth_v1_code(request: Request):
         'kid': SITE_KEY_XID
     }
 
-    auth_code = jws.sign(payload, key=jwt_encode_key, headers={'kid': payload.get('kid')}, algorithm=ALGORITHMS.RS256)
+    with span('sign'):
+        auth_code = jws.sign(payload, key=KEYS.jwt_encode_key, headers={'kid': payload.get('kid')}, algorithm=ALGORITHMS.RS256)
 
     response = {
         "auth_code": auth_code,
@@ -401,16 +961,22 @@ async def auth_v1_code(request: Request):
 # venv/lib/python3.9/site-packages/nls_core_auth/auth.py - TokenResponse
 @app.post('/auth/v1/token', description='exchange auth code and verifier for token')
 async def auth_v1_token(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    with span('parse'):
+        j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+
+    if (response := __rate_limit('auth', request, __get_unverified_origin_ref(j.get('auth_code')))) is not None:
+        return response
 
     try:
-        payload = jwt.decode(token=j.get('auth_code'), key=jwt_decode_key, algorithms=ALGORITHMS.RS256)
+        with span('token'):
+            payload = jwt.decode(token=j.get('auth_code'), key=KEYS.jwt_decode_key, algorithms=ALGORITHMS.RS256)
     except JWTError as e:
         response = {'status': 400, 'title': 'invalid token', 'detail': str(e)}
         return Response(content=json_dumps(response), media_type='application/json', status_code=400)
 
     origin_ref = payload.get('origin_ref')
-    logger.info(f'> [   auth   ]: {origin_ref}: {j}')
+    KNOWN_ORIGINS.add(origin_ref)
+    logger.info('> [   auth   ]: %s: %s', origin_ref, j, extra={'route': 'auth', 'origin_ref': origin_ref})
 
     # validate the code challenge
     challenge = b64enc(sha256(j.get('code_verifier').encode('utf-8')).digest()).rstrip(b'=').decode('utf-8')
@@ -431,7 +997,8 @@ async def auth_v1_token(request: Request):
         'origin_ref': origin_ref,
     }
 
-    auth_token = jwt.encode(new_payload, key=jwt_encode_key, headers={'kid': payload.get('kid')}, algorithm=ALGORITHMS.RS256)
+    with span('sign'):
+        auth_token = jwt.encode(new_payload, key=KEYS.jwt_encode_key, headers={'kid': payload.get('kid')}, algorithm=ALGORITHMS.RS256)
 
     response = {
         "auth_token": auth_token,
@@ -446,7 +1013,9 @@ async def auth_v1_token(request: Request):
 # NLS 3.4.0 - venv/lib/python3.12/site-packages/nls_services_lease/test/test_lease_single_controller.py
 @app.post('/leasing/v1/config-token', description='request to get config token for lease operations')
 async def leasing_v1_config_token(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    with span('parse'):
+        j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    keys = KEYS
 
     cur_time = datetime.now(UTC)
     exp_time = cur_time + CLIENT_TOKEN_EXPIRE_DELTA
@@ -462,22 +1031,22 @@ async def leasing_v1_config_token(request: Request):
         "service_instance_ref": j.get('service_instance_ref'),
         "service_instance_public_key_configuration": {
             "service_instance_public_key_me": {
-                "mod": my_si_public_key.mod(),
-                "exp": my_si_public_key.exp(),
+                "mod": keys.si_public_key.mod(),
+                "exp": keys.si_public_key.exp(),
             },
-            "service_instance_public_key_pem": my_si_public_key.pem().decode('utf-8').strip(),
+            "service_instance_public_key_pem": keys.si_public_key.pem().decode('utf-8').strip(),
             "key_retention_mode": "LATEST_ONLY"
         },
     }
 
-    my_jwt_encode_key = jwk.construct(my_si_private_key.pem().decode('utf-8'), algorithm=ALGORITHMS.RS256)
-    config_token = jws.sign(payload, key=my_jwt_encode_key, headers=None, algorithm=ALGORITHMS.RS256)
+    with span('sign'):
+        config_token = jws.sign(payload, key=keys.jwt_encode_key, headers=None, algorithm=ALGORITHMS.RS256)
 
-    response_ca_chain = my_ca_certificate.pem().decode('utf-8').strip()
+    response_ca_chain = keys.ca_certificate.pem().decode('utf-8').strip()
 
     # 76 chars per line on original response with "\r\n"
     """
-    response_ca_chain = my_ca_certificate.pem().decode('utf-8').strip()
+    response_ca_chain = keys.ca_certificate.pem().decode('utf-8').strip()
     response_ca_chain = response_ca_chain.replace('-----BEGIN CERTIFICATE-----', '')
     response_ca_chain = response_ca_chain.replace('-----END CERTIFICATE-----', '')
     response_ca_chain = response_ca_chain.replace('\n', '')
@@ -485,11 +1054,11 @@ async def leasing_v1_config_token(request: Request):
     response_ca_chain = '\r\n'.join(response_ca_chain)
     response_ca_chain = f'-----BEGIN CERTIFICATE-----\r\n{response_ca_chain}\r\n-----END CERTIFICATE-----'
     """
-    response_si_certificate = my_si_certificate.pem().decode('utf-8').strip()
+    response_si_certificate = keys.si_certificate.pem().decode('utf-8').strip()
 
     # 76 chars per line on original response with "\r\n"
     """
-    response_si_certificate = my_si_certificate.pem().decode('utf-8').strip()
+    response_si_certificate = keys.si_certificate.pem().decode('utf-8').strip()
     response_si_certificate = response_si_certificate.replace('-----BEGIN CERTIFICATE-----', '')
     response_si_certificate = response_si_certificate.replace('-----END CERTIFICATE-----', '')
     response_si_certificate = response_si_certificate.replace('\n', '')
@@ -502,8 +1071,8 @@ async def leasing_v1_config_token(request: Request):
             "caChain": [response_ca_chain],
             "publicCert": response_si_certificate,
             "publicKey": {
-                "exp": my_si_certificate.public_key().exp(),
-                "mod": [my_si_certificate.public_key().mod()],
+                "exp": keys.si_certificate.public_key().exp(),
+                "mod": [keys.si_certificate.public_key().mod()],
             },
         },
         "configToken": config_token,
@@ -515,10 +1084,15 @@ async def leasing_v1_config_token(request: Request):
 # venv/lib/python3.9/site-packages/nls_services_lease/test/test_lease_multi_controller.py
 @app.post('/leasing/v1/lessor', description='request multiple leases (borrow) for current origin')
 async def leasing_v1_lessor(request: Request):
-    j, token, cur_time = json_loads((await request.body()).decode('utf-8')), __get_token(request), datetime.now(UTC)
+    if (response := __rate_limit('leasing', request, __get_unverified_origin_ref(request.headers.get('authorization')))) is not None:
+        return response
+
+    with span('parse'):
+        j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
 
     try:
-        token = __get_token(request)
+        with span('token'):
+            token = __get_token(request)
     except JWTError:
         response = {'status': 401, 'detail': 'token is not valid'}
         return Response(content=json_dumps(response), media_type='application/json', status_code=401)
@@ -526,7 +1100,7 @@ async def leasing_v1_lessor(request: Request):
     origin_ref = token.get('origin_ref')
     scope_ref_list = j.get('scope_ref_list')
     lease_proposal_list = j.get('lease_proposal_list')
-    logger.info(f'> [  create  ]: {origin_ref}: create leases for scope_ref_list {scope_ref_list}')
+    logger.info('> [  create  ]: %s: create leases for scope_ref_list %s', origin_ref, scope_ref_list, extra={'route': 'create', 'origin_ref': origin_ref})
 
     for scope_ref in scope_ref_list:
         # if scope_ref not in [ALLOTMENT_REF]:
@@ -534,13 +1108,20 @@ async def leasing_v1_lessor(request: Request):
         #     return Response(content=json_dumps(response), media_type='application/json', status_code=400)
         pass
 
+    origin = Origin.find_by_origin_ref(db, origin_ref)
+    driver_branch = Origin.get_driver_branch(origin.guest_driver_version) if origin is not None else None
+
     lease_result_list = []
     for lease_proposal in lease_proposal_list:
         lease_ref = str(uuid4())
-        expires = cur_time + LEASE_EXPIRE_DELTA
 
         product_name = lease_proposal.get('product').get('name')
-        feature_name = PRODUCT_MAPPING.get_feature_name(product_name=product_name)
+        with span('product_mapping'):
+            feature_name = PRODUCT_MAPPING.get_feature_name(product_name=product_name)
+
+        offline = OFFLINE_LEASE_POLICY.applies(origin_ref, origin.hostname if origin is not None else None, product_name)
+        expires = cur_time + (OFFLINE_LEASE_EXPIRE_DELTA if offline else LEASE_EXPIRE_DELTA)
+        renewal_period = OFFLINE_LEASE_RENEWAL_PERIOD if offline else LEASE_RENEWAL_PERIOD
 
         lease_result_list.append({
             "error": None,
@@ -551,16 +1132,19 @@ async def leasing_v1_lessor(request: Request):
                 "lease_intent_id": None,
                 "license_type": "CONCURRENT_COUNTED_SINGLE",
                 "metadata": None,
-                "offline_lease": False,  # todo
+                "offline_lease": offline,
                 "product_name": product_name,
-                "recommended_lease_renewal": LEASE_RENEWAL_PERIOD,
+                "recommended_lease_renewal": Lease.calculate_renewal_period(renewal_period, lease_ref, LEASE_RENEWAL_JITTER),
                 "ref": lease_ref,
             },
             "ordinal": None,
         })
 
-        data = Lease(origin_ref=origin_ref, lease_ref=lease_ref, lease_created=cur_time, lease_expires=expires)
-        Lease.create_or_update(db, data)
+        data = Lease(origin_ref=origin_ref, lease_ref=lease_ref, lease_created=cur_time, lease_updated=cur_time, lease_expires=expires, product_name=product_name, driver_branch=driver_branch, offline=offline)
+        with span('db'):
+            Lease.create_or_update(db, LeaseCache.copy(data))  # "data" is kept detached, for the cache
+        LEASE_CACHE.put(data)
+        EVENTS.publish('lease.created', {'lease_ref': lease_ref, 'origin_ref': origin_ref, 'product_name': product_name, 'lease_expires': expires.isoformat()})
 
     response = {
         "client_challenge": j.get('client_challenge'),
@@ -572,7 +1156,8 @@ async def leasing_v1_lessor(request: Request):
 
     content = json_dumps(response, separators=(',', ':'))
     content = f'{content}\n'.encode('ascii')
-    signature = my_si_private_key.generate_signature(content)
+    with span('sign'):
+        signature = KEYS.si_private_key.generate_signature(content)
 
     headers = {
         'Content-Type': 'application/json',
@@ -587,12 +1172,19 @@ async def leasing_v1_lessor(request: Request):
 # venv/lib/python3.9/site-packages/nls_dal_service_instance_dls/schema/service_instance/V1_0_21__product_mapping.sql
 @app.get('/leasing/v1/lessor/leases', description='get active leases for current origin')
 async def leasing_v1_lessor_lease(request: Request):
-    token, cur_time = __get_token(request), datetime.now(UTC)
+    if (response := __rate_limit('leasing', request, __get_unverified_origin_ref(request.headers.get('authorization')))) is not None:
+        return response
+
+    with span('token'):
+        token, cur_time = __get_token(request), datetime.now(UTC)
 
     origin_ref = token.get('origin_ref')
 
-    active_lease_list = list(map(lambda x: x.lease_ref, Lease.find_by_origin_ref(db, origin_ref)))
-    logger.info(f'> [  leases  ]: {origin_ref}: found {len(active_lease_list)} active leases')
+    async def find() -> [str]:
+        return list(map(lambda x: x.lease_ref, await run_in_threadpool(LEASE_CACHE.find_by_origin_ref, db, origin_ref)))
+
+    active_lease_list = await SINGLE_FLIGHT.do(('leases', origin_ref), find)
+    logger.info('> [  leases  ]: %s: found %d active leases', origin_ref, len(active_lease_list), extra={'route': 'leases', 'origin_ref': origin_ref})
 
     response = {
         "active_lease_list": active_lease_list,
@@ -607,34 +1199,54 @@ async def leasing_v1_lessor_lease(request: Request):
 # venv/lib/python3.9/site-packages/nls_core_lease/lease_single.py
 @app.put('/leasing/v1/lease/{lease_ref}', description='renew a lease')
 async def leasing_v1_lease_renew(request: Request, lease_ref: str):
-    j, token, cur_time = json_loads((await request.body()).decode('utf-8')), __get_token(request), datetime.now(UTC)
+    if (response := __rate_limit('leasing', request, __get_unverified_origin_ref(request.headers.get('authorization')))) is not None:
+        return response
+
+    with span('parse'):
+        j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    with span('token'):
+        token = __get_token(request)
 
     origin_ref = token.get('origin_ref')
-    logger.info(f'> [  renew   ]: {origin_ref}: renew {lease_ref}')
+    logger.info('> [  renew   ]: %s: renew %s', origin_ref, lease_ref, extra={'route': 'renew', 'origin_ref': origin_ref})
 
-    entity = Lease.find_by_origin_ref_and_lease_ref(db, origin_ref, lease_ref)
+    entity = LEASE_CACHE.find_by_origin_ref_and_lease_ref(db, origin_ref, lease_ref)
     if entity is None:
         response = {'status': 404, 'detail': 'requested lease not available'}
         return Response(content=json_dumps(response), media_type='application/json', status_code=404)
 
-    expires = cur_time + LEASE_EXPIRE_DELTA
+    # policy is applied again, so origins or products removed from it get online leases on their next renewal
+    hostname = None
+    if len(OFFLINE_LEASE_POLICY.hostnames) > 0 and (origin := Origin.find_by_origin_ref(db, origin_ref)) is not None:
+        hostname = origin.hostname
+    offline = OFFLINE_LEASE_POLICY.applies(origin_ref, hostname, entity.product_name)
+
+    expires = cur_time + (OFFLINE_LEASE_EXPIRE_DELTA if offline else LEASE_EXPIRE_DELTA)
+    with span('db'):
+        renewed = RENEWALS.renew(entity, expires, cur_time, offline=offline)
+    if not renewed:  # deleted meanwhile (e.g. by another worker or cluster node), but still cached
+        LEASE_CACHE.remove(origin_ref, lease_ref)
+        response = {'status': 404, 'detail': 'requested lease not available'}
+        return Response(content=json_dumps(response), media_type='application/json', status_code=404)
+    LEASE_CACHE.put(LeaseCache.copy(entity, lease_expires=expires, lease_updated=cur_time, offline=offline))
+    EVENTS.publish('lease.renewed', {'lease_ref': lease_ref, 'origin_ref': origin_ref, 'lease_expires': expires.isoformat()})
+
     response = {
         "client_challenge": j.get('client_challenge'),
         "expires": expires.strftime('%Y-%m-%dT%H:%M:%S.%f'),  # DT_FORMAT => "trailing 'Z' missing in this response
         "feature_expired": False,
         "lease_ref": lease_ref,
         "metadata": None,
-        "offline_lease": False,  # todo
+        "offline_lease": offline,
         "prompts": None,
-        "recommended_lease_renewal": LEASE_RENEWAL_PERIOD,
+        "recommended_lease_renewal": Lease.calculate_renewal_period(__lease_renewal(offline).get('renewal_period'), lease_ref, LEASE_RENEWAL_JITTER),
         "sync_timestamp": cur_time.strftime(DT_FORMAT),
     }
 
-    Lease.renew(db, entity, expires, cur_time)
-
     content = json_dumps(response, separators=(',', ':'))
     content = f'{content}\n'.encode('ascii')
-    signature = my_si_private_key.generate_signature(content)
+    with span('sign'):
+        signature = KEYS.si_private_key.generate_signature(content)
 
     headers = {
         'Content-Type': 'application/json',
@@ -645,26 +1257,32 @@ async def leasing_v1_lease_renew(request: Request, lease_ref: str):
     return Response(content=content, media_type='application/json', headers=headers)
 
 
-
 # venv/lib/python3.9/site-packages/nls_services_lease/test/test_lease_single_controller.py
 @app.delete('/leasing/v1/lease/{lease_ref}', description='release (return) a lease')
 async def leasing_v1_lease_delete(request: Request, lease_ref: str):
-    token, cur_time = __get_token(request), datetime.now(UTC)
+    if (response := __rate_limit('leasing', request, __get_unverified_origin_ref(request.headers.get('authorization')))) is not None:
+        return response
+
+    with span('token'):
+        token, cur_time = __get_token(request), datetime.now(UTC)
 
     origin_ref = token.get('origin_ref')
-    logger.info(f'> [  return  ]: {origin_ref}: return {lease_ref}')
+    logger.info('> [  return  ]: %s: return %s', origin_ref, lease_ref, extra={'route': 'return', 'origin_ref': origin_ref})
 
-    entity = Lease.find_by_lease_ref(db, lease_ref)
-    if entity.origin_ref != origin_ref:
+    entity = LEASE_CACHE.find_by_origin_ref_and_lease_ref(db, origin_ref, lease_ref)
+    if entity is None and Lease.find_by_lease_ref(db, lease_ref) is not None:  # exists, but is a lease of another origin
         response = {'status': 403, 'detail': 'access or operation forbidden'}
         return Response(content=json_dumps(response), media_type='application/json', status_code=403)
     if entity is None:
         response = {'status': 404, 'detail': 'requested lease not available'}
         return Response(content=json_dumps(response), media_type='application/json', status_code=404)
 
-    if Lease.delete(db, lease_ref) == 0:
+    deletions = Lease.delete(db, lease_ref)
+    LEASE_CACHE.remove(origin_ref, lease_ref)
+    if deletions == 0:
         response = {'status': 404, 'detail': 'lease not found'}
         return Response(content=json_dumps(response), media_type='application/json', status_code=404)
+    EVENTS.publish('lease.released', {'lease_ref': lease_ref, 'origin_ref': origin_ref})
 
     response = {
         "client_challenge": None,
@@ -679,13 +1297,20 @@ async def leasing_v1_lease_delete(request: Request, lease_ref: str):
 # venv/lib/python3.9/site-packages/nls_services_lease/test/test_lease_multi_controller.py
 @app.delete('/leasing/v1/lessor/leases', description='release all leases')
 async def leasing_v1_lessor_lease_remove(request: Request):
-    token, cur_time = __get_token(request), datetime.now(UTC)
+    if (response := __rate_limit('leasing', request, __get_unverified_origin_ref(request.headers.get('authorization')))) is not None:
+        return response
+
+    with span('token'):
+        token, cur_time = __get_token(request), datetime.now(UTC)
 
     origin_ref = token.get('origin_ref')
 
-    released_lease_list = list(map(lambda x: x.lease_ref, Lease.find_by_origin_ref(db, origin_ref)))
+    released_lease_list = list(map(lambda x: x.lease_ref, LEASE_CACHE.find_by_origin_ref(db, origin_ref)))
     deletions = Lease.cleanup(db, origin_ref)
-    logger.info(f'> [  remove  ]: {origin_ref}: removed {deletions} leases')
+    LEASE_CACHE.remove(origin_ref)
+    logger.info('> [  remove  ]: %s: removed %d leases', origin_ref, deletions, extra={'route': 'remove', 'origin_ref': origin_ref})
+    for lease_ref in released_lease_list:
+        EVENTS.publish('lease.released', {'lease_ref': lease_ref, 'origin_ref': origin_ref})
 
     response = {
         "released_lease_list": released_lease_list,
@@ -699,15 +1324,20 @@ async def leasing_v1_lessor_lease_remove(request: Request):
 
 @app.post('/leasing/v1/lessor/shutdown', description='shutdown all leases')
 async def leasing_v1_lessor_shutdown(request: Request):
-    j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
+    with span('parse'):
+        j, cur_time = json_loads((await request.body()).decode('utf-8')), datetime.now(UTC)
 
-    token = j.get('token')
-    token = jwt.decode(token=token, key=jwt_decode_key, algorithms=ALGORITHMS.RS256, options={'verify_aud': False})
+    with span('token'):
+        token = j.get('token')
+        token = jwt.decode(token=token, key=KEYS.jwt_decode_key, algorithms=ALGORITHMS.RS256, options={'verify_aud': False})
     origin_ref = token.get('origin_ref')
 
-    released_lease_list = list(map(lambda x: x.lease_ref, Lease.find_by_origin_ref(db, origin_ref)))
+    released_lease_list = list(map(lambda x: x.lease_ref, LEASE_CACHE.find_by_origin_ref(db, origin_ref)))
     deletions = Lease.cleanup(db, origin_ref)
-    logger.info(f'> [ shutdown ]: {origin_ref}: removed {deletions} leases')
+    LEASE_CACHE.remove(origin_ref)
+    logger.info('> [ shutdown ]: %s: removed %d leases', origin_ref, deletions, extra={'route': 'shutdown', 'origin_ref': origin_ref})
+    for lease_ref in released_lease_list:
+        EVENTS.publish('lease.released', {'lease_ref': lease_ref, 'origin_ref': origin_ref})
 
     response = {
         "released_lease_list": released_lease_list,
@@ -728,6 +1358,8 @@ if __name__ == '__main__':
     #
     # openssl req -x509 -nodes -days 365 -newkey rsa:2048 -keyout app/cert/webserver.key -out app/cert/webserver.crt
     #
+    # This is a dev-server (with reload), use `python app/serve.py` in production.
+    #
     ###
 
     logger.info(f'> Starting dev-server ...')
@@ -1,78 +1,386 @@
+import binascii
+import logging
+from collections import OrderedDict
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import datetime, timedelta, timezone, UTC
+from functools import wraps
+from hashlib import sha256
+from inspect import signature
+from json import loads as json_loads, dumps as json_dumps
+from os import makedirs, fsync
+from os.path import join, isfile
+from threading import Lock, RLock, Thread, Event
+from time import monotonic
+from typing import Callable, NamedTuple
 
-from dateutil.relativedelta import relativedelta
-from sqlalchemy import Column, VARCHAR, CHAR, ForeignKey, DATETIME, update, and_, inspect, text
-from sqlalchemy.engine import Engine
+from sqlalchemy import Column, VARCHAR, CHAR, INTEGER, BOOLEAN, ForeignKey, DATETIME, Index, select, insert, update, delete, and_, or_, case, cast, text, create_engine, event, func, bindparam
+from sqlalchemy.dialects import mysql as mysql_dialect, postgresql as postgresql_dialect, sqlite as sqlite_dialect
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-from util import DriverMatrix
+from util import CURRENT_TRACE, DriverMatrix, FileLock, span, write_file_atomic
 
 Base = declarative_base()
 
+# Built-in engine tuning profiles (env "DATABASE_TUNING") per dialect. For "sqlite" the values are pragmas which are set
+# on every new connection, for all other dialects they are passed as connection pool arguments to "create_engine".
+TUNING_PROFILES = {
+    'none': {},
+    'balanced': {
+        'sqlite': dict(journal_mode='WAL', synchronous='NORMAL', busy_timeout=5000, mmap_size=64 * 1024 * 1024, cache_size=-8 * 1024),
+        'postgresql': dict(pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=1800),
+        'mysql': dict(pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=1800),
+    },
+    'performance': {
+        'sqlite': dict(journal_mode='WAL', synchronous='NORMAL', busy_timeout=10000, mmap_size=256 * 1024 * 1024, cache_size=-64 * 1024, temp_store='MEMORY'),
+        'postgresql': dict(pool_size=20, max_overflow=40, pool_pre_ping=True, pool_recycle=1800),
+        'mysql': dict(pool_size=20, max_overflow=40, pool_pre_ping=True, pool_recycle=1800),
+    },
+}
 
-class Origin(Base):
-    __tablename__ = "origin"
 
-    origin_ref = Column(CHAR(length=36), primary_key=True, unique=True, index=True)  # uuid4
+def keyset_cursor(entity, sort: str, key: str) -> str:
+    """
+    opaque cursor of "entity" (last row of a page) for "keyset" / "keyset_list": its sort value and key, so the next
+    page does not depend on that row still existing or being unchanged
+    """
+    value = getattr(entity, sort)
+    value = {'datetime': value.replace(tzinfo=None).isoformat()} if isinstance(value, datetime) else ('' if value is None else value)
+    return urlsafe_b64encode(json_dumps([sort, value, getattr(entity, key)]).encode('utf-8')).decode('ascii').rstrip('=')
 
-    # service_instance_xid = Column(CHAR(length=36), nullable=False, index=True)  # uuid4 # not necessary, we only support one service_instance_xid ('INSTANCE_REF')
-    hostname = Column(VARCHAR(length=256), nullable=True)
-    guest_driver_version = Column(VARCHAR(length=10), nullable=True)
-    os_platform = Column(VARCHAR(length=256), nullable=True)
-    os_version = Column(VARCHAR(length=256), nullable=True)
 
-    def __repr__(self):
-        return f'Origin(origin_ref={self.origin_ref}, hostname={self.hostname})'
+def keyset_anchor(cursor: str, sort: str) -> tuple:
+    """ sort value and key of "cursor" (see "keyset_cursor"), raises "ValueError" if invalid or of another sort """
+    try:
+        field, value, key = json_loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value['datetime'])
+    except (TypeError, KeyError, UnicodeDecodeError, binascii.Error) as e:  # JSONDecodeError is a ValueError
+        raise ValueError(f'invalid cursor: {e}') from e
+    if field != sort or not isinstance(value, (str, datetime)) or not isinstance(key, str):
+        raise ValueError('invalid cursor')
+    return value, key
 
-    def serialize(self) -> dict:
-        _ = DriverMatrix().find(self.guest_driver_version)
 
-        return {
+def keyset(query, sort, key, after: str | None, descending: bool, sort_name: str):
+    """
+    Orders "query" by "sort" (ties by unique "key") and continues after cursor "after" (see "keyset_cursor", created
+    with field "sort_name"). Nullable "sort" columns have to be coalesced by the caller.
+    """
+    if after is not None:
+        value, after = keyset_anchor(after, sort_name)
+        if descending:
+            query = query.filter(or_(sort < value, and_(sort == value, key < after)))
+        else:
+            query = query.filter(or_(sort > value, and_(sort == value, key > after)))
+    return query.order_by(sort.desc(), key.desc()) if descending else query.order_by(sort, key)
+
+
+def keyset_list(entities: list, sort: str, key: str, after: str | None, descending: bool) -> list:
+    """ same as "keyset" for entities held in memory, "None" values are sorted as empty string """
+    def value(entity):
+        _ = getattr(entity, sort)
+        return ('' if _ is None else _.replace(tzinfo=None) if isinstance(_, datetime) else _), getattr(entity, key)
+
+    entities = sorted(entities, key=value, reverse=descending)
+    if after is not None:
+        anchor = keyset_anchor(after, sort)
+        entities = [_ for _ in entities if (value(_) < anchor if descending else value(_) > anchor)]
+    return entities
+
+
+def traced(cls):
+    """ measures public static methods taking an "engine" as span (e.g. "Lease.create_or_update") of the current trace """
+    def wrap(func: Callable, name: str) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if CURRENT_TRACE.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    for name, attribute in list(vars(cls).items()):
+        if isinstance(attribute, staticmethod) and not name.startswith('_'):
+            if next(iter(signature(attribute.__func__).parameters), None) == 'engine':
+                setattr(cls, name, staticmethod(wrap(attribute.__func__, f'{cls.__name__}.{name}')))
+    return cls
+
+
+class OriginRow(NamedTuple):
+    """
+    Plain columns of an "Origin", as returned by listings. Rows are selected column-only, so they skip identity map and
+    attribute instrumentation of mapped instances, which are not needed to serialize them.
+    """
+    origin_ref: str
+    hostname: str | None
+    guest_driver_version: str | None
+    os_platform: str | None
+    os_version: str | None
+
+    @staticmethod
+    def columns() -> list:
+        return [getattr(Origin, _) for _ in OriginRow._fields]
+
+    @staticmethod
+    def of(origin: "Origin") -> "OriginRow":
+        return OriginRow._make(getattr(origin, _) for _ in OriginRow._fields)
+
+    def serialize(self, fields: [str] = None) -> dict:
+        """ only given "fields" (see "FIELDS", "origin_ref" is always included), driver matrix lookup only if requested """
+        fields = Origin.FIELDS if fields is None else ['origin_ref', *fields]
+
+        x = {
             'origin_ref': self.origin_ref,
             # 'service_instance_xid': self.service_instance_xid,
             'hostname': self.hostname,
             'guest_driver_version': self.guest_driver_version,
             'os_platform': self.os_platform,
             'os_version': self.os_version,
-            '$driver': _ if _ is not None else None,
         }
+        if '$driver' in fields:
+            x['$driver'] = DriverMatrix().find(self.guest_driver_version)
+        return {k: v for k, v in x.items() if k in fields}
+
+
+class LeaseRow(NamedTuple):
+    """ plain columns of a "Lease", as returned by listings (see "OriginRow") """
+    lease_ref: str
+    origin_ref: str
+    lease_created: datetime
+    lease_expires: datetime
+    lease_updated: datetime
+    product_name: str | None
+    driver_branch: str | None
+    offline: bool | None
+
+    @staticmethod
+    def columns() -> list:
+        return [getattr(Lease, _) for _ in LeaseRow._fields]
+
+    @staticmethod
+    def of(lease: "Lease") -> "LeaseRow":
+        return LeaseRow._make(getattr(lease, _) for _ in LeaseRow._fields)
+
+    def serialize(self, renewal_period: float, renewal_delta: timedelta, renewal_jitter: float = 0) -> dict:
+        lease_renewal = self.calculate_lease_renewal(renewal_period, renewal_delta, renewal_jitter)
+
+        return {
+            'lease_ref': self.lease_ref,
+            'origin_ref': self.origin_ref,
+            # 'scope_ref': self.scope_ref,
+            'lease_created': self.lease_created.replace(tzinfo=timezone.utc).isoformat(),
+            'lease_expires': self.lease_expires.replace(tzinfo=timezone.utc).isoformat(),
+            'lease_updated': self.lease_updated.replace(tzinfo=timezone.utc).isoformat(),
+            'lease_renewal': lease_renewal.replace(tzinfo=timezone.utc).isoformat(),
+            'product_name': self.product_name,
+            'driver_branch': self.driver_branch,
+            'offline_lease': bool(self.offline),
+        }
+
+    def calculate_lease_renewal(self, renewal_period: float, renewal_delta: timedelta, renewal_jitter: float = 0) -> datetime:
+        renewal_period = Lease.calculate_renewal_period(renewal_period, self.lease_ref, renewal_jitter)
+        lease_renewal = int(Lease.calculate_renewal(renewal_period, renewal_delta).total_seconds())
+        return self.lease_updated + timedelta(seconds=lease_renewal)
+
+
+@traced
+class Origin(Base):
+    __tablename__ = "origin"
+
+    origin_ref = Column(CHAR(length=36), primary_key=True, unique=True, index=True)  # uuid4
+
+    # service_instance_xid = Column(CHAR(length=36), nullable=False, index=True)  # uuid4 # not necessary, we only support one service_instance_xid ('INSTANCE_REF')
+    hostname = Column(VARCHAR(length=256), nullable=True, index=True)
+    guest_driver_version = Column(VARCHAR(length=10), nullable=True, index=True)
+    os_platform = Column(VARCHAR(length=256), nullable=True, index=True)
+    os_version = Column(VARCHAR(length=256), nullable=True, index=True)
+
+    FIELDS = ('origin_ref', 'hostname', 'guest_driver_version', 'os_platform', 'os_version', '$driver')
+    SEARCH_FIELDS = ('hostname', 'guest_driver_version', 'os_platform', 'os_version')  # prefix match
+    SORT_FIELDS = ('origin_ref', 'hostname', 'guest_driver_version', 'os_platform', 'os_version')
+
+    def __repr__(self):
+        return f'Origin(origin_ref={self.origin_ref}, hostname={self.hostname})'
+
+    def serialize(self, fields: [str] = None) -> dict:
+        return OriginRow.of(self).serialize(fields)
 
     @staticmethod
     def create_statement(engine: Engine):
         from sqlalchemy.schema import CreateTable
         return CreateTable(Origin.__table__).compile(engine)
 
+    @staticmethod
+    def get_driver_branch(guest_driver_version: str | None) -> str | None:
+        """ "550.54.14" => "R550" (same naming as "Driver Branch" in driver matrix) """
+        major = (guest_driver_version or '').split('.')[0]
+        return f'R{major}' if major.isdigit() else None
+
     @staticmethod
     def create_or_update(engine: Engine, origin: "Origin"):
+        if isinstance(engine, MemoryStore):
+            return engine.origin_create_or_update(origin)
+
+        x = dict(
+            hostname=origin.hostname,
+            guest_driver_version=origin.guest_driver_version,
+            os_platform=origin.os_platform,
+            os_version=origin.os_version
+        )
         session = sessionmaker(bind=engine)()
-        entity = session.query(Origin).filter(Origin.origin_ref == origin.origin_ref).first()
-        if entity is None:
-            session.add(origin)
-        else:
-            x = dict(
-                hostname=origin.hostname,
-                guest_driver_version=origin.guest_driver_version,
-                os_platform=origin.os_platform,
-                os_version=origin.os_version
-            )
+        try:
+            entity = session.query(Origin).filter(Origin.origin_ref == origin.origin_ref).first()
+            if entity is None:
+                session.add(origin)
+            else:
+                session.execute(update(Origin).where(Origin.origin_ref == origin.origin_ref).values(**x))
+            session.commit()
+        except IntegrityError:
+            # inserted meanwhile by a concurrent request (e.g. another worker registering the same new origin)
+            session.rollback()
             session.execute(update(Origin).where(Origin.origin_ref == origin.origin_ref).values(**x))
-        session.commit()
-        session.flush()
+            session.commit()
+        finally:
+            session.close()
+
+    @staticmethod
+    def find_all(engine: Engine) -> [OriginRow]:
+        if isinstance(engine, MemoryStore):
+            return engine.origin_find_all()
+
+        session = sessionmaker(bind=engine)()
+        rows = list(map(OriginRow._make, session.execute(select(*OriginRow.columns()))))
+        session.close()
+        return rows
+
+    @staticmethod
+    def find_by_origin_ref(engine: Engine, origin_ref: str) -> "Origin":
+        if isinstance(engine, MemoryStore):
+            return engine.origin_find_by_origin_ref(origin_ref)
+
+        session = sessionmaker(bind=engine)()
+        entity = session.query(Origin).filter(Origin.origin_ref == origin_ref).first()
+        session.close()
+        return entity
+
+    @staticmethod
+    def find_registered(engine: Engine, origin_refs: [str]) -> set[str]:
+        """ subset of "origin_refs" which are registered """
+        if isinstance(engine, MemoryStore):
+            return engine.origin_find_registered(origin_refs)
+
+        session = sessionmaker(bind=engine)()
+        registered = set(_ for _, in session.execute(select(Origin.origin_ref).where(Origin.origin_ref.in_(origin_refs))))
+        session.close()
+        return registered
+
+    @staticmethod
+    def prefix_criteria(filters: dict[str, str], dialect: str) -> list:
+        """
+        case-sensitive prefix match (same as "str.startswith") with wildcards in the prefix escaped. sqlite uses "GLOB"
+        (its "LIKE" is case-insensitive), mysql additionally compares bytes (default collations are case-insensitive)
+        """
+        criteria = []
+        for field, prefix in filter(lambda _: _[1], filters.items()):
+            column = getattr(Origin, field)
+            if dialect == 'sqlite':
+                criteria.append(column.op('GLOB')(''.join(f'[{_}]' if _ in '*?[' else _ for _ in prefix) + '*'))
+                continue
+            pattern = ''.join(f'/{_}' if _ in '/%_' else _ for _ in prefix) + '%'
+            criteria.append(column.like(pattern, escape='/'))
+            if dialect in ('mysql', 'mariadb'):
+                criteria.append(cast(column, mysql_dialect.BINARY()).like(pattern.encode('utf-8'), escape='/'))
+        return criteria
+
+    @staticmethod
+    def activity_criteria(active_after: datetime | None, active_before: datetime | None) -> list:
+        """
+        last activity (latest "lease_updated") of an origin at / after "active_after" and before "active_before", as
+        correlated "EXISTS" per origin instead of grouping all leases. Origins without leases never match.
+        """
+        def leases(*criterion):
+            return select(Lease.lease_ref).where(Lease.origin_ref == Origin.origin_ref, *criterion).correlate(Origin).exists()
+
+        criteria = []
+        if active_after is not None:
+            criteria.append(leases(Lease.lease_updated >= active_after))
+        if active_before is not None:
+            criteria += [leases(), ~leases(Lease.lease_updated >= active_before)]
+        return criteria
+
+    @staticmethod
+    def search(engine: Engine, filters: dict[str, str], active_after: datetime = None, active_before: datetime = None, after: str = None, limit: int = 100, sort: str = 'origin_ref', descending: bool = False) -> [(OriginRow, datetime | None)]:
+        """
+        Origins matching all "filters" (prefix of "SEARCH_FIELDS", uses their indexes), ordered by "sort" (one of
+        "SORT_FIELDS") and paginated by keyset ("after" is "keyset_cursor" of the last origin of previous page). Returns origins and
+        their last activity (latest "lease_updated" of its leases), "active_after" / "active_before" filter on it.
+        """
+        if isinstance(engine, MemoryStore):
+            return engine.origin_search(filters, active_after, active_before, after, limit, sort, descending)
+
+        session = sessionmaker(bind=engine)()
+        # correlated per origin (answered by index "ix_lease_origin_ref_lease_updated"), only for origins of this page
+        last_activity = select(func.max(Lease.lease_updated)).where(Lease.origin_ref == Origin.origin_ref).correlate(Origin).scalar_subquery()
+        query = session.query(*OriginRow.columns(), last_activity.label('last_activity'))
+        query = query.filter(*Origin.prefix_criteria(filters, engine.dialect.name), *Origin.activity_criteria(active_after, active_before))
+        column = getattr(Origin, sort)
+        query = keyset(query, column if sort == 'origin_ref' else func.coalesce(column, ''), Origin.origin_ref, after, descending, sort)
+        rows = query.limit(limit).all()
         session.close()
+        return [(OriginRow._make(row[:-1]), row[-1]) for row in rows]
 
     @staticmethod
     def delete(engine: Engine, origin_refs: [str] = None) -> int:
+        if isinstance(engine, MemoryStore):
+            return engine.origin_delete(origin_refs)
+
         session = sessionmaker(bind=engine)()
-        if origin_refs is None:
-            deletions = session.query(Origin).delete()
+        deletions, _ = Origin.__delete(session, [] if origin_refs is None else [Origin.origin_ref.in_(origin_refs)])
+        session.commit()
+        session.close()
+        return deletions
+
+    @staticmethod
+    def delete_matching(engine: Engine, origin_refs: [str] = None, filters: dict[str, str] = None, active_before: datetime = None) -> (int, int):
+        """
+        Deletes origins (and their leases) matching all given criteria (see "search"), origins without leases never
+        match "active_before". Returns number of deleted origins and leases.
+        """
+        if isinstance(engine, MemoryStore):
+            return engine.origin_delete_matching(origin_refs, filters, active_before)
+
+        session = sessionmaker(bind=engine)()
+        criteria = Origin.prefix_criteria(filters or {}, engine.dialect.name)
+        if origin_refs is not None:
+            criteria.append(Origin.origin_ref.in_(origin_refs))
+        if active_before is None:
+            deletions = Origin.__delete(session, criteria)
         else:
-            deletions = session.query(Origin).filter(Origin.origin_ref.in_(origin_refs)).delete()
+            # resolved once, activity changes while deleting leases (origins without leases would match afterwards)
+            criteria += Origin.activity_criteria(None, active_before)
+            origin_refs = [origin_ref for origin_ref, in session.execute(select(Origin.origin_ref).where(*criteria))]
+            deletions = Origin.__delete(session, [Origin.origin_ref.in_(origin_refs)])
         session.commit()
         session.close()
         return deletions
 
+    @staticmethod
+    def __delete(session, criteria: list) -> (int, int):
+        # leases are deleted explicitly and first (not every database enforces "ondelete"), so usage is decremented.
+        # "origin_ref" of matching origins as derived table, mysql can not select from "lease" while deleting from it
+        matching = select(Origin.origin_ref).where(*criteria).subquery()
+        criterion = [Lease.origin_ref.in_(select(matching.c.origin_ref))] if len(criteria) > 0 else []
+        lease_deletions = LeaseUsage.delete_leases(session, datetime.now(UTC), *criterion)
+        deletions = session.execute(delete(Origin).where(*criteria).execution_options(synchronize_session=False)).rowcount
+        return deletions, lease_deletions
+
     @staticmethod
     def delete_expired(engine: Engine) -> int:
+        if isinstance(engine, MemoryStore):
+            return engine.origin_delete_expired()
+
         session = sessionmaker(bind=engine)()
         origins = session.query(Origin).join(Lease, Origin.origin_ref == Lease.origin_ref, isouter=True).filter(Lease.lease_ref.is_(None)).all()
         origin_refs = [origin.origin_ref for origin in origins]
@@ -82,6 +390,7 @@ class Origin(Base):
         return deletions
 
 
+@traced
 class Lease(Base):
     __tablename__ = "lease"
 
@@ -90,25 +399,24 @@ class Lease(Base):
     origin_ref = Column(CHAR(length=36), ForeignKey(Origin.origin_ref, ondelete='CASCADE'), nullable=False, index=True)  # uuid4
     # scope_ref = Column(CHAR(length=36), nullable=False, index=True)  # uuid4 # not necessary, we only support one scope_ref ('ALLOTMENT_REF')
     lease_created = Column(DATETIME(), nullable=False)
-    lease_expires = Column(DATETIME(), nullable=False)
+    lease_expires = Column(DATETIME(), nullable=False, index=True)
     lease_updated = Column(DATETIME(), nullable=False)
+    product_name = Column(VARCHAR(length=256), nullable=True)
+    driver_branch = Column(VARCHAR(length=16), nullable=True)  # of origin when lease was created, e.g. "R550"
+    offline = Column(BOOLEAN, nullable=True)  # issued as offline lease (see "OfflineLeasePolicy")
+
+    __table_args__ = (
+        Index('ix_lease_origin_ref_lease_updated', 'origin_ref', 'lease_updated'),  # last activity per origin
+    )
+
+    FILTER_FIELDS = ('origin_ref', 'product_name', 'driver_branch')
+    SORT_FIELDS = ('lease_ref', 'origin_ref', 'lease_created', 'lease_expires', 'lease_updated', 'product_name')
 
     def __repr__(self):
         return f'Lease(origin_ref={self.origin_ref}, lease_ref={self.lease_ref}, expires={self.lease_expires})'
 
-    def serialize(self, renewal_period: float, renewal_delta: timedelta) -> dict:
-        lease_renewal = int(Lease.calculate_renewal(renewal_period, renewal_delta).total_seconds())
-        lease_renewal = self.lease_updated + relativedelta(seconds=lease_renewal)
-
-        return {
-            'lease_ref': self.lease_ref,
-            'origin_ref': self.origin_ref,
-            # 'scope_ref': self.scope_ref,
-            'lease_created': self.lease_created.replace(tzinfo=timezone.utc).isoformat(),
-            'lease_expires': self.lease_expires.replace(tzinfo=timezone.utc).isoformat(),
-            'lease_updated': self.lease_updated.replace(tzinfo=timezone.utc).isoformat(),
-            'lease_renewal': lease_renewal.replace(tzinfo=timezone.utc).isoformat(),
-        }
+    def serialize(self, renewal_period: float, renewal_delta: timedelta, renewal_jitter: float = 0) -> dict:
+        return LeaseRow.of(self).serialize(renewal_period, renewal_delta, renewal_jitter)
 
     @staticmethod
     def create_statement(engine: Engine):
@@ -117,12 +425,16 @@ class Lease(Base):
 
     @staticmethod
     def create_or_update(engine: Engine, lease: "Lease"):
+        if isinstance(engine, MemoryStore):
+            return engine.lease_create_or_update(lease)
+
         session = sessionmaker(bind=engine)()
         entity = session.query(Lease).filter(Lease.lease_ref == lease.lease_ref).first()
         if entity is None:
             if lease.lease_updated is None:
                 lease.lease_updated = lease.lease_created
             session.add(lease)
+            LeaseUsage.apply(session, {(lease.product_name, lease.driver_branch): 1}, lease.lease_created)
         else:
             x = dict(origin_ref=lease.origin_ref, lease_expires=lease.lease_expires, lease_updated=lease.lease_updated)
             session.execute(update(Lease).where(Lease.lease_ref == lease.lease_ref).values(**x))
@@ -130,8 +442,61 @@ class Lease(Base):
         session.flush()
         session.close()
 
+    @staticmethod
+    def create_many(engine: Engine, leases: ["Lease"]):
+        """ creates new leases of registered origins (see "Origin.find_registered") in one transaction """
+        if isinstance(engine, MemoryStore):
+            return engine.lease_create_many(leases)
+
+        session = sessionmaker(bind=engine)()
+        deltas = {}
+        for lease in leases:
+            lease.lease_updated = lease.lease_updated or lease.lease_created
+            deltas[(lease.product_name, lease.driver_branch)] = deltas.get((lease.product_name, lease.driver_branch), 0) + 1
+        session.add_all(leases)
+        LeaseUsage.apply(session, deltas, datetime.now(UTC))
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def find_all(engine: Engine) -> [LeaseRow]:
+        if isinstance(engine, MemoryStore):
+            return engine.lease_find_all()
+
+        session = sessionmaker(bind=engine)()
+        rows = list(map(LeaseRow._make, session.execute(select(*LeaseRow.columns()))))
+        session.close()
+        return rows
+
+    @staticmethod
+    def page(engine: Engine, filters: dict[str, str], after: str = None, limit: int = 100, sort: str = 'lease_ref', descending: bool = False) -> [LeaseRow]:
+        """ leases matching all "filters" (exact, see "FILTER_FIELDS"), ordered by "sort" and paginated by keyset """
+        if isinstance(engine, MemoryStore):
+            return engine.lease_page(filters, after, limit, sort, descending)
+
+        session = sessionmaker(bind=engine)()
+        query = session.query(*LeaseRow.columns()).filter(*[getattr(Lease, k) == v for k, v in filters.items()])
+        column = getattr(Lease, sort)
+        query = keyset(query, func.coalesce(column, '') if column.nullable else column, Lease.lease_ref, after, descending, sort)
+        rows = list(map(LeaseRow._make, query.limit(limit).all()))
+        session.close()
+        return rows
+
+    @staticmethod
+    def count(engine: Engine, filters: dict[str, str] = None) -> int:
+        if isinstance(engine, MemoryStore):
+            return engine.lease_count(filters or {})
+
+        session = sessionmaker(bind=engine)()
+        count = session.query(func.count(Lease.lease_ref)).filter(*[getattr(Lease, k) == v for k, v in (filters or {}).items()]).scalar()
+        session.close()
+        return count
+
     @staticmethod
     def find_by_origin_ref(engine: Engine, origin_ref: str) -> ["Lease"]:
+        if isinstance(engine, MemoryStore):
+            return engine.lease_find_by_origin_ref(origin_ref)
+
         session = sessionmaker(bind=engine)()
         entities = session.query(Lease).filter(Lease.origin_ref == origin_ref).all()
         session.close()
@@ -139,6 +504,9 @@ class Lease(Base):
 
     @staticmethod
     def find_by_lease_ref(engine: Engine, lease_ref: str) -> "Lease":
+        if isinstance(engine, MemoryStore):
+            return engine.lease_find_by_lease_ref(lease_ref)
+
         session = sessionmaker(bind=engine)()
         entity = session.query(Lease).filter(Lease.lease_ref == lease_ref).first()
         session.close()
@@ -146,43 +514,128 @@ class Lease(Base):
 
     @staticmethod
     def find_by_origin_ref_and_lease_ref(engine: Engine, origin_ref: str, lease_ref: str) -> "Lease":
+        if isinstance(engine, MemoryStore):
+            return engine.lease_find_by_origin_ref_and_lease_ref(origin_ref, lease_ref)
+
         session = sessionmaker(bind=engine)()
         entity = session.query(Lease).filter(and_(Lease.origin_ref == origin_ref, Lease.lease_ref == lease_ref)).first()
         session.close()
         return entity
 
     @staticmethod
-    def renew(engine: Engine, lease: "Lease", lease_expires: datetime, lease_updated: datetime):
+    def renew(engine: Engine, lease: "Lease", lease_expires: datetime, lease_updated: datetime, offline: bool = None) -> bool:
+        """ "offline" is only changed if given, returns "False" if the lease does not exist (anymore) """
+        if isinstance(engine, MemoryStore):
+            return engine.lease_renew(lease, lease_expires, lease_updated, offline)
+
         session = sessionmaker(bind=engine)()
         x = dict(lease_expires=lease_expires, lease_updated=lease_updated)
-        session.execute(update(Lease).where(and_(Lease.origin_ref == lease.origin_ref, Lease.lease_ref == lease.lease_ref)).values(**x))
+        if offline is not None:
+            x['offline'] = offline
+        statement = update(Lease).where(and_(Lease.origin_ref == lease.origin_ref, Lease.lease_ref == lease.lease_ref)).values(**x)
+        renewed = session.execute(statement).rowcount > 0
+        session.commit()
+        session.close()
+        return renewed
+
+    @staticmethod
+    def renew_many(engine: Engine, renewals: [("Lease", datetime, datetime, bool | None)]):
+        """
+        Same as "renew" for many leases (lease, lease_expires, lease_updated, offline) in one transaction, with one
+        statement executed for all (per whether "offline" is given). A lease already renewed later is not changed.
+        """
+        if isinstance(engine, MemoryStore):
+            for lease, lease_expires, lease_updated, offline in renewals:
+                engine.lease_renew(lease, lease_expires, lease_updated, offline)
+            return
+
+        table = Lease.__table__
+        criteria = and_(table.c.origin_ref == bindparam('b_origin_ref'), table.c.lease_ref == bindparam('b_lease_ref'), table.c.lease_updated <= bindparam('b_lease_updated'))
+        values = dict(lease_expires=bindparam('b_lease_expires'), lease_updated=bindparam('b_lease_updated'))
+
+        session = sessionmaker(bind=engine)()
+        for with_offline in [False, True]:
+            params = [{
+                'b_origin_ref': lease.origin_ref, 'b_lease_ref': lease.lease_ref, 'b_lease_expires': lease_expires, 'b_lease_updated': lease_updated,
+                **({'b_offline': offline} if with_offline else {}),
+            } for lease, lease_expires, lease_updated, offline in renewals if (offline is not None) == with_offline]
+            if len(params) > 0:
+                statement = update(table).where(criteria).values(**values, **({'offline': bindparam('b_offline')} if with_offline else {}))
+                session.execute(statement, params)  # "executemany"
         session.commit()
         session.close()
 
     @staticmethod
     def cleanup(engine: Engine, origin_ref: str) -> int:
+        if isinstance(engine, MemoryStore):
+            return engine.lease_cleanup(origin_ref)
+
         session = sessionmaker(bind=engine)()
-        deletions = session.query(Lease).filter(Lease.origin_ref == origin_ref).delete()
+        deletions = LeaseUsage.delete_leases(session, datetime.now(UTC), Lease.origin_ref == origin_ref)
         session.commit()
         session.close()
         return deletions
 
     @staticmethod
     def delete(engine: Engine, lease_ref: str) -> int:
+        if isinstance(engine, MemoryStore):
+            return engine.lease_delete(lease_ref)
+
         session = sessionmaker(bind=engine)()
-        deletions = session.query(Lease).filter(Lease.lease_ref == lease_ref).delete()
+        deletions = LeaseUsage.delete_leases(session, datetime.now(UTC), Lease.lease_ref == lease_ref)
         session.commit()
         session.close()
         return deletions
 
     @staticmethod
-    def delete_expired(engine: Engine) -> int:
+    def delete_matching(engine: Engine, lease_refs: [str] = None, origin_refs: [str] = None, updated_before: datetime = None) -> int:
+        """ deletes leases matching all given criteria in one statement """
+        if isinstance(engine, MemoryStore):
+            return engine.lease_delete_matching(lease_refs, origin_refs, updated_before)
+
+        criteria = []
+        if lease_refs is not None:
+            criteria.append(Lease.lease_ref.in_(lease_refs))
+        if origin_refs is not None:
+            criteria.append(Lease.origin_ref.in_(origin_refs))
+        if updated_before is not None:
+            criteria.append(Lease.lease_updated < updated_before)
+
         session = sessionmaker(bind=engine)()
-        deletions = session.query(Lease).filter(Lease.lease_expires <= datetime.now(UTC)).delete()
+        deletions = LeaseUsage.delete_leases(session, datetime.now(UTC), *criteria)
+        session.commit()
+        session.close()
+        return deletions
+
+    @staticmethod
+    def delete_expired(engine: Engine, cur_time: datetime = None) -> [(str, str)]:
+        """ deletes leases expired by "cur_time", returns "lease_ref" and "origin_ref" of the deleted leases """
+        if isinstance(engine, MemoryStore):
+            return engine.lease_delete_expired(cur_time)
+
+        session, cur_time = sessionmaker(bind=engine)(), cur_time or datetime.now(UTC)
+        deletions = LeaseUsage.delete_leases_returning(session, cur_time, Lease.lease_expires <= cur_time)
         session.commit()
         session.close()
         return deletions
 
+    def calculate_lease_renewal(self, renewal_period: float, renewal_delta: timedelta, renewal_jitter: float = 0) -> datetime:
+        return LeaseRow.of(self).calculate_lease_renewal(renewal_period, renewal_delta, renewal_jitter)
+
+    @staticmethod
+    def calculate_renewal_period(renewal_period: float, lease_ref: str, jitter: float = 0) -> float:
+        """
+        Spreads renewals of leases which were created at the same time (e.g. many VMs booted together), so they do not
+        renew at the same time forever. The offset is derived from "lease_ref", so it is the same on every renewal.
+
+        LEASE_RENEWAL_PERIOD=0.15, LEASE_RENEWAL_JITTER=0.1  # +/- 10% of renewal period
+        => every lease renews at a fixed value between 0.135 and 0.165
+        """
+        if jitter <= 0:
+            return renewal_period
+        x = int.from_bytes(sha256(lease_ref.encode('utf-8')).digest()[:8], 'big') / 2 ** 64  # uniform in [0, 1)
+        return round(renewal_period * (1 + jitter * (2 * x - 1)), 6)
+
     @staticmethod
     def calculate_renewal(renewal_period: float, delta: timedelta) -> timedelta:
         """
@@ -206,22 +659,862 @@ class Lease(Base):
         return renew
 
 
+@traced
+class LeaseUsage(Base):
+    """
+    Incrementally maintained rollup of active leases per product, driver branch and hour. A row is written for every
+    hour in which the count changed, "active" is the count at the end of the hour (or now) and "peak" the maximum within
+    the hour. Additional rows with "*" as driver branch (and as product) aggregate all branches (and all products).
+    """
+    __tablename__ = "lease_usage"
+
+    ALL, UNKNOWN = '*', 'unknown'
+
+    product_name = Column(VARCHAR(length=256), primary_key=True)
+    driver_branch = Column(VARCHAR(length=16), primary_key=True)
+    hour = Column(DATETIME(), primary_key=True)  # utc, truncated to hour
+    active = Column(INTEGER, nullable=False)
+    peak = Column(INTEGER, nullable=False)
+
+    def __repr__(self):
+        return f'LeaseUsage(product_name={self.product_name}, driver_branch={self.driver_branch}, hour={self.hour}, active={self.active})'
+
+    def serialize(self) -> dict:
+        return {
+            'hour': self.hour.replace(tzinfo=timezone.utc).isoformat(),
+            'active': self.active,
+            'peak': self.peak,
+        }
+
+    @staticmethod
+    def create_statement(engine: Engine):
+        from sqlalchemy.schema import CreateTable
+        return CreateTable(LeaseUsage.__table__).compile(engine)
+
+    @staticmethod
+    def truncate_hour(cur_time: datetime) -> datetime:
+        return cur_time.astimezone(UTC).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+    @staticmethod
+    def expand(deltas: dict[tuple[str | None, str | None], int]) -> dict[tuple[str, str], int]:
+        """ {(product_name, driver_branch): delta} => including aggregate keys "(product_name, *)" and "(*, *)" """
+        expanded = {}
+        for (product_name, driver_branch), delta in deltas.items():
+            product_name, driver_branch = product_name or LeaseUsage.UNKNOWN, driver_branch or LeaseUsage.UNKNOWN
+            for key in [(product_name, driver_branch), (product_name, LeaseUsage.ALL), (LeaseUsage.ALL, LeaseUsage.ALL)]:
+                expanded[key] = expanded.get(key, 0) + delta
+        return expanded
+
+    @staticmethod
+    def deltas_of(session, *criterion, for_update: bool = False) -> dict[tuple[str | None, str | None], int]:
+        """ negative deltas for leases matching "criterion" """
+        columns = [Lease.product_name, Lease.driver_branch]
+        query = session.query(*columns, func.count()).filter(*criterion).group_by(*columns)
+        rows = (query.with_for_update() if for_update else query).all()
+        return {(product_name, driver_branch): -count for product_name, driver_branch, count in rows}
+
+    @staticmethod
+    def delete_leases(session, cur_time: datetime, *criterion) -> int:
+        """
+        deletes leases matching "criterion" in one statement and decrements usage by the leases actually deleted, so
+        leases deleted concurrently (e.g. expired leases by every worker) are not decremented twice
+        """
+        statement = delete(Lease).where(*criterion).execution_options(synchronize_session=False)
+        if session.get_bind().dialect.delete_returning:  # postgresql, sqlite >= 3.35, mariadb
+            deltas = {}
+            for key in session.execute(statement.returning(Lease.product_name, Lease.driver_branch)).tuples():
+                deltas[key] = deltas.get(key, 0) - 1
+        else:  # grouped count locks the matching rows (mysql), so they are deleted by this transaction only
+            deltas = LeaseUsage.deltas_of(session, *criterion, for_update=True)
+            session.execute(statement)
+        LeaseUsage.apply(session, deltas, cur_time)
+        return -sum(deltas.values())
+
+    @staticmethod
+    def delete_leases_returning(session, cur_time: datetime, *criterion) -> [(str, str)]:
+        """ same as "delete_leases", but returns "lease_ref" and "origin_ref" of the deleted leases """
+        columns = [Lease.lease_ref, Lease.origin_ref, Lease.product_name, Lease.driver_branch]
+        statement = delete(Lease).where(*criterion).execution_options(synchronize_session=False)
+        if session.get_bind().dialect.delete_returning:
+            rows = session.execute(statement.returning(*columns)).all()
+        else:  # matching rows are locked, so they are deleted by this transaction only
+            rows = session.query(*columns).filter(*criterion).with_for_update().all()
+            session.execute(statement)
+        deltas = {}
+        for _, _, product_name, driver_branch in rows:
+            deltas[(product_name, driver_branch)] = deltas.get((product_name, driver_branch), 0) - 1
+        LeaseUsage.apply(session, deltas, cur_time)
+        return [(lease_ref, origin_ref) for lease_ref, origin_ref, _, _ in rows]
+
+    @staticmethod
+    def increment(delta: int) -> list:
+        """
+        ordered assignments adding "delta" to the row in place, "peak" first (mysql evaluates assignments left to right,
+        all others use the values before the update)
+        """
+        table = LeaseUsage.__table__
+        active = case((table.c.active + delta > 0, table.c.active + delta), else_=0)  # leases created before rollups existed are not counted
+        return [(table.c.peak, case((table.c.peak > active, table.c.peak), else_=active)), (table.c.active, active)]
+
+    @staticmethod
+    def upsert(dialect: str, values: dict, delta: int):
+        """ inserts the row of a new hour, or adds "delta" if it was inserted concurrently, "None" if not supported """
+        table = LeaseUsage.__table__
+        if dialect in ('sqlite', 'postgresql'):
+            module = sqlite_dialect if dialect == 'sqlite' else postgresql_dialect
+            statement = module.insert(table).values(**values)
+            return statement.on_conflict_do_update(index_elements=table.primary_key.columns, set_=dict((_.name, v) for _, v in LeaseUsage.increment(delta)))
+        if dialect in ('mysql', 'mariadb'):
+            return mysql_dialect.insert(table).values(**values).on_duplicate_key_update([(_.name, v) for _, v in LeaseUsage.increment(delta)])
+        return None
+
+    @staticmethod
+    def apply(session, deltas: dict[tuple[str | None, str | None], int], cur_time: datetime):
+        """
+        applies "deltas" within the transaction of "session". Counts are changed in the database ("active + delta"), not
+        read and written back, so concurrent workers and nodes do not lose changes. The row of a new hour starts with
+        the latest count before it.
+        """
+        table, hour = LeaseUsage.__table__, LeaseUsage.truncate_hour(cur_time)
+        dialect = session.get_bind().dialect.name
+        for (product_name, driver_branch), delta in LeaseUsage.expand(deltas).items():
+            if delta == 0:
+                continue
+            key = and_(table.c.product_name == product_name, table.c.driver_branch == driver_branch)
+            update_hour = update(table).where(key, table.c.hour == hour).ordered_values(*LeaseUsage.increment(delta))
+            if session.execute(update_hour).rowcount > 0:
+                continue
+
+            latest = select(table.c.active).where(key, table.c.hour < hour).order_by(table.c.hour.desc()).limit(1)
+            previous = session.execute(latest).scalar() or 0
+            active = max(previous + delta, 0)
+            values = dict(product_name=product_name, driver_branch=driver_branch, hour=hour, active=active, peak=max(previous, active))
+            statement = LeaseUsage.upsert(dialect, values, delta)
+            if statement is not None:
+                session.execute(statement)
+                continue
+            try:
+                with session.begin_nested():
+                    session.execute(insert(table).values(**values))
+            except IntegrityError:  # inserted by another transaction meanwhile
+                session.execute(update_hour)
+
+    @staticmethod
+    def find(engine: Engine, since: datetime) -> ["LeaseUsage"]:
+        """ all rows since given time, and per key the latest row before (which holds the count at "since") """
+        if isinstance(engine, MemoryStore):
+            return engine.usage_find(since)
+
+        since = LeaseUsage.truncate_hour(since)
+        session = sessionmaker(bind=engine)()
+        keys = [LeaseUsage.product_name, LeaseUsage.driver_branch]
+        before = session.query(*keys, func.max(LeaseUsage.hour).label('hour')).filter(LeaseUsage.hour < since).group_by(*keys).subquery()
+        entities = session.query(LeaseUsage).join(before, and_(
+            LeaseUsage.product_name == before.c.product_name,
+            LeaseUsage.driver_branch == before.c.driver_branch,
+            LeaseUsage.hour == before.c.hour,
+        )).all()
+        entities += session.query(LeaseUsage).filter(LeaseUsage.hour >= since).all()
+        session.close()
+        return sorted(entities, key=lambda _: (_.product_name, _.driver_branch, _.hour))
+
+    @staticmethod
+    def rebuild(engine: Engine, cur_time: datetime):
+        """ seeds the rollup with the currently active leases (used once, when the table was created) """
+        session = sessionmaker(bind=engine)()
+        LeaseUsage.apply(session, {k: -v for k, v in LeaseUsage.deltas_of(session).items()}, cur_time)
+        session.commit()
+        session.close()
+
+
+class LeaseCache:
+    """
+    Per-process cache of "origin_ref" => leases for the leasing endpoints (an origin usually holds one or two leases).
+    Filled on read and updated write-through by every change this process makes. Changes made by other processes
+    (workers or cluster nodes) are not seen until the entry is reloaded after "ttl" seconds. At most "max_origins" are
+    kept (least recently used are dropped), with "max_origins=0" every call goes to the database.
+    Cached leases are shared between requests, never modify them, changes replace the cached lease.
+    """
+
+    def __init__(self, max_origins: int = 10000, ttl: float = 30):
+        self.max_origins, self.ttl = max_origins, ttl
+        self.__entries: OrderedDict[str, tuple[float, dict[str, Lease]]] = OrderedDict()  # origin => (expires, leases)
+        # fills started before a change of their origin are discarded: "__fills" counts changes per origin while it is
+        # filled (origin => [changes, fills in progress]), "__generation" changes affecting all origins
+        self.__fills: dict[str, list[int]] = {}
+        self.__generation = 0
+        self.__lock = RLock()
+        self.hits, self.misses = 0, 0
+
+    def __repr__(self):
+        return f'LeaseCache(max_origins={self.max_origins}, ttl={self.ttl}, origins={len(self.__entries)})'
+
+    @staticmethod
+    def copy(lease: Lease, **changes) -> Lease:
+        x = {_.name: getattr(lease, _.name) for _ in Lease.__table__.columns}
+        return Lease(**(x | changes))
+
+    def find_by_origin_ref(self, engine: Engine, origin_ref: str) -> [Lease]:
+        if self.max_origins <= 0:
+            return Lease.find_by_origin_ref(engine, origin_ref)
+
+        with self.__lock:
+            entry = self.__entries.get(origin_ref)
+            if entry is not None and entry[0] > monotonic():
+                self.__entries.move_to_end(origin_ref)
+                self.hits += 1
+                return list(entry[1].values())
+            self.misses += 1
+            fill = self.__fills.setdefault(origin_ref, [0, 0])
+            fill[1] += 1
+            changes, generation = fill[0], self.__generation
+
+        leases = None
+        try:
+            leases = Lease.find_by_origin_ref(engine, origin_ref)
+        finally:
+            with self.__lock:
+                fill[1] -= 1
+                if fill[1] == 0:
+                    del self.__fills[origin_ref]
+                if leases is not None and changes == fill[0] and generation == self.__generation:
+                    self.__entries[origin_ref] = (monotonic() + self.ttl, {_.lease_ref: _ for _ in leases})
+                    self.__entries.move_to_end(origin_ref)
+                    while len(self.__entries) > self.max_origins:
+                        self.__entries.popitem(last=False)
+        return leases
+
+    def find_by_origin_ref_and_lease_ref(self, engine: Engine, origin_ref: str, lease_ref: str) -> Lease | None:
+        # a lease missing in cache may have been created by another process, so it is looked up in database
+        lease = next((_ for _ in self.find_by_origin_ref(engine, origin_ref) if _.lease_ref == lease_ref), None)
+        if lease is None and self.max_origins > 0:
+            lease = Lease.find_by_origin_ref_and_lease_ref(engine, origin_ref, lease_ref)
+        return lease
+
+    def put(self, lease: Lease):
+        """ after a lease was created or renewed, only origins already cached are updated """
+        with self.__lock:
+            self.__changed(lease.origin_ref)
+            if (entry := self.__entries.get(lease.origin_ref)) is not None:
+                entry[1][lease.lease_ref] = lease
+
+    def remove(self, origin_ref: str, lease_ref: str = None):
+        """ after a lease ("lease_ref") or all leases of an origin were deleted """
+        with self.__lock:
+            self.__changed(origin_ref)
+            if (entry := self.__entries.get(origin_ref)) is not None:
+                if lease_ref is None:
+                    entry[1].clear()
+                else:
+                    entry[1].pop(lease_ref, None)
+
+    def __changed(self, origin_ref: str):
+        if (fill := self.__fills.get(origin_ref)) is not None:
+            fill[0] += 1
+
+    def remove_lease(self, lease_ref: str):
+        """ after a lease was deleted whose origin is not known """
+        with self.__lock:
+            self.__generation += 1
+            for _, leases in self.__entries.values():
+                leases.pop(lease_ref, None)
+
+    def expire(self, cur_time: datetime):
+        """ after expired leases were deleted (see "Lease.delete_expired") """
+        with self.__lock:
+            self.__generation += 1
+            for _, leases in self.__entries.values():
+                for lease in list(leases.values()):
+                    if lease.lease_expires.replace(tzinfo=lease.lease_expires.tzinfo or UTC) <= cur_time:
+                        leases.pop(lease.lease_ref)
+
+    def clear(self):
+        """ after bulk changes """
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+
+
+class RenewalQueue:
+    """
+    Optional write-behind of lease renewals. With "interval > 0" renewals are queued in memory (the latest per lease)
+    and written by a background thread every "interval" seconds, or as soon as "max_size" leases are queued, in one
+    transaction (see "Lease.renew_many"). Reads apply queued renewals ("get"), "close" writes all queued renewals.
+    If the process dies, renewals of the last "interval" seconds are lost, their leases expire as of their previous
+    renewal. With "interval=0" (and for "MemoryStore", which is not slowed down by commits) every renewal is written
+    immediately.
+    """
+
+    def __init__(self, engine: Engine, interval: float = 0, max_size: int = 1000):
+        self.engine, self.interval, self.max_size = engine, interval, max_size
+        self.__pending: dict[str, tuple[Lease, datetime, datetime, bool | None]] = {}  # lease_ref => renewal
+        self.__flushing: dict[str, tuple[Lease, datetime, datetime, bool | None]] = {}  # being written, still applied
+        self.__lock, self.__flush_lock = RLock(), Lock()
+        self.__wake, self.__stopped, self.__thread = Event(), Event(), None
+        self.flushed, self.batches = 0, 0
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def __repr__(self):
+        return f'RenewalQueue(interval={self.interval}, max_size={self.max_size}, pending={len(self)})'
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__pending)
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0 and not isinstance(self.engine, MemoryStore)
+
+    def start(self):
+        """ starts writing queued renewals in a background thread """
+        if not self.enabled or self.__thread is not None:
+            return
+
+        def run():
+            while not self.__stopped.is_set():
+                self.__wake.wait(self.interval)
+                self.__wake.clear()
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.log.error(f'Failed to write {len(self)} queued renewals, retrying: {e}')
+
+        self.__thread = Thread(target=run, name='renewal-queue', daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        """ stops the background thread and writes all queued renewals """
+        self.__stopped.set()
+        self.__wake.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def renew(self, lease: Lease, lease_expires: datetime, lease_updated: datetime, offline: bool = None) -> bool:
+        """
+        same as "Lease.renew", but only queued if enabled. Then the lease is looked up by primary key first, "lease" may
+        come from a cache and have been deleted meanwhile (e.g. by another worker).
+        """
+        if not self.enabled:
+            return Lease.renew(self.engine, lease, lease_expires, lease_updated, offline)
+        if Lease.find_by_origin_ref_and_lease_ref(self.engine, lease.origin_ref, lease.lease_ref) is None:
+            return False
+
+        with self.__lock:
+            self.__pending[lease.lease_ref] = (lease, lease_expires, lease_updated, offline)
+            full = len(self.__pending) >= self.max_size
+        if full:
+            self.__wake.set()
+        return True
+
+    def get(self, lease: Lease | LeaseRow) -> Lease | LeaseRow:
+        """ "lease" (entity or row) with its queued renewal applied, as a copy """
+        if not self.__pending and not self.__flushing:
+            return lease
+        with self.__lock:
+            renewal = self.__pending.get(lease.lease_ref) or self.__flushing.get(lease.lease_ref)
+        if renewal is None:
+            return lease
+        _, lease_expires, lease_updated, offline = renewal
+        changes = dict(lease_expires=lease_expires, lease_updated=lease_updated) | ({} if offline is None else {'offline': offline})
+        return lease._replace(**changes) if isinstance(lease, LeaseRow) else LeaseCache.copy(lease, **changes)
+
+    def flush(self) -> int:
+        """ writes all queued renewals, on failure they are queued again (unless renewed again meanwhile) """
+        with self.__flush_lock:
+            with self.__lock:
+                self.__flushing, self.__pending = self.__pending, {}
+            if len(self.__flushing) == 0:
+                return 0
+            try:
+                Lease.renew_many(self.engine, list(self.__flushing.values()))
+                self.flushed, self.batches = self.flushed + len(self.__flushing), self.batches + 1
+                return len(self.__flushing)
+            except Exception:
+                with self.__lock:
+                    self.__pending = self.__flushing | self.__pending
+                raise
+            finally:
+                with self.__lock:
+                    self.__flushing = {}
+
+
+class MemoryStore:
+    """
+    Alternative storage backend ("DATABASE=memory://<directory>") for single-node setups. Origins and leases are held in
+    dicts (with an index of leases per origin), every change is appended to a fsync'd change log. Periodically (and on
+    close) a snapshot is written atomically and the change log is truncated. On startup the snapshot is loaded and the
+    change log is replayed, all logged operations are idempotent so replaying them on top of a newer snapshot is safe.
+    Without a directory ("memory://") nothing is persisted. Only a single process may use a directory at once.
+
+    All operations of "Origin" and "Lease" dispatch to the "origin_*" and "lease_*" methods if called with this store.
+    """
+
+    SCHEME = 'memory://'
+    SNAPSHOT_FILENAME, CHANGELOG_FILENAME, LOCK_FILENAME = 'snapshot.json', 'changes.log', '.lock'
+
+    def __init__(self, path: str | None = None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.path = path if path else None
+        self.__lock = RLock()
+        self.__origins: dict[str, Origin] = {}
+        self.__leases: dict[str, Lease] = {}
+        self.__leases_by_origin: dict[str, dict[str, Lease]] = {}
+        self.__usage: dict[tuple[str, str], dict[datetime, LeaseUsage]] = {}  # rows per key, ordered by hour
+        self.__active: dict[tuple[str, str], int] = {}
+        self.__changelog, self.__file_lock = None, None
+        self.__snapshots, self.__stopped = None, Event()
+
+        if self.path is not None:
+            makedirs(self.path, exist_ok=True)
+            self.__file_lock = FileLock(join(self.path, MemoryStore.LOCK_FILENAME), blocking=False).__enter__()
+            self.__load()
+            self.__changelog = open(join(self.path, MemoryStore.CHANGELOG_FILENAME), 'a', encoding='utf-8')
+
+    @staticmethod
+    def from_url(url: str) -> "MemoryStore":
+        return MemoryStore(path=url[len(MemoryStore.SCHEME):])
+
+    def __repr__(self):
+        return f'MemoryStore(path={self.path}, origins={len(self.__origins)}, leases={len(self.__leases)})'
+
+    # persistence
+
+    @staticmethod
+    def __row(entity: Base) -> dict:
+        values = {column.name: getattr(entity, column.name) for column in entity.__table__.columns}
+        return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in values.items()}
+
+    @staticmethod
+    def __entity(cls, row: dict) -> Base:
+        for column in cls.__table__.columns:
+            if isinstance(column.type, DATETIME) and row.get(column.name) is not None:
+                row[column.name] = datetime.fromisoformat(row.get(column.name))
+        return cls(**row)
+
+    def __load(self):
+        snapshot_filename = join(self.path, MemoryStore.SNAPSHOT_FILENAME)
+        changelog_filename = join(self.path, MemoryStore.CHANGELOG_FILENAME)
+
+        if isfile(snapshot_filename):
+            with open(snapshot_filename, 'r', encoding='utf-8') as file:
+                snapshot = json_loads(file.read())
+            for row in snapshot.get('origins'):
+                self.__put_origin(MemoryStore.__entity(Origin, row))
+            for row in snapshot.get('leases'):
+                self.__put_lease(MemoryStore.__entity(Lease, row))
+            for row in snapshot.get('usage', []):
+                usage = MemoryStore.__entity(LeaseUsage, row)
+                self.__usage.setdefault((usage.product_name, usage.driver_branch), {})[usage.hour] = usage
+
+        changes = 0
+        if isfile(changelog_filename):
+            with open(changelog_filename, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        change = json_loads(line)
+                    except ValueError:  # last line may be incomplete if process was killed while writing
+                        self.log.warning(f'Skipping invalid change log entry: {line.strip()}')
+                        continue
+                    self.__apply(change)
+                    changes += 1
+
+        # usage changes are not logged, active counts are derived from leases and differences recorded in current hour
+        counts = {}
+        for lease in self.__leases.values():
+            counts[(lease.product_name, lease.driver_branch)] = counts.get((lease.product_name, lease.driver_branch), 0) + 1
+        counts, hour = LeaseUsage.expand(counts), LeaseUsage.truncate_hour(datetime.now(UTC))
+        for key in set(self.__usage.keys()) | set(counts.keys()):
+            latest = next(reversed(self.__usage.get(key, {}).values()), None)
+            self.__active[key] = counts.get(key, 0)
+            if latest is None or latest.active != counts.get(key, 0):
+                self.__set_usage(key, counts.get(key, 0), hour)
+
+        self.log.info(f'Loaded {len(self.__origins)} origins and {len(self.__leases)} leases ({changes} changes replayed).')
+
+    def __apply(self, change: dict):
+        op, data = change.get('op'), change.get('data')
+        if op == 'origin':
+            self.__put_origin(MemoryStore.__entity(Origin, data))
+        elif op == 'lease':
+            self.__put_lease(MemoryStore.__entity(Lease, data))
+        elif op == 'renew':
+            lease = self.__leases.get(data.get('lease_ref'))
+            if lease is not None:
+                lease.lease_expires = datetime.fromisoformat(data.get('lease_expires'))
+                lease.lease_updated = datetime.fromisoformat(data.get('lease_updated'))
+                lease.offline = data.get('offline', lease.offline)
+        elif op == 'delete_origins':
+            for origin_ref in data:
+                self.__remove_origin(origin_ref)
+        elif op == 'delete_leases':
+            for lease_ref in data:
+                self.__remove_lease(lease_ref)
+
+    def __write(self, op: str, data: dict | list):
+        if self.__changelog is None:
+            return
+        self.__changelog.write(json_dumps({'op': op, 'data': data}, separators=(',', ':')) + '\n')
+        self.__changelog.flush()
+        fsync(self.__changelog.fileno())
+
+    def snapshot(self):
+        if self.path is None:
+            return
+        with self.__lock:
+            snapshot = {
+                'origins': [MemoryStore.__row(_) for _ in self.__origins.values()],
+                'leases': [MemoryStore.__row(_) for _ in self.__leases.values()],
+                'usage': [MemoryStore.__row(_) for rows in self.__usage.values() for _ in rows.values()],
+            }
+            write_file_atomic(join(self.path, MemoryStore.SNAPSHOT_FILENAME), json_dumps(snapshot).encode('utf-8'))
+            self.__changelog.truncate(0)
+            self.__changelog.flush()
+            fsync(self.__changelog.fileno())
+        self.log.debug(f'Written snapshot with {len(snapshot.get("origins"))} origins and {len(snapshot.get("leases"))} leases.')
+
+    def start(self, interval: float):
+        """ starts writing snapshots every "interval" seconds in a background thread """
+        if self.path is None or interval <= 0 or self.__snapshots is not None:
+            return
+
+        def run():
+            while not self.__stopped.wait(interval):
+                try:
+                    self.snapshot()
+                except Exception as e:
+                    self.log.error(f'Failed to write snapshot: {e}')
+
+        self.__snapshots = Thread(target=run, name='memory-store-snapshots', daemon=True)
+        self.__snapshots.start()
+
+    def close(self):
+        self.__stopped.set()
+        if self.__snapshots is not None:
+            self.__snapshots.join()
+        if self.path is not None and self.__changelog is not None:
+            self.snapshot()
+            self.__changelog.close()
+            self.__changelog = None
+            self.__file_lock.__exit__()
+
+    # indexes (callers hold the lock)
+
+    def __put_origin(self, origin: Origin):
+        self.__origins[origin.origin_ref] = origin
+
+    def __remove_origin(self, origin_ref: str) -> bool:
+        for lease_ref in list(self.__leases_by_origin.get(origin_ref, {}).keys()):
+            self.__remove_lease(lease_ref)
+        return self.__origins.pop(origin_ref, None) is not None
+
+    def __put_lease(self, lease: Lease):
+        existing = self.__leases.get(lease.lease_ref)
+        if existing is not None and existing.origin_ref != lease.origin_ref:
+            self.__leases_by_origin.get(existing.origin_ref, {}).pop(lease.lease_ref, None)
+        self.__leases[lease.lease_ref] = lease
+        self.__leases_by_origin.setdefault(lease.origin_ref, {})[lease.lease_ref] = lease
+
+    def __remove_lease(self, lease_ref: str) -> bool:
+        lease = self.__leases.pop(lease_ref, None)
+        if lease is None:
+            return False
+        leases = self.__leases_by_origin.get(lease.origin_ref, {})
+        leases.pop(lease_ref, None)
+        if len(leases) == 0:
+            self.__leases_by_origin.pop(lease.origin_ref, None)
+        return True
+
+    def __set_usage(self, key: tuple[str, str], active: int, hour: datetime):
+        self.__active[key] = active
+        rows = self.__usage.setdefault(key, {})
+        latest = next(reversed(rows.values()), None)
+        if latest is not None and latest.hour == hour:
+            latest.active, latest.peak = active, max(latest.peak, active)
+        else:
+            previous = latest.active if latest is not None else 0
+            rows[hour] = LeaseUsage(product_name=key[0], driver_branch=key[1], hour=hour, active=active, peak=max(previous, active))
+
+    def __record_usage(self, deltas: dict[tuple[str | None, str | None], int], cur_time: datetime):
+        hour = LeaseUsage.truncate_hour(cur_time)
+        for key, delta in LeaseUsage.expand(deltas).items():
+            self.__set_usage(key, max(self.__active.get(key, 0) + delta, 0), hour)
+
+    def __usage_deltas(self, lease_refs: [str]) -> dict[tuple[str | None, str | None], int]:
+        deltas = {}
+        for lease in filter(None, map(self.__leases.get, lease_refs)):
+            deltas[(lease.product_name, lease.driver_branch)] = deltas.get((lease.product_name, lease.driver_branch), 0) - 1
+        return deltas
+
+    # origin operations
+
+    def origin_create_or_update(self, origin: Origin):
+        with self.__lock:
+            entity = self.__origins.get(origin.origin_ref)
+            if entity is not None:
+                entity.hostname = origin.hostname
+                entity.guest_driver_version = origin.guest_driver_version
+                entity.os_platform = origin.os_platform
+                entity.os_version = origin.os_version
+                origin = entity
+            self.__put_origin(origin)
+            self.__write('origin', MemoryStore.__row(origin))
+
+    def origin_find_all(self) -> [OriginRow]:
+        with self.__lock:
+            return list(map(OriginRow.of, self.__origins.values()))
+
+    def origin_find_by_origin_ref(self, origin_ref: str) -> Origin | None:
+        return self.__origins.get(origin_ref)
+
+    def origin_find_registered(self, origin_refs: [str]) -> set[str]:
+        with self.__lock:
+            return set(_ for _ in origin_refs if _ in self.__origins)
+
+    def origin_search(self, filters: dict[str, str], active_after: datetime = None, active_before: datetime = None, after: str = None, limit: int = 100, sort: str = 'origin_ref', descending: bool = False) -> [(OriginRow, datetime | None)]:
+        with self.__lock:
+            entities = []
+            for origin in keyset_list(list(self.__origins.values()), sort, 'origin_ref', after, descending):
+                origin_ref = origin.origin_ref
+                if not all((getattr(origin, field) or '').startswith(prefix) for field, prefix in filters.items()):
+                    continue
+                leases = self.__leases_by_origin.get(origin_ref, {}).values()
+                last_activity = max((_.lease_updated for _ in leases), default=None)
+                if (active_after is not None or active_before is not None) and last_activity is None:
+                    continue
+                if active_after is not None and last_activity.replace(tzinfo=UTC) < active_after:
+                    continue
+                if active_before is not None and last_activity.replace(tzinfo=UTC) >= active_before:
+                    continue
+                entities.append((OriginRow.of(origin), last_activity))
+                if len(entities) >= limit:
+                    break
+            return entities
+
+    def origin_delete(self, origin_refs: [str] = None) -> int:
+        with self.__lock:
+            origin_refs = list(self.__origins.keys()) if origin_refs is None else origin_refs
+            lease_refs = [_ for origin_ref in origin_refs for _ in self.__leases_by_origin.get(origin_ref, {}).keys()]
+            self.__record_usage(self.__usage_deltas(lease_refs), datetime.now(UTC))
+            deletions = [_ for _ in origin_refs if self.__remove_origin(_)]
+            if len(deletions) > 0:
+                self.__write('delete_origins', deletions)
+            return len(deletions)
+
+    def origin_delete_matching(self, origin_refs: [str] = None, filters: dict[str, str] = None, active_before: datetime = None) -> (int, int):
+        origin_refs = set(origin_refs) if origin_refs is not None else None
+        with self.__lock:
+            matches = self.origin_search(filters or {}, active_before=active_before, limit=len(self.__origins) + 1)
+            matches = [origin.origin_ref for origin, _ in matches if origin_refs is None or origin.origin_ref in origin_refs]
+            leases = sum(len(self.__leases_by_origin.get(_, {})) for _ in matches)
+            return self.origin_delete(matches), leases
+
+    def origin_delete_expired(self) -> int:
+        with self.__lock:
+            origin_refs = [_ for _ in self.__origins.keys() if _ not in self.__leases_by_origin]
+            return self.origin_delete(origin_refs)
+
+    # lease operations
+
+    def lease_create_or_update(self, lease: Lease):
+        with self.__lock:
+            entity = self.__leases.get(lease.lease_ref)
+            if entity is None:
+                if lease.lease_updated is None:
+                    lease.lease_updated = lease.lease_created
+                self.__record_usage({(lease.product_name, lease.driver_branch): 1}, lease.lease_created)
+            else:
+                entity.origin_ref = lease.origin_ref
+                entity.lease_expires = lease.lease_expires
+                entity.lease_updated = lease.lease_updated
+                lease = entity
+            self.__put_lease(lease)
+            self.__write('lease', MemoryStore.__row(lease))
+
+    def lease_create_many(self, leases: [Lease]):
+        with self.__lock:
+            for lease in leases:
+                self.lease_create_or_update(lease)
+
+    def lease_find_all(self) -> [LeaseRow]:
+        with self.__lock:
+            return list(map(LeaseRow.of, self.__leases.values()))
+
+    def lease_page(self, filters: dict[str, str], after: str = None, limit: int = 100, sort: str = 'lease_ref', descending: bool = False) -> [LeaseRow]:
+        with self.__lock:
+            leases = self.__leases_by_origin.get(filters.get('origin_ref'), {}) if 'origin_ref' in filters else self.__leases
+            leases = [LeaseRow.of(_) for _ in leases.values() if all(getattr(_, k) == v for k, v in filters.items())]
+        return keyset_list(leases, sort, 'lease_ref', after, descending)[:limit]
+
+    def lease_count(self, filters: dict[str, str]) -> int:
+        with self.__lock:
+            return sum(1 for _ in self.__leases.values() if all(getattr(_, k) == v for k, v in filters.items()))
+
+    def lease_find_by_origin_ref(self, origin_ref: str) -> [Lease]:
+        with self.__lock:
+            return list(self.__leases_by_origin.get(origin_ref, {}).values())
+
+    def lease_find_by_lease_ref(self, lease_ref: str) -> Lease | None:
+        return self.__leases.get(lease_ref)
+
+    def lease_find_by_origin_ref_and_lease_ref(self, origin_ref: str, lease_ref: str) -> Lease | None:
+        return self.__leases_by_origin.get(origin_ref, {}).get(lease_ref)
+
+    def lease_renew(self, lease: Lease, lease_expires: datetime, lease_updated: datetime, offline: bool = None) -> bool:
+        with self.__lock:
+            entity = self.__leases_by_origin.get(lease.origin_ref, {}).get(lease.lease_ref)
+            if entity is None:
+                return False
+            entity.lease_expires, entity.lease_updated = lease_expires, lease_updated
+            entity.offline = offline if offline is not None else entity.offline
+            data = dict(lease_ref=lease.lease_ref, lease_expires=lease_expires.isoformat(), lease_updated=lease_updated.isoformat(), offline=entity.offline)
+            self.__write('renew', data)
+            return True
+
+    def lease_cleanup(self, origin_ref: str) -> int:
+        with self.__lock:
+            lease_refs = list(self.__leases_by_origin.get(origin_ref, {}).keys())
+            return self.__delete_leases(lease_refs)
+
+    def lease_delete(self, lease_ref: str) -> int:
+        with self.__lock:
+            return self.__delete_leases([lease_ref])
+
+    def lease_delete_matching(self, lease_refs: [str] = None, origin_refs: [str] = None, updated_before: datetime = None) -> int:
+        lease_refs = set(lease_refs) if lease_refs is not None else None
+        origin_refs = set(origin_refs) if origin_refs is not None else None
+        with self.__lock:
+            lease_refs = [_.lease_ref for _ in self.__leases.values() if all([
+                lease_refs is None or _.lease_ref in lease_refs,
+                origin_refs is None or _.origin_ref in origin_refs,
+                updated_before is None or _.lease_updated.replace(tzinfo=UTC) < updated_before,
+            ])]
+            return self.__delete_leases(lease_refs)
+
+    def lease_delete_expired(self, cur_time: datetime = None) -> [(str, str)]:
+        with self.__lock:
+            now = cur_time or datetime.now(UTC)
+            expired = [(_.lease_ref, _.origin_ref) for _ in self.__leases.values() if _.lease_expires.replace(tzinfo=UTC) <= now]
+            self.__delete_leases([lease_ref for lease_ref, _ in expired])
+            return expired
+
+    def __delete_leases(self, lease_refs: [str]) -> int:
+        self.__record_usage(self.__usage_deltas(lease_refs), datetime.now(UTC))
+        deletions = [_ for _ in lease_refs if self.__remove_lease(_)]
+        if len(deletions) > 0:
+            self.__write('delete_leases', deletions)
+        return len(deletions)
+
+    # usage operations
+
+    def usage_find(self, since: datetime) -> [LeaseUsage]:
+        since = LeaseUsage.truncate_hour(since)
+        with self.__lock:
+            entities = []
+            for key in sorted(self.__usage.keys()):
+                rows = list(self.__usage.get(key).values())
+                entities += [_ for _ in rows if _.hour < since][-1:] + [_ for _ in rows if _.hour >= since]
+            return entities
+
+
+def create_tuned_engine(url: str, profile: str = 'none') -> (Engine, dict):
+    """
+    Creates an engine with settings of given tuning profile (see "TUNING_PROFILES") for the dialect of "url".
+    Returns the engine and the applied settings, for "sqlite" these are the values read back after setting them.
+    """
+    if profile not in TUNING_PROFILES:
+        raise ValueError(f'Unknown database tuning profile "{profile}", use one of {list(TUNING_PROFILES.keys())}')
+
+    dialect = make_url(url).get_backend_name()
+    dialect = 'mysql' if dialect == 'mariadb' else dialect
+    settings = TUNING_PROFILES.get(profile).get(dialect, {})
+    applied = {'profile': profile, 'dialect': dialect, 'settings': {}}
+
+    if dialect != 'sqlite':
+        applied['settings'].update(settings)
+        return create_engine(url, **settings), applied
+
+    engine = create_engine(url)
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in settings.items():
+            cursor.execute(f'PRAGMA {pragma}={value}')
+            applied['settings'][pragma] = cursor.execute(f'PRAGMA {pragma}').fetchone()[0]
+        cursor.close()
+
+    return engine, applied
+
+
+class DatabaseLock:
+    """
+    Exclusive lock held in the database, shared between all nodes using it (like "FileLock" for processes of one host).
+    Uses "pg_advisory_lock" on postgres and "GET_LOCK" on mysql / mariadb, for all other dialects (e.g. "sqlite", which
+    is local anyway) and "MemoryStore" this does nothing. After entering, "contended" tells if another node was holding
+    the lock.
+    """
+
+    def __init__(self, engine: Engine, name: str):
+        self.engine, self.name = engine, name
+        self.key = int.from_bytes(sha256(name.encode('utf-8')).digest()[:8], 'big', signed=True)  # bigint for postgres
+        self.contended = False
+        self.__connection, self.__release = None, None
+
+    def __enter__(self) -> "DatabaseLock":
+        dialect = None if isinstance(self.engine, MemoryStore) else self.engine.dialect.name
+        if dialect == 'postgresql':
+            statements = ('SELECT pg_try_advisory_lock(:key)', 'SELECT pg_advisory_lock(:key)', 'SELECT pg_advisory_unlock(:key)')
+        elif dialect in ('mysql', 'mariadb'):
+            statements = ('SELECT GET_LOCK(:name, 0)', 'SELECT GET_LOCK(:name, -1)', 'SELECT RELEASE_LOCK(:name)')
+        else:
+            return self
+
+        # session level locks, held (and released) by this connection
+        self.__connection, self.__release = self.engine.connect(), statements[2]
+        if not self.__connection.execute(text(statements[0]), dict(key=self.key, name=self.name)).scalar():
+            self.contended = True
+            logging.getLogger(__name__).debug(f'Waiting for database lock "{self.name}"')
+            self.__connection.execute(text(statements[1]), dict(key=self.key, name=self.name))
+        self.__connection.commit()
+        return self
+
+    def __exit__(self, *args):
+        if self.__connection is not None:
+            self.__connection.execute(text(self.__release), dict(key=self.key, name=self.name))
+            self.__connection.commit()
+            self.__connection.close()
+            self.__connection = None
+
+
+def observe_queries(engine: Engine, on_query: Callable[[str], None]):
+    """ calls "on_query" with the statement kind (e.g. "select", "update") before each query executed by "engine" """
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement: str, parameters, context, executemany):
+        on_query(statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'unknown')
+
+
 def init(engine: Engine):
-    tables = [Origin, Lease]
-    db = inspect(engine)
-    session = sessionmaker(bind=engine)()
-    for table in tables:
-        if not db.dialect.has_table(engine.connect(), table.__tablename__):
-            session.execute(text(str(table.create_statement(engine))))
-            session.commit()
-    session.close()
+    if isinstance(engine, MemoryStore):
+        return
+
+    tables = [Origin, Lease, LeaseUsage]
+    with engine.connect() as connection:
+        for table in tables:
+            if not connection.dialect.has_table(connection, table.__tablename__):
+                connection.execute(text(str(table.create_statement(engine))))
+                connection.commit()
 
 
 def migrate(engine: Engine):
-    db = inspect(engine)
+    if isinstance(engine, MemoryStore):
+        return
 
     def upgrade_1_0_to_1_1():
-        x = db.dialect.get_columns(engine.connect(), Lease.__tablename__)
+        with engine.connect() as connection:
+            x = connection.dialect.get_columns(connection, Lease.__tablename__)
         x = next(_ for _ in x if _['name'] == 'origin_ref')
         if x['primary_key'] > 0:
             print('Found old database schema with "origin_ref" as primary-key in "lease" table. Dropping table!')
@@ -230,6 +1523,32 @@ def migrate(engine: Engine):
             Lease.__table__.drop(bind=engine)
             init(engine)
 
+    def upgrade_1_x_to_lease_usage():
+        with engine.connect() as connection:
+            x = connection.dialect.get_columns(connection, Lease.__tablename__)
+            for column in [Lease.product_name, Lease.driver_branch, Lease.offline]:
+                if next((_ for _ in x if _['name'] == column.name), None) is None:
+                    print(f'Adding column "{column.name}" to "lease" table.')
+                    column_type = column.type.compile(engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {Lease.__tablename__} ADD COLUMN {column.name} {column_type}'))
+                    connection.commit()
+        session = sessionmaker(bind=engine)()
+        empty = session.query(LeaseUsage).first() is None
+        session.close()
+        if empty:
+            LeaseUsage.rebuild(engine, datetime.now(UTC))
+
+    def create_indexes():
+        # "init" creates tables without indexes, create missing ones (for new and existing databases)
+        for table in [Origin, Lease]:
+            for index in table.__table__.indexes:
+                index.create(bind=engine, checkfirst=True)
+        if engine.dialect.name == 'postgresql':  # "LIKE 'prefix%'" uses btree indexes only with pattern ops (or "C" locale)
+            with engine.connect() as connection:
+                for field in Origin.SEARCH_FIELDS:
+                    connection.execute(text(f'CREATE INDEX IF NOT EXISTS ix_origin_{field}_pattern ON {Origin.__tablename__} ({field} varchar_pattern_ops)'))
+                connection.commit()
+
     # def upgrade_1_2_to_1_3():
     #    x = db.dialect.get_columns(engine.connect(), Lease.__tablename__)
     #    x = next((_ for _ in x if _['name'] == 'scope_ref'), None)
@@ -241,3 +1560,5 @@ def migrate(engine: Engine):
 
     upgrade_1_0_to_1_1()
     # upgrade_1_2_to_1_3()
+    upgrade_1_x_to_lease_usage()
+    create_indexes()
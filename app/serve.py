@@ -0,0 +1,161 @@
+"""
+Production entry point, runs "main:app" with uvicorn configured from environment (see README "Configuration").
+
+    python app/serve.py   # or "python -m serve" in app dir
+
+Every worker is a separate process. Without "REUSE_PORT" all workers accept on one socket bound by this process, with
+"REUSE_PORT" every worker binds its own socket ("SO_REUSEPORT") and the kernel balances new connections between them.
+On SIGTERM (or SIGINT) workers stop accepting, finish open requests (up to "GRACEFUL_TIMEOUT") and run the app shutdown.
+"""
+import logging
+import multiprocessing
+import signal
+import socket
+import sys
+from json import dumps as json_dumps
+from os import cpu_count, environ, setpgrp
+from os.path import join, dirname, isfile
+from collections import deque
+from threading import Event
+from time import monotonic
+
+logger = logging.getLogger('serve')
+
+APP_DIR = dirname(__file__)
+RESTART_DELAY, RESTART_MAX_DELAY = 0.5, 30  # seconds until a failed worker is restarted, doubled per failure in a row
+RESTART_LIMIT, RESTART_WINDOW = 5, 60  # failures (of all workers) within seconds until the supervisor gives up
+
+
+def settings(env: dict = environ) -> dict:
+    """ effective settings, "uvicorn" are passed to "uvicorn.Config" """
+    def optional_int(key: str) -> int | None:
+        return int(env.get(key)) if env.get(key) else None
+
+    workers = str(env.get('WORKERS', 1))
+    ssl_keyfile = env.get('SSL_KEYFILE', join(APP_DIR, 'cert/webserver.key')) or None  # empty disables https
+    ssl_certfile = env.get('SSL_CERTFILE', join(APP_DIR, 'cert/webserver.crt')) or None
+    return {
+        'workers': (cpu_count() or 1) if workers == 'auto' else max(int(workers), 1),
+        'reuse_port': str(env.get('REUSE_PORT', 'false')).lower() in ('true', '1'),
+        'uvicorn': {
+            'host': env.get('BIND_HOST', '0.0.0.0'),
+            'port': int(env.get('BIND_PORT', 443 if ssl_keyfile else 8000)),
+            'loop': env.get('LOOP', 'auto'),  # "auto", "asyncio" or "uvloop"
+            'http': env.get('HTTP', 'auto'),  # "auto", "h11" or "httptools"
+            'backlog': int(env.get('BACKLOG', 2048)),
+            'timeout_keep_alive': int(env.get('KEEP_ALIVE', 5)),
+            'limit_concurrency': optional_int('LIMIT_CONCURRENCY'),  # per worker, further requests get 503
+            'limit_max_requests': optional_int('LIMIT_MAX_REQUESTS'),  # per worker, which is restarted after
+            'timeout_graceful_shutdown': int(env.get('GRACEFUL_TIMEOUT', 30)),
+            'proxy_headers': True,
+            'forwarded_allow_ips': env.get('FORWARDED_ALLOW_IPS', '127.0.0.1'),
+            'ssl_keyfile': ssl_keyfile,
+            'ssl_certfile': ssl_certfile,
+        },
+    }
+
+
+def bind(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    """ listening starts with the server, using its backlog """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def run(config: dict, sock: socket.socket | None = None, supervised: bool = False):
+    """ runs one worker until SIGTERM / SIGINT (handled by uvicorn), binds its own socket if none is given """
+    import uvicorn
+
+    if supervised:
+        setpgrp()  # no SIGINT of terminal, supervisor sends SIGTERM (a second signal would skip draining)
+    sock = sock or bind(config.get('host'), config.get('port'), reuse_port=True)
+    sys.path.insert(0, APP_DIR)
+    server = uvicorn.Server(uvicorn.Config('main:app', **config))
+    server.run(sockets=[sock])
+
+
+def supervise(x: dict) -> int:
+    """
+    starts "workers" processes and restarts exited ones until SIGTERM / SIGINT, then waits for them to drain. Failed
+    workers (e.g. database not reachable) are restarted with backoff, after "RESTART_LIMIT" failures within
+    "RESTART_WINDOW" seconds all workers are stopped. Returns the exit code (1 if it gave up).
+    """
+    config, stop, code = x.get('uvicorn'), Event(), 0
+    sock = None if x.get('reuse_port') else bind(config.get('host'), config.get('port'))
+    context = multiprocessing.get_context('spawn')
+    workers = x.get('workers')
+    failures, failed_in_row, started, restart_at = deque(), [0] * workers, [0.] * workers, [0.] * workers
+
+    def start(idx: int):
+        process = context.Process(target=run, args=(config, sock, True), name=f'worker-{idx}')
+        process.start()
+        started[idx] = monotonic()
+        logger.info(f'Started worker {idx} (pid {process.pid}).')
+        return process
+
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    processes = [start(idx) for idx in range(workers)]
+    while not stop.wait(timeout=0.5):
+        now = monotonic()
+        for idx, process in enumerate(processes):
+            if process is None:  # waiting for restart
+                if now >= restart_at[idx]:
+                    processes[idx] = start(idx)
+                continue
+            if process.is_alive():
+                continue
+            if process.exitcode == 0:  # e.g. "LIMIT_MAX_REQUESTS" reached
+                logger.info(f'Worker {idx} (pid {process.pid}) exited, restarting.')
+                failed_in_row[idx], processes[idx] = 0, start(idx)
+                continue
+
+            failures.append(now)
+            while failures[0] < now - RESTART_WINDOW:
+                failures.popleft()
+            if len(failures) >= RESTART_LIMIT:
+                logger.error(f'Workers failed {len(failures)} times within {RESTART_WINDOW}s, giving up (worker {idx} exited with code {process.exitcode}).')
+                stop.set()
+                code = 1
+                break
+            if now - started[idx] > RESTART_WINDOW:  # was running fine, not failing in a row
+                failed_in_row[idx] = 0
+            delay = min(RESTART_DELAY * 2 ** failed_in_row[idx], RESTART_MAX_DELAY)
+            failed_in_row[idx] += 1
+            logger.warning(f'Worker {idx} (pid {process.pid}) exited with code {process.exitcode}, restarting in {delay}s.')
+            processes[idx], restart_at[idx] = None, now + delay
+
+    processes = [_ for _ in processes if _ is not None]
+    logger.info(f'Stopping {len(processes)} workers (draining up to {config.get("timeout_graceful_shutdown")}s).')
+    for process in processes:
+        if process.is_alive():
+            process.terminate()  # SIGTERM, graceful shutdown of uvicorn
+    for process in processes:
+        process.join(timeout=config.get('timeout_graceful_shutdown') + 10)  # plus app shutdown
+        if process.is_alive():
+            logger.warning(f'Worker (pid {process.pid}) did not stop in time, killing.')
+            process.kill()
+    if sock is not None:
+        sock.close()
+    return code
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s', level=logging.INFO)
+
+    x = settings()
+    for _ in filter(None, [x['uvicorn'].get('ssl_keyfile'), x['uvicorn'].get('ssl_certfile')]):
+        if not isfile(_):
+            logger.error(f'"{_}" does not exist, create a certificate or set "SSL_KEYFILE" and "SSL_CERTFILE" empty (http).')
+            exit(1)
+
+    logger.info(f'Serving with {json_dumps(x)}')  # effective settings, to reproduce throughput measurements
+    if x.get('workers') == 1 and x['uvicorn'].get('limit_max_requests') is None:
+        run(x.get('uvicorn'), bind(x['uvicorn'].get('host'), x['uvicorn'].get('port'), x.get('reuse_port')))
+    else:
+        exit(supervise(x))
@@ -1,7 +1,23 @@
+import asyncio
 import logging
+import re
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, UTC, timedelta
-from json import loads as json_loads
-from os.path import join, dirname, isfile, isdir
+from hashlib import sha256
+from json import loads as json_loads, dumps as json_dumps
+from os import cpu_count, fsync, replace
+from os.path import join, dirname, isfile, isdir, getmtime
+from queue import Queue, Full
+from random import random
+from threading import Lock, Thread
+from time import monotonic, perf_counter, time
+from typing import Any, Awaitable, Callable, Hashable, Iterator
+from uuid import uuid4
 
 from cryptography import x509
 from cryptography.hazmat._oid import NameOID
@@ -12,6 +28,21 @@ from cryptography.hazmat.primitives.hashes import SHA256
 from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
 from cryptography.x509 import load_pem_x509_certificate, Certificate
+from jose import jwk, jws
+from jose.constants import ALGORITHMS
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    import fcntl
+except ImportError:  # not available on windows, locking is not supported there
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # optional ("pip install brotli"), only "gzip" compression is available without
+    brotli = None
 
 logging.basicConfig()
 
@@ -24,6 +55,76 @@ def load_file(filename: str) -> bytes:
     return content
 
 
+def parse_nodes(value: str, default_port: int) -> [(str, int)]:
+    """
+    Parses a comma separated list of "host[:port]" (IPv6 addresses in brackets, e.g. "[fd00::1]:443").
+    e.g. "dls-1.example.com,dls-2.example.com:8443" => [('dls-1.example.com', 443), ('dls-2.example.com', 8443)]
+    """
+    nodes = []
+    for node in filter(None, map(str.strip, value.split(','))):
+        host, port = node, default_port
+        if node.startswith('['):
+            host, _, port = node[1:].partition(']')
+            port = int(port[1:]) if port.startswith(':') else default_port
+        elif node.count(':') == 1:
+            host, port = node.split(':')
+        nodes.append((host, int(port)))
+    return nodes
+
+
+def write_file_atomic(filename: str, content: bytes):
+    # write to a temporary file first, so other processes never read half-written files
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(content)
+        file.flush()
+        fsync(file.fileno())
+    replace(tmp, filename)
+
+
+class FileLock:
+    """
+    Exclusive (advisory) lock on a file, shared between processes (e.g. uvicorn workers).
+    After entering, "contended" tells if another process was holding the lock, so callers can skip work already done.
+    If not "blocking", entering raises "BlockingIOError" instead of waiting for the other process.
+    """
+
+    def __init__(self, filename: str, blocking: bool = True):
+        self.filename = filename
+        self.blocking = blocking
+        self.contended = False
+        self.__file = None
+
+    def __enter__(self) -> "FileLock":
+        self.__file = open(self.filename, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.contended = True
+                if not self.blocking:
+                    self.__file.close()
+                    raise
+                logging.getLogger(__name__).debug(f'Waiting for lock "{self.filename}"')
+                fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+        self.__file.close()
+
+
+def generate_private_key_pem(key_size: int, public_exponent: int = 65537) -> bytes:
+    # module level function (and pem as return type), so it can be pickled into a worker process
+    key = generate_private_key(public_exponent=public_exponent, key_size=key_size)
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
 class CASetup:
     ###
     #
@@ -38,32 +139,69 @@ class CASetup:
     SI_PRIVATE_KEY_FILENAME = 'si_private_key.pem'
     SI_CERTIFICATE_FILENAME = 'si_certificate.pem'
 
+    LOCK_FILENAME = '.ca_setup.lock'
+
     def __init__(self, service_instance_ref: str, cert_path: str = None):
         cert_path_prefix = join(dirname(__file__), 'cert')
         if cert_path is not None and len(cert_path) > 0 and isdir(cert_path):
             cert_path_prefix = cert_path
 
+        # previous versions only stored the root private key in "cert_path", all other files in "app/cert"
+        legacy = (isfile(join(cert_path_prefix, CASetup.ROOT_PRIVATE_KEY_FILENAME))
+                  and not isfile(join(cert_path_prefix, CASetup.ROOT_CERTIFICATE_FILENAME)))
+        files_prefix = join(dirname(__file__), 'cert') if legacy else cert_path_prefix
+
         self.service_instance_ref = service_instance_ref
         self.root_private_key_filename = join(cert_path_prefix, CASetup.ROOT_PRIVATE_KEY_FILENAME)
-        self.root_certificate_filename = join(dirname(__file__), 'cert', CASetup.ROOT_CERTIFICATE_FILENAME)
-        self.ca_private_key_filename = join(dirname(__file__), 'cert', CASetup.CA_PRIVATE_KEY_FILENAME)
-        self.ca_certificate_filename = join(dirname(__file__), 'cert', CASetup.CA_CERTIFICATE_FILENAME)
-        self.si_private_key_filename = join(dirname(__file__), 'cert', CASetup.SI_PRIVATE_KEY_FILENAME)
-        self.si_certificate_filename = join(dirname(__file__), 'cert', CASetup.SI_CERTIFICATE_FILENAME)
-
-        if not (isfile(self.root_private_key_filename)
+        self.root_certificate_filename = join(files_prefix, CASetup.ROOT_CERTIFICATE_FILENAME)
+        self.ca_private_key_filename = join(files_prefix, CASetup.CA_PRIVATE_KEY_FILENAME)
+        self.ca_certificate_filename = join(files_prefix, CASetup.CA_CERTIFICATE_FILENAME)
+        self.si_private_key_filename = join(files_prefix, CASetup.SI_PRIVATE_KEY_FILENAME)
+        self.si_certificate_filename = join(files_prefix, CASetup.SI_CERTIFICATE_FILENAME)
+
+        # multiple workers may start at the same time, only one of them must generate the keys
+        if not self.__is_complete():
+            with FileLock(join(cert_path_prefix, CASetup.LOCK_FILENAME)):
+                if not self.__is_complete():
+                    self.init_config_token_demo()
+
+    def __is_complete(self) -> bool:
+        return (isfile(self.root_private_key_filename)
                 and isfile(self.root_certificate_filename)
                 and isfile(self.ca_private_key_filename)
                 and isfile(self.ca_certificate_filename)
                 and isfile(self.si_private_key_filename)
-                and isfile(self.si_certificate_filename)):
-            self.init_config_token_demo()
+                and isfile(self.si_certificate_filename))
+
+    @staticmethod
+    def generate_private_keys(*key_sizes: int) -> [RSAPrivateKey]:
+        """
+        RSA key generation holds the GIL, so keys are generated in worker processes (one per key) instead of threads.
+        On single core machines or if no worker processes can be spawned, keys are generated one after another.
+        """
+        log = logging.getLogger(__name__)
+        workers = min(len(key_sizes), cpu_count() or 1)
+        log.debug(f'Generating {len(key_sizes)} RSA-Keys using {workers} process(es)')
+
+        pems = None
+        if workers > 1:
+            try:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    pems = list(executor.map(generate_private_key_pem, key_sizes))
+            except Exception as e:
+                log.warning(f'Failed to generate RSA-Keys in parallel, falling back to serial generation: {e}')
+        if pems is None:
+            pems = list(map(generate_private_key_pem, key_sizes))
+
+        return [load_pem_private_key(pem, password=None) for pem in pems]
 
     def init_config_token_demo(self):
+        # create root, ca and si keypair at once, this is the expensive part of the setup
+        my_root_private_key, my_ca_private_key, my_si_private_key = CASetup.generate_private_keys(4096, 4096, 2048)
+
         """ Create Root Key and Certificate """
 
         # create root keypair
-        my_root_private_key = generate_private_key(public_exponent=65537, key_size=4096)
         my_root_public_key = my_root_private_key.public_key()
 
         # create root-certificate subject
@@ -107,16 +245,12 @@ class CASetup:
             encryption_algorithm=serialization.NoEncryption(),
         )
 
-        with open(self.root_private_key_filename, 'wb') as f:
-            f.write(my_root_private_key_as_pem)
-
-        with open(self.root_certificate_filename, 'wb') as f:
-            f.write(my_root_certificate.public_bytes(encoding=Encoding.PEM))
+        write_file_atomic(self.root_private_key_filename, my_root_private_key_as_pem)
+        write_file_atomic(self.root_certificate_filename, my_root_certificate.public_bytes(encoding=Encoding.PEM))
 
         """ Create CA (Intermediate) Key and Certificate """
 
         # create ca keypair
-        my_ca_private_key = generate_private_key(public_exponent=65537, key_size=4096)
         my_ca_public_key = my_ca_private_key.public_key()
 
         # create ca-certificate subject
@@ -162,16 +296,12 @@ class CASetup:
             encryption_algorithm=serialization.NoEncryption(),
         )
 
-        with open(self.ca_private_key_filename, 'wb') as f:
-            f.write(my_ca_private_key_as_pem)
-
-        with open(self.ca_certificate_filename, 'wb') as f:
-            f.write(my_ca_certificate.public_bytes(encoding=Encoding.PEM))
+        write_file_atomic(self.ca_private_key_filename, my_ca_private_key_as_pem)
+        write_file_atomic(self.ca_certificate_filename, my_ca_certificate.public_bytes(encoding=Encoding.PEM))
 
         """ Create Service-Instance Key and Certificate """
 
         # create si keypair
-        my_si_private_key = generate_private_key(public_exponent=65537, key_size=2048)
         my_si_public_key = my_si_private_key.public_key()
 
         my_si_private_key_as_pem = my_si_private_key.private_bytes(
@@ -184,8 +314,7 @@ class CASetup:
             format=serialization.PublicFormat.SubjectPublicKeyInfo,
         )
 
-        with open(self.si_private_key_filename, 'wb') as f:
-            f.write(my_si_private_key_as_pem)
+        write_file_atomic(self.si_private_key_filename, my_si_private_key_as_pem)
 
         # with open(self.si_public_key_filename, 'wb') as f:
         #    f.write(my_si_public_key_as_pem)
@@ -223,8 +352,7 @@ class CASetup:
             ]), critical=False)
             .sign(my_ca_private_key, hashes.SHA256()))
 
-        with open(self.si_certificate_filename, 'wb') as f:
-            f.write(my_si_certificate.public_bytes(encoding=Encoding.PEM))
+        write_file_atomic(self.si_certificate_filename, my_si_certificate.public_bytes(encoding=Encoding.PEM))
 
 
 class PrivateKey:
@@ -347,49 +475,162 @@ class Cert:
         return self.__cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value.key_identifier
 
 
+class KeyContext:
+    """
+    Certificates and signing keys (and derived "jose" keys) of the service instance, loaded from the files of "CASetup"
+    and validated as a whole. On reload a new context is created and swapped in, so a request which took a reference to
+    the current context uses consistent keys until it is finished.
+    """
+
+    def __init__(self, root_certificate: Cert, ca_certificate: Cert, si_certificate: Cert, si_private_key: PrivateKey):
+        self.root_certificate, self.ca_certificate = root_certificate, ca_certificate
+        self.si_certificate, self.si_private_key = si_certificate, si_private_key
+        self.si_public_key = si_private_key.public_key()
+        self.jwt_encode_key = jwk.construct(si_private_key.pem(), algorithm=ALGORITHMS.RS256)
+        self.jwt_decode_key = jwk.construct(self.si_public_key.pem(), algorithm=ALGORITHMS.RS256)
+        self.fingerprint = sha256(si_certificate.pem() + ca_certificate.pem() + root_certificate.pem()).hexdigest()[:16]
+        self.loaded = datetime.now(UTC)
+
+    def __repr__(self):
+        return f'KeyContext(fingerprint={self.fingerprint}, loaded={self.loaded.isoformat()})'
+
+    @staticmethod
+    def filenames(ca_setup: CASetup) -> [str]:
+        return [ca_setup.root_certificate_filename, ca_setup.ca_certificate_filename, ca_setup.si_certificate_filename, ca_setup.si_private_key_filename]
+
+    @staticmethod
+    def load(ca_setup: CASetup) -> "KeyContext":
+        """ raises "ValueError" if files do not form a valid chain (e.g. while they are replaced one by one) """
+        context = KeyContext(
+            root_certificate=Cert.from_file(ca_setup.root_certificate_filename),
+            ca_certificate=Cert.from_file(ca_setup.ca_certificate_filename),
+            si_certificate=Cert.from_file(ca_setup.si_certificate_filename),
+            si_private_key=PrivateKey.from_file(ca_setup.si_private_key_filename),
+        )
+        context.validate()
+        return context
+
+    def validate(self):
+        try:
+            self.ca_certificate.raw().verify_directly_issued_by(self.root_certificate.raw())
+            self.si_certificate.raw().verify_directly_issued_by(self.ca_certificate.raw())
+        except Exception as e:
+            raise ValueError(f'invalid certificate chain: {e}')
+        if self.si_certificate.public_key().mod() != self.si_public_key.mod():
+            raise ValueError('service instance certificate does not match private key')
+
+    def warm_up(self):
+        """ primes RSA blinding and "jose" key objects, so the first request signed with this context is not slower """
+        self.si_private_key.generate_signature(b'warm-up')
+        token = jws.sign({'warm-up': True}, key=self.jwt_encode_key, algorithm=ALGORITHMS.RS256)
+        jws.verify(token, key=self.jwt_decode_key, algorithms=ALGORITHMS.RS256)
+
+
+class KeyWatcher:
+    """
+    Polls modification times of key and certificate files and calls "on_change" when they changed. Polling works on
+    every platform and on network shares (e.g. "CERT_PATH" shared in cluster mode), where file system events do not.
+    """
+
+    def __init__(self, filenames: [str], interval: float, on_change: Callable[[], Awaitable]):
+        self.filenames, self.interval, self.on_change = filenames, interval, on_change
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.__mtimes = self.mtimes()
+        self.__task: asyncio.Task | None = None
+
+    def mtimes(self) -> tuple:
+        return tuple(getmtime(_) if isfile(_) else None for _ in self.filenames)
+
+    def start(self):
+        self.__task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            mtimes = self.mtimes()
+            if mtimes == self.__mtimes:
+                continue
+            try:
+                await self.on_change()
+                self.__mtimes = mtimes
+            except Exception as e:  # e.g. only some files are replaced yet, retried on next poll
+                self.log.warning(f'Failed to reload keys, keeping current ones: {e}')
+
+
 class DriverMatrix:
     __DRIVER_MATRIX_FILENAME = 'static/driver_matrix.json'
-    __DRIVER_MATRIX: None | dict = None  # https://docs.nvidia.com/grid/ => "Driver Versions"
+    __DRIVER_MATRIX: None | dict = None  # https://docs.nvidia.com/grid/ => "Driver Versions", indexed by driver version
 
-    def __init__(self):
+    FORMAT = 2  # {"$format": 2, "releases": [release], "versions": {driver version: index of release}}
+
+    def __init__(self, filename: str = None):
         self.log = logging.getLogger(self.__class__.__name__)
 
-        if DriverMatrix.__DRIVER_MATRIX is None:
-            self.__load()
+        if DriverMatrix.__DRIVER_MATRIX is None or filename is not None:
+            self.__load(filename or DriverMatrix.__DRIVER_MATRIX_FILENAME)
 
-    def __load(self):
+    def __load(self, filename: str):
         try:
-            with open(DriverMatrix.__DRIVER_MATRIX_FILENAME, 'r') as f:
-                DriverMatrix.__DRIVER_MATRIX = json_loads(f.read())
-            self.log.debug(f'Successfully loaded "{DriverMatrix.__DRIVER_MATRIX_FILENAME}".')
+            with open(filename, 'r') as f:
+                DriverMatrix.__DRIVER_MATRIX = DriverMatrix.index(json_loads(f.read()))
+            self.log.debug(f'Successfully loaded "{filename}".')
         except Exception as e:
             DriverMatrix.__DRIVER_MATRIX = {}  # init empty dict to not try open file everytime, just when restarting app
             # self.log.warning(f'Failed to load "{NV.__DRIVER_MATRIX_FILENAME}": {e}')
 
+    @staticmethod
+    def index(matrix: dict) -> dict[str, dict]:
+        """
+        Driver version (linux and windows) => release, as returned by "find". Files in the compact format (see
+        "test/create_driver_matrix_json.py") are already indexed, the nested format (branches with their "$releases" as
+        parsed from the docs) is indexed once on load.
+        """
+        if matrix.get('$format') == DriverMatrix.FORMAT:
+            releases = matrix.get('releases')
+            return {driver: releases[idx] for driver, idx in matrix.get('versions').items()}
+
+        def version(_: str | None) -> tuple:
+            return tuple(int(_) for _ in re.findall(r'\d+', _ or ''))
+
+        versions = {}
+        for key, branch in matrix.items():
+            releases = branch.get('$releases')
+            latest = branch.get('Latest Release in Branch')
+            if latest is None:  # not part of the docs tables, newest release of branch
+                latest = max((_.get('vGPU Software') for _ in releases), key=version, default=None)
+            for release in releases:
+                status = branch.get('vGPU Branch Status', release.get('vGPU Branch Status'))
+                drivers = list(filter(None, [release.get('Linux Driver'), release.get('Windows Driver')]))
+                major = drivers[0].split('.')[0] if len(drivers) > 0 else ''
+                is_latest = release.get('vGPU Software') == latest
+                x = {
+                    'software_branch': branch.get('vGPU Software Branch', key),
+                    'branch_version': release.get('vGPU Software'),
+                    'driver_branch': branch.get('Driver Branch', release.get('Driver Branch', f'R{major}' if major.isdigit() else None)),
+                    'branch_status': status,
+                    'release_date': release.get('Release Date'),
+                    # e.g. "Production Branch, supported until July 2025" or "EOL since March 2024"
+                    'eol': branch.get('EOL Date', next(iter(re.findall(r'(?:until|since|from) (.+)$', status or '')), None)) if is_latest else None,
+                    'is_latest': is_latest,
+                }
+                for driver in drivers:
+                    versions.setdefault(driver, x)
+        return versions
+
     @staticmethod
     def find(version: str) -> dict | None:
         if DriverMatrix.__DRIVER_MATRIX is None:
             return None
-        for idx, (key, branch) in enumerate(DriverMatrix.__DRIVER_MATRIX.items()):
-            for release in branch.get('$releases'):
-                linux_driver = release.get('Linux Driver')
-                windows_driver = release.get('Windows Driver')
-                if version == linux_driver or version == windows_driver:
-                    tmp = branch.copy()
-                    tmp.pop('$releases')
-
-                    is_latest = release.get('vGPU Software') == branch.get('Latest Release in Branch')
-
-                    return {
-                        'software_branch': branch.get('vGPU Software Branch'),
-                        'branch_version': release.get('vGPU Software'),
-                        'driver_branch': branch.get('Driver Branch'),
-                        'branch_status': branch.get('vGPU Branch Status'),
-                        'release_date': release.get('Release Date'),
-                        'eol': branch.get('EOL Date') if is_latest else None,
-                        'is_latest': is_latest,
-                    }
-        return None
+        release = DriverMatrix.__DRIVER_MATRIX.get(version)
+        return None if release is None else dict(release)
 
 
 class ProductMapping:
@@ -421,3 +662,570 @@ class ProductMapping:
         features = list(filter(lambda _: _.get('product_fulfillment_xid') == product_fulfillment_xid, feature_list))
         features.sort(key=lambda _: _.get('evaluation_order_index'))
         return features[0]
+
+
+class OfflineLeasePolicy:
+    """
+    Decides which leases are issued as offline leases (long validity, rare renewals): leases of configured origins
+    ("origin_ref"), of origins with configured hostname prefixes, or of configured products.
+    """
+
+    def __init__(self, origin_refs: [str] = (), hostnames: [str] = (), product_names: [str] = ()):
+        self.origin_refs, self.hostnames, self.product_names = set(origin_refs), tuple(hostnames), set(product_names)
+
+    @staticmethod
+    def from_strings(origin_refs: str | None, hostnames: str | None, product_names: str | None) -> "OfflineLeasePolicy":
+        """ comma separated lists, e.g. from env """
+        def split(value: str | None) -> [str]:
+            return [_.strip() for _ in (value or '').split(',') if _.strip()]
+        return OfflineLeasePolicy(split(origin_refs), split(hostnames), split(product_names))
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.origin_refs) > 0 or len(self.hostnames) > 0 or len(self.product_names) > 0
+
+    def applies(self, origin_ref: str, hostname: str | None, product_name: str | None) -> bool:
+        return origin_ref in self.origin_refs \
+            or product_name in self.product_names \
+            or (hostname is not None and len(self.hostnames) > 0 and hostname.startswith(self.hostnames))
+
+    def serialize(self) -> dict:
+        return {'origin_refs': sorted(self.origin_refs), 'hostnames': list(self.hostnames), 'product_names': sorted(self.product_names)}
+
+
+class RateLimiter:
+    """
+    Token bucket per key (e.g. "origin_ref"): every key may do "burst" requests at once, then "rate" requests per second.
+    Memory is bounded, only the "max_keys" most recently used buckets are kept (a dropped bucket is full again).
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        if rate <= 0 or burst < 1:
+            raise ValueError(f'Invalid rate limit "{rate}/{burst}", rate has to be greater than 0 and burst at least 1')
+        self.rate, self.burst, self.max_keys = rate, burst, max_keys
+        self.__buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()  # key => (tokens, last update)
+        self.__lock = Lock()
+
+    def __repr__(self):
+        return f'RateLimiter(rate={self.rate}, burst={self.burst}, max_keys={self.max_keys})'
+
+    @staticmethod
+    def from_string(value: str | None, max_keys: int = 10000) -> "RateLimiter | None":
+        """ parses "<rate>/<burst>", e.g. "2/10" (2 requests per second, 10 at once). Returns "None" if not set. """
+        if value is None or len(value.strip()) == 0:
+            return None
+        rate, _, burst = value.partition('/')
+        return RateLimiter(rate=float(rate), burst=int(burst) if burst else max(1, int(float(rate))), max_keys=max_keys)
+
+    def acquire(self, key: str) -> float:
+        """ takes a token from bucket of "key", returns 0 on success, otherwise seconds until a token is available """
+        now = monotonic()
+        with self.__lock:
+            tokens, updated = self.__buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            retry_after = 0. if tokens >= 1 else (1 - tokens) / self.rate
+            self.__buckets[key] = (tokens - 1 if retry_after == 0 else tokens, now)
+            if len(self.__buckets) > self.max_keys:
+                self.__buckets.popitem(last=False)
+        return retry_after
+
+
+class RecentKeys:
+    """ bounded set of keys, only the "max_keys" most recently added are kept (e.g. origins known to this process) """
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self.__keys: OrderedDict[str, None] = OrderedDict()
+        self.__lock = Lock()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__keys
+
+    def __len__(self) -> int:
+        return len(self.__keys)
+
+    def add(self, key: str):
+        with self.__lock:
+            self.__keys[key] = None
+            self.__keys.move_to_end(key)
+            if len(self.__keys) > self.max_keys:
+                self.__keys.popitem(last=False)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the computation, all others wait for it and get
+    the same result (or exception). With "ttl", successful results are reused for that many seconds after completion.
+    Only use this for idempotent (read-mostly) computations. Must be used from a single event loop.
+    """
+
+    def __init__(self, max_results: int = 10000):
+        self.max_results = max_results
+        self.__flights: dict[Hashable, asyncio.Future] = {}
+        self.__results: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()  # key => (expires, result)
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable], ttl: float = 0) -> Any:
+        if (cached := self.__results.get(key)) is not None:
+            if cached[0] > monotonic():
+                self.coalesced += 1
+                return cached[1]
+            self.__results.pop(key, None)
+
+        if (flight := self.__flights.get(key)) is not None:
+            self.coalesced += 1
+            return await asyncio.shield(flight)
+
+        flight = asyncio.get_running_loop().create_future()
+        self.__flights[key] = flight
+        try:
+            result = await fn()
+        except Exception as e:
+            flight.set_exception(e)
+            flight.exception()  # mark as retrieved, if there is no other caller waiting
+            raise
+        except BaseException:
+            flight.cancel()
+            raise
+        finally:
+            self.__flights.pop(key, None)
+
+        flight.set_result(result)
+        if ttl > 0:
+            self.__results[key] = (monotonic() + ttl, result)
+            while len(self.__results) > self.max_results:
+                self.__results.popitem(last=False)
+        return result
+
+
+class EventSubscription:
+    """ events of "EventBroadcaster" for one subscriber, replayed events ("backlog") first """
+
+    def __init__(self, backlog: list[tuple[int, str, dict]], queue_size: int):
+        self.backlog = deque(backlog)
+        self.queue: asyncio.Queue[tuple[int, str, dict]] = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+
+    async def next(self, timeout: float) -> tuple[int, str, dict] | None:
+        """ next event as (id, event, data), "None" on timeout, raises "EOFError" if dropped (after remaining events) """
+        if len(self.backlog) > 0:
+            return self.backlog.popleft()
+        if self.dropped and self.queue.empty():
+            raise EOFError('subscriber was dropped')
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBroadcaster:
+    """
+    Publishes events to all subscribers, every subscriber has a bounded queue. A subscriber which does not keep up (its
+    queue is full) is dropped instead of blocking or buffering without limit, it has to resubscribe. The last "history"
+    events are kept, so subscribers can resume after the id of the last event they received.
+    Ids start at current time in milliseconds, so they continue to increase after a restart. Must be used from a single
+    event loop.
+    """
+
+    def __init__(self, history: int = 1000, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.__history: deque[tuple[int, str, dict]] = deque(maxlen=history)
+        self.__subscribers: set[EventSubscription] = set()
+        self.__id = int(time() * 1000)
+        self.dropped = 0
+
+    @property
+    def subscribers(self) -> int:
+        return len(self.__subscribers)
+
+    def publish(self, event: str, data: dict) -> int:
+        self.__id += 1
+        item = (self.__id, event, data)
+        self.__history.append(item)
+        for subscription in list(self.__subscribers):
+            try:
+                subscription.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                subscription.dropped = True
+                self.__subscribers.discard(subscription)
+                self.dropped += 1
+        return self.__id
+
+    def subscribe(self, last_event_id: int = None) -> EventSubscription:
+        """ with "last_event_id", all newer events which are still in history are replayed """
+        backlog = [_ for _ in self.__history if _[0] > last_event_id] if last_event_id is not None else []
+        subscription = EventSubscription(backlog, self.queue_size)
+        self.__subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription):
+        self.__subscribers.discard(subscription)
+
+    @staticmethod
+    def format(event_id: int, event: str, data: dict) -> str:
+        """ server-sent events format """
+        return f'id: {event_id}\nevent: {event}\ndata: {json_dumps(data, separators=(",", ":"))}\n\n'
+
+
+class Metrics:
+    """
+    Counters with labels, rendered in Prometheus text format. Thread-safe, counters are kept per process. Only use labels
+    with a small, fixed set of values (e.g. route or engine names, never ids).
+    """
+
+    def __init__(self):
+        self.__counters: dict[str, dict[tuple[tuple[str, str], ...], float]] = {}
+        self.__help: dict[str, str] = {}
+        self.__lock = Lock()
+
+    def describe(self, name: str, help: str):
+        self.__help[name] = help
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            series = self.__counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def get(self, name: str, **labels: str) -> float:
+        return self.__counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> str:
+        with self.__lock:
+            counters = {name: dict(series) for name, series in self.__counters.items()}
+
+        lines = []
+        for name in sorted(set(counters.keys()) | set(self.__help.keys())):
+            if name in self.__help:
+                lines.append(f'# HELP {name} {self.__help.get(name)}')
+            lines.append(f'# TYPE {name} counter')
+            for key, value in sorted(counters.get(name, {}).items()):
+                labels = ','.join(f'{k}="{v}"' for k, v in key)
+                lines.append(f'{name}{{{labels}}} {value:g}' if labels else f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+class BrotliResponder(IdentityResponder):
+    """ like "GZipResponder" (compresses single and streamed responses, e.g. "StreamingResponse") with brotli """
+    content_encoding = 'br'
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int = 4):
+        super().__init__(app, minimum_size)
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        return self.compressor.process(body) + (self.compressor.flush() if more_body else self.compressor.finish())
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses of paths starting with one of "prefixes" with the encoding negotiated by "Accept-Encoding"
+    (first of "encodings" with highest quality value), also streamed responses. Responses smaller than "minimum_size",
+    already encoded responses and server-sent events are sent as they are. "br" requires the optional "brotli" package.
+    """
+
+    GZIP_LEVEL, BROTLI_QUALITY = 6, 4  # fast levels, responses are compressed on every request
+
+    def __init__(self, app: ASGIApp, prefixes: [str], encodings: [str] = ('br', 'gzip'), minimum_size: int = 1024):
+        self.app, self.prefixes, self.minimum_size = app, tuple(prefixes), minimum_size
+        self.encodings = CompressionMiddleware.available(encodings)
+
+    @staticmethod
+    def available(encodings: [str]) -> [str]:
+        """ supported of given "encodings" (in same order), "br" only if "brotli" is installed """
+        return [_ for _ in encodings if _ == 'gzip' or (_ == 'br' and brotli is not None)]
+
+    @staticmethod
+    def negotiate(accept_encoding: str, encodings: [str]) -> str | None:
+        """ returns the first of "encodings" with the highest quality in "Accept-Encoding", "None" if none is accepted """
+        accepted = {}
+        for part in accept_encoding.lower().split(','):
+            name, _, params = part.partition(';')
+            try:
+                accepted[name.strip()] = float(params.strip()[2:]) if params.strip().startswith('q=') else 1.
+            except ValueError:
+                accepted[name.strip()] = 0.
+        candidates = [(accepted.get(encoding, accepted.get('*', 0.)), -idx, encoding) for idx, encoding in enumerate(encodings)]
+        quality, _, encoding = max(candidates, default=(0., 0, None))
+        return encoding if quality > 0 else None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self.negotiate(Headers(scope=scope).get('accept-encoding', ''), self.encodings)
+        if encoding == 'br':
+            responder = BrotliResponder(self.app, self.minimum_size, quality=CompressionMiddleware.BROTLI_QUALITY)
+        elif encoding == 'gzip':
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=CompressionMiddleware.GZIP_LEVEL)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)  # adds "Vary: Accept-Encoding"
+        await responder(scope, receive, send)
+
+
+class JsonFormatter(logging.Formatter):
+    """ formats records as one json object per line, "extra" attributes "route" and "origin_ref" are added as fields """
+
+    FIELDS = ('route', 'origin_ref')
+
+    def format(self, record: logging.LogRecord) -> str:
+        x = {
+            'time': datetime.fromtimestamp(record.created, tz=UTC).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        x.update({_: getattr(record, _) for _ in JsonFormatter.FIELDS if hasattr(record, _)})
+        if record.exc_info:
+            x['exception'] = self.formatException(record.exc_info)
+        return json_dumps(x, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of records per "route" ("extra" attribute), e.g. {'leases': 0.1} keeps every 10th record.
+    Records without route and warnings (or higher) are always kept.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    @staticmethod
+    def parse(value: str | None) -> dict[str, float]:
+        """ parses "<route>=<rate>,...", e.g. "leases=0.1,renew=0.5" """
+        rates = {}
+        for item in filter(None, map(str.strip, (value or '').split(','))):
+            route, _, rate = item.partition('=')
+            rates[route.strip()] = float(rate)
+        return rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, 'route', None), 1)
+        return rate >= 1 or record.levelno >= logging.WARNING or random() < rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to a bounded queue (consumed by a "QueueListener" in another thread) and drops them if the queue is
+    full, so logging never blocks request handling. Records are not formatted here, but in the listener thread.
+    """
+
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # in-process queue, no need to format (and pickle) the record before handing it over
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def setup_logging(json: bool = False, queue_size: int = 10000, sampling: dict[str, float] = None) -> (QueueListener, DroppingQueueHandler):
+    """
+    Replaces root handlers with a bounded queue, records are formatted and written to stderr by a background thread.
+    The returned listener has to be stopped on exit to flush remaining records.
+    """
+    handler = logging.StreamHandler()
+    if json:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('[{levelname:^7}] [{module:^15}] {message}', style='{'))
+
+    queue_handler = DroppingQueueHandler(Queue(maxsize=queue_size))
+    queue_handler.addFilter(SamplingFilter(sampling or {}))
+
+    root = logging.getLogger()
+    for _ in list(root.handlers):
+        root.removeHandler(_)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener, queue_handler
+
+
+class Trace:
+    """
+    Spans of one request, "spans" are (id, parent, name, start, duration) in milliseconds since "begin". Spans are added
+    when they end (from any thread the request context was copied to, e.g. "run_in_threadpool").
+    """
+
+    __slots__ = ('trace_id', 'name', 'attributes', 'started', 'begin', 'duration', 'spans', 'ids')
+
+    def __init__(self, name: str, attributes: dict):
+        self.trace_id, self.name, self.attributes = uuid4().hex, name, attributes
+        self.started, self.begin, self.duration = time(), perf_counter(), None
+        self.spans: list[tuple[int, int | None, str, float, float]] = []
+        self.ids = count(1)  # "next" is atomic, spans of concurrent threads get unique ids
+
+    def serialize(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started': datetime.fromtimestamp(self.started, tz=UTC).isoformat(),
+            'duration_ms': round(self.duration, 3) if self.duration is not None else None,
+            'attributes': self.attributes,
+            'spans': [
+                {'id': _id, 'parent': parent, 'name': name, 'start_ms': round(start, 3), 'duration_ms': round(duration, 3)}
+                for _id, parent, name, start, duration in sorted(self.spans, key=lambda _: _[3])
+            ],
+        }
+
+
+CURRENT_TRACE: ContextVar[tuple[Trace, int | None] | None] = ContextVar('trace', default=None)  # (trace, parent span)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """ measures the enclosed block as span of the current trace, does nothing (but a lookup) if there is none """
+    current = CURRENT_TRACE.get()
+    if current is None:
+        yield
+        return
+
+    trace, parent = current
+    _id, begin = next(trace.ids), perf_counter()
+    token = CURRENT_TRACE.set((trace, _id))
+    try:
+        yield
+    finally:
+        CURRENT_TRACE.reset(token)
+        end = perf_counter()
+        trace.spans.append((_id, parent, name, (begin - trace.begin) * 1000, (end - begin) * 1000))
+
+
+class RingBufferExporter:
+    """ keeps the last "size" exported traces in memory (per process) """
+
+    def __init__(self, size: int = 100):
+        self.traces: deque[dict] = deque(maxlen=size)
+
+    def __repr__(self):
+        return f'RingBufferExporter(size={self.traces.maxlen})'
+
+    def export(self, trace: dict):
+        self.traces.append(trace)
+
+    def close(self):
+        pass
+
+
+class JsonLinesExporter:
+    """
+    Appends exported traces as one json object per line to "filename", written by a background thread. Like
+    "DroppingQueueHandler" traces are dropped if the bounded queue is full, so exporting never blocks requests.
+    """
+
+    def __init__(self, filename: str, queue_size: int = 1000):
+        self.filename, self.dropped = filename, 0
+        self.__queue: Queue[dict | None] = Queue(maxsize=queue_size)
+        self.__thread = Thread(target=self.__run, name='trace-exporter', daemon=True)
+        self.__thread.start()
+
+    def __repr__(self):
+        return f'JsonLinesExporter(filename={self.filename})'
+
+    def __run(self):
+        with open(self.filename, 'a', encoding='utf-8') as file:
+            while (trace := self.__queue.get()) is not None:
+                file.write(f'{json_dumps(trace, default=str)}\n')
+                if self.__queue.empty():
+                    file.flush()
+
+    def export(self, trace: dict):
+        try:
+            self.__queue.put_nowait(trace)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        """ writes remaining traces and stops the background thread """
+        self.__queue.put(None)
+        self.__thread.join(timeout=5)
+
+
+class Tracer:
+    """
+    Records a trace with spans (see "span") per request. A trace is exported if it is sampled (fraction "sampling") or
+    slower than "slow" milliseconds, slow traces are also kept (the last "history") for "/-/debug/traces".
+    Spans are only recorded if one of both is enabled, otherwise "trace" and "span" do nothing. Per process.
+    """
+
+    def __init__(self, sampling: float = 0, slow: float = 0, exporter: RingBufferExporter | JsonLinesExporter | None = None, history: int = 100):
+        self.sampling, self.slow, self.exporter = sampling, slow, exporter
+        self.slow_traces: deque[dict] = deque(maxlen=history)
+        self.traced, self.exported = 0, 0
+
+    def __repr__(self):
+        return f'Tracer(sampling={self.sampling}, slow={self.slow}, exporter={self.exporter})'
+
+    @property
+    def enabled(self) -> bool:
+        return self.sampling > 0 or self.slow > 0
+
+    @contextmanager
+    def trace(self, name: str, **attributes) -> Iterator[Trace | None]:
+        """ root of all spans within the enclosed block (also in threads the context is copied to) """
+        if not self.enabled:
+            yield None
+            return
+
+        trace = Trace(name, attributes)
+        token = CURRENT_TRACE.set((trace, None))
+        try:
+            yield trace
+        finally:
+            CURRENT_TRACE.reset(token)
+            trace.duration = (perf_counter() - trace.begin) * 1000
+            self.finish(trace)
+
+    def finish(self, trace: Trace):
+        self.traced += 1
+        slow = 0 < self.slow <= trace.duration
+        if not slow and random() >= self.sampling:
+            return
+
+        x = trace.serialize()
+        x['slow'] = slow
+        if slow:
+            self.slow_traces.append(x)
+        if self.exporter is not None:
+            self.exporter.export(x)
+            self.exported += 1
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
+
+
+class TracingMiddleware:
+    """
+    Traces requests of paths starting with one of "prefixes", named by their endpoint (e.g. "leasing_v1_lessor"), with
+    method, path and status code as attributes.
+    """
+
+    def __init__(self, app: ASGIApp, tracer: Tracer, prefixes: [str]):
+        self.app, self.tracer, self.prefixes = app, tracer, tuple(prefixes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or not self.tracer.enabled or not scope['path'].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        with self.tracer.trace(f'{scope["method"]} {scope["path"]}', method=scope['method'], path=scope['path']) as trace:
+            async def send_wrapper(message: dict):
+                if message['type'] == 'http.response.start':
+                    trace.attributes['status_code'] = message['status']
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                if (endpoint := scope.get('endpoint')) is not None:  # set by router, path could contain refs
+                    trace.name = endpoint.__name__
@@ -0,0 +1,81 @@
+"""
+Compares the lease store backends on the operations used by the leasing endpoints.
+
+Usage: python benchmark_lease_store.py [origins]
+"""
+import logging
+import sys
+from datetime import datetime, UTC
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uuid import uuid4
+
+from dateutil.relativedelta import relativedelta
+
+# add relative path to use packages as they were in the app/ dir
+sys.path.append('../')
+sys.path.append('../app')
+
+from orm import Origin, Lease, MemoryStore, create_tuned_engine, init, migrate
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def __benchmark(engine, origins: int) -> dict:
+    cur_time = datetime.now(UTC)
+    origin_refs, lease_refs = [str(uuid4()) for _ in range(origins)], [str(uuid4()) for _ in range(origins)]
+    timings = {}
+
+    begin = perf_counter()
+    for origin_ref in origin_refs:
+        Origin.create_or_update(engine, Origin(origin_ref=origin_ref, hostname='benchmark', guest_driver_version='550.54.14'))
+    timings['origin'] = perf_counter() - begin
+
+    begin = perf_counter()
+    for origin_ref, lease_ref in zip(origin_refs, lease_refs):
+        lease = Lease(origin_ref=origin_ref, lease_ref=lease_ref, lease_created=cur_time, lease_expires=cur_time + relativedelta(days=90))
+        Lease.create_or_update(engine, lease)
+    timings['create'] = perf_counter() - begin
+
+    begin = perf_counter()
+    for origin_ref in origin_refs:
+        Lease.find_by_origin_ref(engine, origin_ref)
+    timings['leases'] = perf_counter() - begin
+
+    begin = perf_counter()
+    for origin_ref, lease_ref in zip(origin_refs, lease_refs):
+        lease = Lease.find_by_origin_ref_and_lease_ref(engine, origin_ref, lease_ref)
+        Lease.renew(engine, lease, cur_time + relativedelta(days=91), cur_time)
+    timings['renew'] = perf_counter() - begin
+
+    begin = perf_counter()
+    for origin_ref in origin_refs:
+        Lease.cleanup(engine, origin_ref)
+    timings['release'] = perf_counter() - begin
+
+    return timings
+
+
+if __name__ == '__main__':
+    origins = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    results = {}
+    with TemporaryDirectory() as path:
+        for name, profile in [('sqlite', 'none'), ('sqlite (balanced)', 'balanced')]:
+            engine, _ = create_tuned_engine(f'sqlite:///{join(path, f"{profile}.sqlite")}', profile=profile)
+            init(engine), migrate(engine)
+            results[name] = __benchmark(engine, origins)
+            engine.dispose()
+
+        store = MemoryStore.from_url(f'memory://{join(path, "memory")}')
+        results['memory'] = __benchmark(store, origins)
+        store.close()
+
+    operations = list(next(iter(results.values())).keys())
+    print(f'{origins} origins, microseconds per operation')
+    print(f'{"backend":<20}' + ''.join(f'{_:>10}' for _ in operations))
+    for name, timings in results.items():
+        print(f'{name:<20}' + ''.join(f'{timings.get(_) / origins * 1e6:>10.0f}' for _ in operations))
@@ -0,0 +1,95 @@
+"""
+Compares loading leases for listings as mapped "Lease" instances and as plain "LeaseRow" tuples (column-only query).
+
+Usage: python benchmark_listing.py [leases]
+"""
+import gc
+import logging
+import sys
+import tracemalloc
+from datetime import datetime, timedelta, UTC
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uuid import uuid4
+
+from dateutil.relativedelta import relativedelta
+from sqlalchemy.orm import sessionmaker
+
+# add relative path to use packages as they were in the app/ dir
+sys.path.append('../')
+sys.path.append('../app')
+
+from orm import Origin, Lease, create_tuned_engine, init, migrate
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BATCH = 10000
+RENEWAL = dict(renewal_period=0.15, renewal_delta=timedelta(days=90), renewal_jitter=0.1)
+
+
+def __populate(engine, leases: int):
+    cur_time = datetime.now(UTC)
+    origin_refs = [str(uuid4()) for _ in range(max(leases // 10, 1))]  # 10 leases per origin
+    session = sessionmaker(bind=engine)()
+    session.add_all([Origin(origin_ref=_) for _ in origin_refs])
+    session.commit()
+    session.close()
+    for offset in range(0, leases, BATCH):
+        Lease.create_many(engine, [Lease(
+            origin_ref=origin_refs[idx % len(origin_refs)], lease_ref=str(uuid4()), lease_created=cur_time,
+            lease_expires=cur_time + relativedelta(days=90), product_name='NVIDIA Virtual Applications', driver_branch='R550',
+        ) for idx in range(offset, min(offset + BATCH, leases))])
+
+
+def __entities(engine) -> list:
+    session = sessionmaker(bind=engine)()
+    entities = session.query(Lease).all()
+    session.close()
+    return entities
+
+
+def __benchmark(load, engine) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    begin = perf_counter()
+    items = load(engine)
+    loaded = perf_counter() - begin
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    begin = perf_counter()
+    for item in items:
+        item.serialize(**RENEWAL)
+    serialized = perf_counter() - begin
+
+    # tracing slows down allocations, so load time is measured again without it
+    del items
+    gc.collect()
+    begin = perf_counter()
+    items = load(engine)
+    loaded = min(loaded, perf_counter() - begin)
+    return dict(rows=len(items), load=loaded, serialize=serialized, memory=memory)
+
+
+if __name__ == '__main__':
+    leases = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    results = {}
+    with TemporaryDirectory() as path:
+        engine, _ = create_tuned_engine(f'sqlite:///{join(path, "listing.sqlite")}', profile='balanced')
+        init(engine), migrate(engine)
+        begin = perf_counter()
+        __populate(engine, leases)
+        logger.info(f'created {leases} leases in {perf_counter() - begin:.1f}s')
+
+        results['Lease (orm)'] = __benchmark(__entities, engine)
+        results['LeaseRow'] = __benchmark(Lease.find_all, engine)
+        engine.dispose()
+
+    print(f'{leases} leases, per row')
+    print(f'{"type":<20}{"load (us)":>12}{"serialize (us)":>16}{"memory (bytes)":>16}')
+    for name, x in results.items():
+        print(f'{name:<20}{x["load"] / x["rows"] * 1e6:>12.2f}{x["serialize"] / x["rows"] * 1e6:>16.2f}{x["memory"] / x["rows"]:>16.0f}')
@@ -1,4 +1,26 @@
+"""
+Builds "app/static/driver_matrix.json" from the "Driver Versions" of the NVIDIA vGPU docs.
+
+The docs page is fetched conditionally (ETag / Last-Modified of the previous download are kept in "--cache"), a saved
+page can be used with "--html" (no network). The matrix is only rebuilt if the page changed since the last build, it is
+written pre-indexed by driver version (see "DriverMatrix.index"), so the app loads it without scanning.
+
+Usage: python create_driver_matrix_json.py [--html saved.html] [--cache dir] [--output file] [--force]
+"""
 import logging
+import sys
+from argparse import ArgumentParser
+from hashlib import sha256
+from html.parser import HTMLParser
+from json import loads as json_loads, dumps as json_dumps
+from os import makedirs
+from os.path import join, isfile
+
+# add relative path to use packages as they were in the app/ dir
+sys.path.append('../')
+sys.path.append('../app')
+
+from util import DriverMatrix
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -12,66 +34,153 @@ LINUX_VGPU_MANAGER_KEY, LINUX_DRIVER_KEY = 'Linux vGPU Manager', 'Linux Driver'
 WINDOWS_VGPU_MANAGER_KEY, WINDOWS_DRIVER_KEY = 'Windows vGPU Manager', 'Windows Driver'
 ALT_VGPU_MANAGER_KEY = 'vGPU Manager'
 RELEASE_DATE_KEY, LATEST_KEY, EOL_KEY = 'Release Date', 'Latest Release in Branch', 'EOL Date'
+SOFTWARE_BRANCH_KEY = 'vGPU Software Branch'
 JSON_RELEASES_KEY = '$releases'
 
 
-def __driver_versions(html: 'BeautifulSoup'):
+class DriverVersionsParser(HTMLParser):
+    """
+    Collects the branches of "div#driver-versions" (accordion items with title, branch status and first table of
+    releases), only needs the standard library.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.branches = []  # [{title, status, headers, rows}]
+        self.__depth = 0  # div depth within "div#driver-versions", 0 is outside
+        self.__branch, self.__tables, self.__row = None, 0, None
+        self.__title, self.__title_depth, self.__link, self.__cell = None, None, None, None  # text buffers
+        self.__status = False  # next text is the branch status
+
+    def handle_starttag(self, tag: str, attrs: list):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag == 'div' and (self.__depth > 0 or attrs.get('id') == 'driver-versions'):
+            self.__depth += 1
+        if self.__depth == 0:
+            return
+        self.__status = False
+        if tag == 'bsp-accordion' and 'Accordion-items-item' in classes:
+            self.__branch, self.__tables = dict(title='', status='', headers=[], rows=[]), 0
+            self.branches.append(self.__branch)
+        elif self.__branch is None:
+            return
+        elif tag == 'div' and 'Accordion-items-item-title' in classes:
+            self.__title, self.__title_depth = [], self.__depth
+        elif tag == 'a' and 'href' in attrs:
+            self.__link = []
+        elif tag == 'table':
+            self.__tables += 1
+        elif tag == 'tr' and self.__tables == 1:
+            self.__row = []
+        elif tag in ('th', 'td') and self.__tables == 1:
+            self.__cell = []
+
+    def handle_endtag(self, tag: str):
+        if self.__depth == 0:
+            return
+        if tag == 'div':
+            if self.__depth == self.__title_depth:
+                self.__branch['title'], self.__title, self.__title_depth = ''.join(self.__title).strip(), None, None
+            self.__depth -= 1
+        elif tag == 'a' and self.__link is not None:
+            self.__status, self.__link = ''.join(self.__link).strip() == 'Branch status', None
+        elif tag == 'th' and self.__cell is not None:
+            self.__branch['headers'].append(''.join(self.__cell).strip())
+            self.__cell = None
+        elif tag == 'td' and self.__cell is not None:
+            if self.__row is not None:
+                self.__row.append(''.join(self.__cell))
+            self.__cell = None
+        elif tag == 'tr' and self.__row is not None:
+            if len(self.__row) > 0:  # skip rows without cells (table head)
+                self.__branch['rows'].append(self.__row)
+            self.__row = None
+
+    def handle_data(self, data: str):
+        if self.__status:  # text right after the "Branch status" link
+            self.__branch['status'], self.__status = data.replace(':', '').strip(), False
+        for _ in filter(lambda _: _ is not None, (self.__title, self.__link, self.__cell)):
+            _.append(data)
+
+
+def parse(html: str) -> dict:
+    """ nested matrix, branches (by lowercase title) with their "$releases" as rows of the docs tables """
     def __strip(_: str) -> str:
         # removes content after linebreak (e.g. "Hello\n World" to "Hello")
-        _ = _.strip()
-        tmp = _.split('\n')
-        if len(tmp) > 0:
-            return tmp[0]
-        return _
-
-    # find wrapper for "DriverVersions" and find tables
-    data = html.find('div', {'id': 'driver-versions'})
-    items = data.find_all('bsp-accordion', {'class': 'Accordion-items-item'})
-    for item in items:
-        software_branch = item.find('div', {'class': 'Accordion-items-item-title'}).text.strip()
-        software_branch = software_branch.replace(' Releases', '')
-        matrix_key = software_branch.lower()
-
-        branch_status = item.find('a', href=True, string='Branch status')
-        branch_status = branch_status.next_sibling.replace(':', '').strip()
-
-        # driver version info from table-heads (ths) and table-rows (trs)
-        table = item.find('table')
-        ths, trs = table.find_all('th'), table.find_all('tr')
-        headers, releases = [header.text.strip() for header in ths], []
-        for trs in trs:
-            tds = trs.find_all('td')
-            if len(tds) == 0:  # skip empty
-                continue
+        return _.strip().split('\n')[0]
+
+    parser = DriverVersionsParser()
+    parser.feed(html)
+    parser.close()
+
+    matrix = {}
+    for branch in parser.branches:
+        software_branch = branch.get('title').replace(' Releases', '')
+        releases = []
+        for row in branch.get('rows'):
             # create dict with table-heads as key and cell content as value
-            x = {headers[i]: __strip(cell.text) for i, cell in enumerate(tds)}
-            x.setdefault(BRANCH_STATUS_KEY, branch_status)
+            x = {branch.get('headers')[i]: __strip(cell) for i, cell in enumerate(row)}
+            x.setdefault(BRANCH_STATUS_KEY, branch.get('status'))
             releases.append(x)
+        matrix[software_branch.lower()] = {SOFTWARE_BRANCH_KEY: software_branch, JSON_RELEASES_KEY: releases}
+    return matrix
+
+
+def build(html: str) -> dict:
+    """
+    Compact format loaded by "DriverMatrix", every release once (linux and windows driver refer to the same) and
+    "$source" is the hash of the parsed page.
+    """
+    releases, versions = [], {}
+    for driver, release in DriverMatrix.index(parse(html)).items():
+        if len(releases) == 0 or releases[-1] is not release:  # drivers of a release are indexed one after another
+            releases.append(release)
+        versions[driver] = len(releases) - 1
+
+    return {
+        '$format': DriverMatrix.FORMAT,
+        '$source': sha256(html.encode('utf-8')).hexdigest(),
+        'releases': releases,
+        'versions': versions,
+    }
+
+
+def fetch(url: str, cache: str) -> str:
+    """ downloads "url" unless not modified since the previous download (kept in "cache") """
+    import httpx
+
+    filename, meta_filename = join(cache, 'driver_versions.html'), join(cache, 'driver_versions.json')
+    meta = json_loads(open(meta_filename).read()) if isfile(meta_filename) and isfile(filename) else {}
+    headers = {k: v for k, v in [('If-None-Match', meta.get('etag')), ('If-Modified-Since', meta.get('last_modified'))] if v}
+
+    r = httpx.get(url, headers=headers)
+    if r.status_code == 304:
+        logger.info(f'"{url}" not modified since {meta.get("last_modified") or meta.get("etag")}, using cached page.')
+        return open(filename, encoding='utf-8').read()
+    if r.status_code != 200:
+        raise RuntimeError(f'Error loading "{url}" with status code {r.status_code}.')
 
-        # add to matrix
-        MATRIX.update({matrix_key: {JSON_RELEASES_KEY: releases}})
+    makedirs(cache, exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(r.text)
+    with open(meta_filename, 'w') as f:
+        f.write(json_dumps({'etag': r.headers.get('etag'), 'last_modified': r.headers.get('last-modified')}))
+    return r.text
 
 
-def __debug():
+def __debug(versions: dict):
     # print table head
-    s = f'{VGPU_KEY:^13} | {LINUX_VGPU_MANAGER_KEY:^21} | {LINUX_DRIVER_KEY:^21} | {WINDOWS_VGPU_MANAGER_KEY:^21} | {WINDOWS_DRIVER_KEY:^21} | {RELEASE_DATE_KEY:>21} | {BRANCH_STATUS_KEY:^21}'
+    s = f'{VGPU_KEY:^13} | {DRIVER_BRANCH_KEY:^13} | {"Driver":^21} | {RELEASE_DATE_KEY:>21} | {BRANCH_STATUS_KEY:^21}'
     print(s)
 
-    # iterate over dict & format some variables to not overload table
-    for idx, (key, branch) in enumerate(MATRIX.items()):
-        for release in branch.get(JSON_RELEASES_KEY):
-            version = release.get(VGPU_KEY, release.get(GRID_KEY, ''))
-            linux_manager = release.get(LINUX_VGPU_MANAGER_KEY, release.get(ALT_VGPU_MANAGER_KEY, ''))
-            linux_driver = release.get(LINUX_DRIVER_KEY)
-            windows_manager = release.get(WINDOWS_VGPU_MANAGER_KEY, release.get(ALT_VGPU_MANAGER_KEY, ''))
-            windows_driver = release.get(WINDOWS_DRIVER_KEY)
-            release_date = release.get(RELEASE_DATE_KEY)
-            is_latest = release.get(VGPU_KEY) == branch.get(LATEST_KEY)
-            branch_status = __parse_branch_status(release.get(BRANCH_STATUS_KEY, ''))
-
-            version = f'{version} *' if is_latest else version
-            s = f'{version:<13} | {linux_manager:<21} | {linux_driver:<21} | {windows_manager:<21} | {windows_driver:<21} | {release_date:>21} | {branch_status:^21}'
-            print(s)
+    # iterate over releases & format some variables to not overload table
+    for driver, release in versions.items():
+        version = release.get('branch_version') or ''
+        version = f'{version} *' if release.get('is_latest') else version
+        branch_status = __parse_branch_status(release.get('branch_status') or '')
+        s = f'{version:<13} | {release.get("driver_branch") or "":<13} | {driver:<21} | {release.get("release_date") or "":>21} | {branch_status:^21}'
+        print(s)
 
 
 def __parse_branch_status(string: str) -> str:
@@ -86,38 +195,40 @@ def __parse_branch_status(string: str) -> str:
     return string
 
 
-def __dump(filename: str):
-    import json
-
-    file = open(filename, 'w')
-    json.dump(MATRIX, file)
-    file.close()
-
-
 if __name__ == '__main__':
-    MATRIX = {}
+    args = ArgumentParser(description='Builds the driver matrix from the NVIDIA vGPU docs.')
+    args.add_argument('--html', help='saved docs page to build from (offline), instead of downloading it')
+    args.add_argument('--cache', default='.cache', help='directory for the downloaded page and its ETag / Last-Modified')
+    args.add_argument('--output', default='../app/static/driver_matrix.json')
+    args.add_argument('--force', action='store_true', help='rebuild even if the page did not change')
+    args = args.parse_args()
 
     try:
-        import httpx
-        from bs4 import BeautifulSoup
-    except Exception as e:
+        html = open(args.html, encoding='utf-8').read() if args.html else fetch(URL, args.cache)
+    except ImportError as e:
         logger.error(f'Failed to import module: {e}')
-        logger.info('Run "pip install beautifulsoup4 httpx"')
+        logger.info('Run "pip install httpx" or use "--html"')
         exit(1)
-
-    r = httpx.get(URL)
-    if r.status_code != 200:
-        logger.error(f'Error loading "{URL}" with status code {r.status_code}.')
+    except RuntimeError as e:
+        logger.error(e)
         exit(2)
 
-    # parse html
-    soup = BeautifulSoup(r.text, features='html.parser')
+    source = sha256(html.encode('utf-8')).hexdigest()
+    try:
+        previous = json_loads(open(args.output).read()).get('$source')
+    except (OSError, ValueError):
+        previous = None
+    if previous == source and not args.force:
+        logger.info(f'"{args.output}" is up to date.')
+        exit(0)
 
     # build matrix
-    __driver_versions(soup)
+    matrix = build(html)
 
     # debug output
-    __debug()
+    __debug(DriverMatrix.index(matrix))
 
     # dump data to file
-    __dump('../app/static/driver_matrix.json')
+    with open(args.output, 'w') as f:
+        f.write(json_dumps(matrix, separators=(',', ':')))
+    logger.info(f'Wrote {len(matrix.get("versions"))} driver versions to "{args.output}".')
@@ -1,9 +1,14 @@
 import json
+import subprocess
 import sys
 from base64 import b64encode as b64enc
 from calendar import timegm
-from datetime import datetime, UTC
+from datetime import datetime, timedelta, UTC
 from hashlib import sha256
+from os import environ, utime
+from os.path import join, dirname, abspath
+from shutil import copy
+from tempfile import TemporaryDirectory
 from uuid import uuid4, UUID
 
 from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
@@ -11,6 +16,7 @@ from cryptography.hazmat.primitives.hashes import SHA256
 from dateutil.relativedelta import relativedelta
 from jose import jwt, jwk, jws
 from jose.constants import ALGORITHMS
+from pytest import fixture, raises
 from starlette.testclient import TestClient
 
 # add relative path to use packages as they were in the app/ dir
@@ -18,10 +24,19 @@ sys.path.append('../')
 sys.path.append('../app')
 
 from app import main
-from util import CASetup, PrivateKey, PublicKey, Cert
+from orm import Origin, OriginRow, Lease, LeaseRow, LeaseCache, LeaseUsage, MemoryStore, RenewalQueue, DatabaseLock, create_tuned_engine, init, migrate, observe_queries, keyset_cursor
+from util import CASetup, DriverMatrix, PrivateKey, PublicKey, Cert, RateLimiter, SingleFlight, EventBroadcaster, JsonFormatter, \
+    CompressionMiddleware, KeyContext, KeyWatcher, Metrics, SamplingFilter, DroppingQueueHandler
 
 client = TestClient(main.app)
 
+
+@fixture(scope='module', autouse=True)
+def lifespan():
+    # runs "lifespan" (database setup and warm-up) once for all tests
+    with client:
+        yield
+
 # Instance
 INSTANCE_REF = '10000000-0000-0000-0000-000000000001'
 ORIGIN_REF, ALLOTMENT_REF, SECRET = str(uuid4()), '20000000-0000-0000-0000-000000000001', 'HelloWorld'
@@ -90,6 +105,584 @@ def test_keypair_and_certificates():
     )
 
 
+def test_multiple_workers():
+    # each worker imports the app (which runs "CASetup"), runs its lifespan (leader-only migrations) and signs a token
+    worker = '''
+import json
+from starlette.testclient import TestClient
+import main
+with TestClient(main.app) as client:
+    response = client.post('/auth/v1/code', json={'code_challenge': 'challenge', 'origin_ref': 'origin'})
+    print(json.dumps({'mod': main.KEYS.si_public_key.mod(), 'auth_code': response.json().get('auth_code')}))
+'''
+
+    with TemporaryDirectory() as cert_path, TemporaryDirectory() as database_path:
+        env = dict(environ, CERT_PATH=cert_path, DATABASE=f'sqlite:///{join(database_path, "db.sqlite")}')
+        cwd = join(dirname(abspath(__file__)), '..', 'app')
+        workers = [subprocess.Popen([sys.executable, '-c', worker], cwd=cwd, env=env, stdout=subprocess.PIPE) for _ in range(4)]
+        results = [json.loads(worker.communicate(timeout=120)[0].decode('utf-8').strip().splitlines()[-1]) for worker in workers]
+        assert all(worker.returncode == 0 for worker in workers)
+
+        si_certificate = Cert.from_file(CASetup(service_instance_ref=INSTANCE_REF, cert_path=cert_path).si_certificate_filename)
+
+    assert len(set(result.get('mod') for result in results)) == 1
+    assert results[0].get('mod') == si_certificate.public_key().mod()
+
+    decode_key = jwk.construct(si_certificate.public_key().pem(), algorithm=ALGORITHMS.RS256)
+    for result in results:
+        payload = json.loads(jws.verify(result.get('auth_code'), key=decode_key, algorithms=ALGORITHMS.RS256))
+        assert payload.get('origin_ref') == 'origin'
+
+
+def test_serve():
+    import serve
+    import signal
+    import socket
+    from time import sleep
+
+    x = serve.settings({'WORKERS': 'auto', 'REUSE_PORT': 'true', 'LIMIT_CONCURRENCY': '100', 'SSL_KEYFILE': '', 'SSL_CERTFILE': ''})
+    assert x.get('workers') >= 1 and x.get('reuse_port')
+    assert x.get('uvicorn').get('port') == 8000 and x.get('uvicorn').get('ssl_keyfile') is None
+    assert x.get('uvicorn').get('limit_concurrency') == 100 and x.get('uvicorn').get('limit_max_requests') is None
+    assert serve.settings({}).get('uvicorn').get('port') == 443
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    # two workers with their own sockets, drained on SIGTERM
+    with TemporaryDirectory() as cert_path, TemporaryDirectory() as database_path:
+        env = dict(
+            environ, CERT_PATH=cert_path, DATABASE=f'sqlite:///{join(database_path, "db.sqlite")}',
+            WORKERS='2', REUSE_PORT='true', BIND_HOST='127.0.0.1', BIND_PORT=str(port), SSL_KEYFILE='', SSL_CERTFILE='',
+        )
+        process = subprocess.Popen([sys.executable, join(dirname(abspath(__file__)), '..', 'app', 'serve.py')], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            for _ in range(120):
+                try:
+                    with socket.create_connection(('127.0.0.1', port), timeout=1) as connection:
+                        connection.sendall(b'GET /-/health/live HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+                        if connection.recv(1024).startswith(b'HTTP/1.1 200'):
+                            break
+                except OSError:
+                    pass
+                sleep(0.5)
+            else:
+                raise AssertionError('not serving')
+        finally:
+            process.send_signal(signal.SIGTERM)
+            output = process.communicate(timeout=60)[0].decode('utf-8')
+    assert process.returncode == 0
+    assert '"workers": 2, "reuse_port": true' in output
+    assert output.count('Application shutdown complete') == 2
+
+    # workers failing on startup are restarted with backoff, until the supervisor gives up
+    env.update(DATABASE='invalid://')
+    process = subprocess.run([sys.executable, join(dirname(abspath(__file__)), '..', 'app', 'serve.py')], env=env, capture_output=True, timeout=120)
+    output = process.stdout.decode('utf-8') + process.stderr.decode('utf-8')
+    assert process.returncode == 1
+    assert 'restarting in 0.5s' in output and 'restarting in 1.0s' in output
+    assert f'failed {serve.RESTART_LIMIT} times within {serve.RESTART_WINDOW}s, giving up' in output
+
+
+def test_key_reload(monkeypatch):
+    keys = KeyContext.load(ca_setup)
+    assert keys.fingerprint == main.KEYS.fingerprint
+    assert keys.si_public_key.mod() == my_si_public_key.mod()
+
+    mismatch = KeyContext(my_root_certificate, my_ca_certificate, my_si_certificate, my_ca_private_key)
+    try:
+        mismatch.validate()
+        assert False, 'certificate does not match private key'
+    except ValueError:
+        pass
+    try:
+        KeyContext(my_ca_certificate, my_root_certificate, my_si_certificate, my_si_private_key).validate()
+        assert False, 'certificate chain is invalid'
+    except ValueError:
+        pass
+
+    response = client.post('/-/keys/reload')
+    assert response.status_code == 200
+    assert response.json().get('fingerprint') == keys.fingerprint and response.json().get('changed') is False
+
+    with TemporaryDirectory() as cert_path:
+        for filename in KeyContext.filenames(ca_setup) + [ca_setup.root_private_key_filename, ca_setup.ca_private_key_filename]:
+            copy(filename, cert_path)
+        broken = CASetup(service_instance_ref=INSTANCE_REF, cert_path=cert_path)
+        copy(ca_setup.ca_private_key_filename, broken.si_private_key_filename)  # e.g. partially replaced files
+        monkeypatch.setattr(main, 'ca_setup', broken)
+        response = client.post('/-/keys/reload')
+        assert response.status_code == 400
+        assert main.KEYS.fingerprint == keys.fingerprint
+
+    # watcher calls "on_change" once per change of modification times
+    import asyncio
+
+    async def watch(filename: str) -> int:
+        changes = []
+
+        async def on_change():
+            changes.append(True)
+
+        watcher = KeyWatcher([filename], interval=0.01, on_change=on_change)
+        watcher.start()
+        await asyncio.sleep(0.05)
+        utime(filename, (0, 0))
+        await asyncio.sleep(0.05)
+        await watcher.stop()
+        return len(changes)
+
+    with TemporaryDirectory() as path:
+        filename = join(path, 'key.pem')
+        open(filename, 'w').close()
+        assert asyncio.run(watch(filename)) == 1
+
+
+def test_memory_store():
+    from shutil import copytree
+
+    cur_time = datetime.now(UTC)
+    origin_ref, lease_ref = str(uuid4()), str(uuid4())
+
+    with TemporaryDirectory() as path, TemporaryDirectory() as crash_path:
+        store = MemoryStore.from_url(f'memory://{path}')
+        Origin.create_or_update(store, Origin(origin_ref=origin_ref, hostname='myhost'))
+        Lease.create_or_update(store, Lease(origin_ref=origin_ref, lease_ref=lease_ref, lease_created=cur_time, lease_expires=cur_time))
+        lease = Lease.find_by_origin_ref_and_lease_ref(store, origin_ref, lease_ref)
+        Lease.renew(store, lease, cur_time + relativedelta(days=1), cur_time + relativedelta(hours=1))
+
+        # files as they are on disk if process crashes now (no snapshot yet, only change log)
+        copytree(path, crash_path, dirs_exist_ok=True)
+        store.close()
+
+        for directory in [path, crash_path]:  # load snapshot / replay change log
+            store = MemoryStore.from_url(f'memory://{directory}')
+            lease = Lease.find_by_lease_ref(store, lease_ref)
+            assert lease.lease_expires == cur_time + relativedelta(days=1)
+            assert lease.lease_updated == cur_time + relativedelta(hours=1)
+            assert Origin.find_by_origin_ref(store, origin_ref).hostname == 'myhost'
+            assert Lease.cleanup(store, origin_ref) == 1
+            assert Origin.delete_expired(store) == 1
+            store.close()
+
+            store = MemoryStore.from_url(f'memory://{directory}')
+            assert len(Lease.find_by_origin_ref(store, origin_ref)) == 0
+            assert len(Origin.find_all(store)) == 0
+            store.close()
+
+
+def test_lease_usage():
+    from sqlalchemy.orm import sessionmaker
+
+    cur_time = datetime.now(UTC)
+    product_name, origin_refs = 'NVIDIA Virtual Applications', [str(uuid4()), str(uuid4())]
+
+    with TemporaryDirectory() as path:
+        engine, _ = create_tuned_engine(f'sqlite:///{join(path, "usage.sqlite")}')
+        init(engine), migrate(engine)
+        for store in [engine, MemoryStore()]:
+            for origin_ref in origin_refs:
+                Origin.create_or_update(store, Origin(origin_ref=origin_ref, guest_driver_version='550.54.14'))
+                for _ in range(2):
+                    lease = Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=cur_time, lease_expires=cur_time + relativedelta(days=1), product_name=product_name, driver_branch='R550')
+                    Lease.create_or_update(store, lease)
+            Lease.cleanup(store, origin_refs[0])
+            lease = Lease.find_by_origin_ref(store, origin_refs[1])[0]
+            Lease.renew(store, lease, cur_time + relativedelta(days=2), cur_time)
+            assert Lease.delete(store, lease.lease_ref) == 1
+            assert Lease.delete(store, lease.lease_ref) == 0  # e.g. deleted by another worker, not decremented twice
+
+            rows = {(_.product_name, _.driver_branch): _ for _ in LeaseUsage.find(store, cur_time)}
+            assert rows.get((product_name, 'R550')).active == 1
+            assert rows.get((product_name, 'R550')).peak == 4
+            assert rows.get((product_name, LeaseUsage.ALL)).active == 1
+            assert rows.get((LeaseUsage.ALL, LeaseUsage.ALL)).peak == 4
+
+            Origin.delete(store)
+            rows = {(_.product_name, _.driver_branch): _ for _ in LeaseUsage.find(store, cur_time)}
+            assert rows.get((LeaseUsage.ALL, LeaseUsage.ALL)).active == 0
+
+        # row of a new hour inserted by another transaction meanwhile is incremented, not replaced
+        session, hour = sessionmaker(bind=engine)(), LeaseUsage.truncate_hour(cur_time + timedelta(hours=1))
+        LeaseUsage.apply(session, {('Other', 'R550'): 2}, hour)
+        session.execute(LeaseUsage.upsert('sqlite', dict(product_name='Other', driver_branch='R550', hour=hour, active=1, peak=1), 1))
+        LeaseUsage.apply(session, {('Other', 'R550'): -1}, hour)
+        session.commit()
+        row = session.query(LeaseUsage).filter(LeaseUsage.product_name == 'Other', LeaseUsage.driver_branch == 'R550').one()
+        assert (row.active, row.peak) == (2, 3)
+        session.close()
+        engine.dispose()
+
+    assert Origin.get_driver_branch('550.54.14') == 'R550'
+    assert Origin.get_driver_branch('guest_driver_version') is None
+
+
+def test_origin_create_concurrently():
+    from sqlalchemy import event
+
+    origin_ref = str(uuid4())
+    with TemporaryDirectory() as path:
+        engine, _ = create_tuned_engine(f'sqlite:///{join(path, "origins.sqlite")}')
+        init(engine), migrate(engine)
+
+        # the same new origin is inserted by another request right after this one looked it up
+        concurrent = [Origin(origin_ref=origin_ref, hostname='first')]
+
+        def after_cursor_execute(conn, cursor, statement: str, *_):
+            if statement.lstrip().upper().startswith('SELECT') and 'FROM origin' in statement and len(concurrent) > 0:
+                Origin.create_or_update(engine, concurrent.pop())
+
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        Origin.create_or_update(engine, Origin(origin_ref=origin_ref, hostname='second'))
+        assert Origin.find_by_origin_ref(engine, origin_ref).hostname == 'second'
+        engine.dispose()
+
+
+def test_origin_search():
+    cur_time = datetime.now(UTC)
+
+    with TemporaryDirectory() as path:
+        engine, _ = create_tuned_engine(f'sqlite:///{join(path, "search.sqlite")}')
+        init(engine), migrate(engine)
+        for store in [engine, MemoryStore()]:
+            origin_refs = sorted(str(uuid4()) for _ in range(5))
+            for idx, origin_ref in enumerate(origin_refs):
+                version = '550.54.14' if idx % 2 == 0 else '535.161.07'
+                Origin.create_or_update(store, Origin(origin_ref=origin_ref, hostname=f'gpu-rack12-{idx}', guest_driver_version=version, os_platform='Windows'))
+            lease = Lease(origin_ref=origin_refs[0], lease_ref=str(uuid4()), lease_created=cur_time, lease_expires=cur_time + relativedelta(days=1))
+            Lease.create_or_update(store, lease)
+
+            assert [origin.origin_ref for origin, _ in Origin.search(store, {'guest_driver_version': '550.'})] == origin_refs[0::2]
+            assert len(Origin.search(store, {'hostname': 'gpu-rack12-', 'os_platform': 'Windows'})) == 5
+            assert len(Origin.search(store, {'hostname': 'gpu-rack13-'})) == 0
+            page = Origin.search(store, {'hostname': 'gpu-rack12-'}, limit=2)
+            page += Origin.search(store, {'hostname': 'gpu-rack12-'}, after=keyset_cursor(page[-1][0], 'origin_ref', 'origin_ref'), limit=10)
+            assert [origin.origin_ref for origin, _ in page] == origin_refs
+            active = Origin.search(store, {}, active_after=cur_time - timedelta(minutes=1))
+            assert [origin.origin_ref for origin, _ in active] == origin_refs[:1]
+            assert active[0][1].replace(tzinfo=UTC) == cur_time
+            assert len(Origin.search(store, {}, active_before=cur_time - timedelta(minutes=1))) == 0
+
+            # sorted by hostname (descending), paginated
+            page = Origin.search(store, {'hostname': 'gpu-rack12-'}, limit=3, sort='hostname', descending=True)
+            page += Origin.search(store, {'hostname': 'gpu-rack12-'}, after=keyset_cursor(page[-1][0], 'hostname', 'origin_ref'), limit=3, sort='hostname', descending=True)
+            assert [origin.hostname for origin, _ in page] == [f'gpu-rack12-{idx}' for idx in reversed(range(5))]
+
+            leases = []
+            for idx in range(5):
+                leases.append(str(uuid4()))
+                lease = Lease(origin_ref=origin_refs[1], lease_ref=leases[-1], lease_created=cur_time, lease_expires=cur_time + relativedelta(days=idx))
+                Lease.create_or_update(store, lease)
+            page = Lease.page(store, {'origin_ref': origin_refs[1]}, limit=2, sort='lease_expires', descending=True)
+            while len(page) % 2 == 0:
+                more = Lease.page(store, {'origin_ref': origin_refs[1]}, after=keyset_cursor(page[-1], 'lease_expires', 'lease_ref'), limit=2, sort='lease_expires', descending=True)
+                page += more
+                if len(more) == 0:
+                    break
+            assert [_.lease_ref for _ in page] == list(reversed(leases))
+            assert Lease.count(store, {'origin_ref': origin_refs[1]}) == 5
+
+            # anchor of the cursor renewed (sorted after the next page) or deleted between pages
+            page = Lease.page(store, {'origin_ref': origin_refs[1]}, limit=2, sort='lease_expires')
+            cursor = keyset_cursor(page[-1], 'lease_expires', 'lease_ref')
+            Lease.renew(store, Lease.find_by_lease_ref(store, leases[1]), cur_time + relativedelta(days=10), cur_time)
+            assert [_.lease_ref for _ in Lease.page(store, {'origin_ref': origin_refs[1]}, after=cursor, sort='lease_expires')] == [*leases[2:], leases[1]]
+            Lease.delete(store, leases[1])
+            assert [_.lease_ref for _ in Lease.page(store, {'origin_ref': origin_refs[1]}, after=cursor, sort='lease_expires')] == leases[2:]
+            with raises(ValueError):
+                Lease.page(store, {}, after=cursor, sort='lease_created')
+
+            # listings return plain rows, which serialize the same as entities
+            assert all(isinstance(_, OriginRow) for _ in Origin.find_all(store))
+            assert all(isinstance(_, LeaseRow) for _ in Lease.find_all(store) + page)
+            row, entity = Origin.search(store, {'hostname': 'gpu-rack12-0'})[0][0], Origin.find_by_origin_ref(store, origin_refs[0])
+            assert row.serialize(fields=['hostname']) == entity.serialize(fields=['hostname']) == {'origin_ref': origin_refs[0], 'hostname': 'gpu-rack12-0'}
+            row, entity = page[0], Lease.find_by_lease_ref(store, page[0].lease_ref)
+            assert row.serialize(0.15, timedelta(days=1), 0.1) == entity.serialize(0.15, timedelta(days=1), 0.1)
+
+            # wildcards are matched literally and case-sensitive, same in database and memory
+            for hostname in ['node_1%', 'nodeX1a', 'NODE_1%b', 'node*1?[', 'node*1xx']:
+                Origin.create_or_update(store, Origin(origin_ref=str(uuid4()), hostname=hostname))
+            for prefix, expected in [('node_1%', ['node_1%']), ('node_', ['node_1%']), ('NODE', ['NODE_1%b']), ('node*1?', ['node*1?[']), ('node*1?[', ['node*1?['])]:
+                assert [origin.hostname for origin, _ in Origin.search(store, {'hostname': prefix})] == expected
+        engine.dispose()
+
+
+def test_delete_matching():
+    cur_time = datetime.now(UTC)
+
+    with TemporaryDirectory() as path:
+        engine, _ = create_tuned_engine(f'sqlite:///{join(path, "delete.sqlite")}')
+        init(engine), migrate(engine)
+        for store in [engine, MemoryStore()]:
+            origin_refs = sorted(str(uuid4()) for _ in range(6))
+            for idx, origin_ref in enumerate(origin_refs):
+                Origin.create_or_update(store, Origin(origin_ref=origin_ref, hostname=f'rack{idx % 2}-{idx}', guest_driver_version='550.54.14'))
+                lease_updated = cur_time - timedelta(days=idx)
+                lease = Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=lease_updated, lease_expires=cur_time + relativedelta(days=1))
+                Lease.create_or_update(store, lease)
+
+            assert Lease.delete_matching(store, updated_before=cur_time - timedelta(days=4, hours=12)) == 1  # idx 5
+            assert Lease.delete_matching(store, lease_refs=[], origin_refs=origin_refs) == 0
+            assert Origin.delete_matching(store, filters={'hostname': 'rack0-'}, active_before=cur_time - timedelta(hours=12)) == (2, 2)  # idx 2, 4
+            assert Origin.delete_matching(store, origin_refs=origin_refs[:2]) == (2, 2)
+            assert [_.origin_ref for _ in Origin.find_all(store)] == [origin_refs[3], origin_refs[5]]
+            assert len(Lease.find_all(store)) == 1
+        engine.dispose()
+
+
+def test_renewal_queue():
+    from time import sleep
+
+    cur_time = datetime.now(UTC)
+
+    with TemporaryDirectory() as path:
+        engine, _ = create_tuned_engine(f'sqlite:///{join(path, "renewals.sqlite")}')
+        init(engine), migrate(engine)
+        origin_ref, lease_refs = str(uuid4()), [str(uuid4()) for _ in range(3)]
+        Origin.create_or_update(engine, Origin(origin_ref=origin_ref))
+        Lease.create_many(engine, [Lease(origin_ref=origin_ref, lease_ref=_, lease_created=cur_time, lease_expires=cur_time + relativedelta(days=1)) for _ in lease_refs])
+        leases = {_.lease_ref: _ for _ in Lease.find_by_origin_ref(engine, origin_ref)}
+
+        def expires(lease_ref: str) -> datetime:
+            return Lease.find_by_lease_ref(engine, lease_ref).lease_expires.replace(tzinfo=UTC)
+
+        # disabled, written immediately
+        queue = RenewalQueue(engine)
+        queue.renew(leases[lease_refs[0]], cur_time + relativedelta(days=2), cur_time)
+        assert not queue.enabled and len(queue) == 0 and expires(lease_refs[0]) == cur_time + relativedelta(days=2)
+
+        # queued (latest per lease) and applied on reads until written
+        queue = RenewalQueue(engine, interval=60, max_size=3)
+        queue.renew(leases[lease_refs[1]], cur_time + relativedelta(days=2), cur_time + timedelta(seconds=1))
+        queue.renew(leases[lease_refs[1]], cur_time + relativedelta(days=3), cur_time + timedelta(seconds=2), offline=True)
+        queue.renew(leases[lease_refs[2]], cur_time + relativedelta(days=2), cur_time + timedelta(seconds=1))
+        assert len(queue) == 2 and expires(lease_refs[1]) == cur_time + relativedelta(days=1)
+        row = queue.get(next(_ for _ in Lease.find_all(engine) if _.lease_ref == lease_refs[1]))
+        assert isinstance(row, LeaseRow) and row.lease_expires == cur_time + relativedelta(days=3) and row.offline
+        assert queue.get(leases[lease_refs[2]]).lease_expires == cur_time + relativedelta(days=2)
+        assert queue.get(leases[lease_refs[0]]) is leases[lease_refs[0]]
+
+        assert queue.flush() == 2 and len(queue) == 0 and queue.batches == 1
+        assert expires(lease_refs[1]) == cur_time + relativedelta(days=3) and Lease.find_by_lease_ref(engine, lease_refs[1]).offline
+        assert expires(lease_refs[2]) == cur_time + relativedelta(days=2)
+
+        # a renewal older than the written one (e.g. queued by another worker) does not move expiry back
+        queue.renew(leases[lease_refs[1]], cur_time + relativedelta(days=2), cur_time)
+        queue.flush()
+        assert expires(lease_refs[1]) == cur_time + relativedelta(days=3)
+
+        # written by background thread when "max_size" is reached, "close" writes the rest
+        queue.start()
+        for lease_ref in lease_refs:
+            queue.renew(leases[lease_ref], cur_time + relativedelta(days=4), cur_time + timedelta(seconds=3))
+        for _ in range(50):
+            if len(queue) == 0 and expires(lease_refs[2]) == cur_time + relativedelta(days=4):
+                break
+            sleep(0.1)
+        assert all(expires(_) == cur_time + relativedelta(days=4) for _ in lease_refs)
+        queue.renew(leases[lease_refs[0]], cur_time + relativedelta(days=5), cur_time + timedelta(seconds=4))
+        queue.close()
+        assert expires(lease_refs[0]) == cur_time + relativedelta(days=5)
+        engine.dispose()
+
+
+def test_driver_matrix(monkeypatch):
+    import httpx
+    import create_driver_matrix_json as builder
+
+    html = open(join(dirname(__file__), 'driver_matrix.html'), encoding='utf-8').read()
+    matrix = builder.build(html)
+    assert len(matrix.get('releases')) == 4 and len(matrix.get('versions')) == 8  # linux and windows driver per release
+    assert matrix.get('versions').get('550.54.14') == matrix.get('versions').get('551.61')
+
+    versions = DriverMatrix.index(matrix)
+    assert versions == DriverMatrix.index(builder.parse(html))  # nested format is indexed the same on load
+    assert versions.get('550.54.14') == {
+        'software_branch': 'vGPU Software 17', 'branch_version': '17.0', 'driver_branch': 'R550',
+        'branch_status': 'Production Branch, supported until June 2025', 'release_date': 'February 2024',
+        'eol': None, 'is_latest': False,
+    }
+    assert versions.get('535.230.02').get('is_latest') and versions.get('535.230.02').get('eol') == 'July 2026'  # 16.10 > 16.9
+    assert 'not a release' not in json.dumps(matrix)  # only first table of a branch
+
+    with TemporaryDirectory() as path:
+        with open(join(path, 'driver_matrix.json'), 'w') as f:
+            f.write(json.dumps(matrix))
+        DriverMatrix(join(path, 'driver_matrix.json'))
+        assert DriverMatrix.find('551.78').get('branch_version') == '17.1'
+        assert DriverMatrix.find('470.82.01') is None
+
+        # conditional fetch, cached page is used if not modified
+        requests = []
+
+        def get(url: str, headers: dict):
+            requests.append(headers)
+            if headers.get('If-None-Match') == '"v1"':
+                return httpx.Response(304)
+            return httpx.Response(200, text=html, headers={'ETag': '"v1"', 'Last-Modified': 'Mon, 03 Mar 2025 10:00:00 GMT'})
+
+        monkeypatch.setattr(httpx, 'get', get)
+        assert builder.fetch(builder.URL, join(path, 'cache')) == html
+        assert builder.fetch(builder.URL, join(path, 'cache')) == html
+        assert requests == [{}, {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 03 Mar 2025 10:00:00 GMT'}]
+    DriverMatrix(join(dirname(__file__), 'missing.json'))  # unloaded again for other tests
+
+
+def test_cluster_nodes():
+    import socket
+    from time import sleep
+    import httpx
+
+    def free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    ports = [free_port() for _ in range(3)]
+    cluster_nodes = ','.join(f'127.0.0.1:{port}' for port in ports)
+
+    with TemporaryDirectory() as cert_path, TemporaryDirectory() as database_path:
+        # all nodes share the same database and certificates
+        env = dict(environ, CERT_PATH=cert_path, CLUSTER_NODES=cluster_nodes, DATABASE_TUNING='balanced',
+                   DATABASE=f'sqlite:///{join(database_path, "db.sqlite")}')
+        app_dir = join(dirname(abspath(__file__)), '..', 'app')
+        nodes = [subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--app-dir', app_dir, '--port', str(port)], env=env, stderr=subprocess.DEVNULL) for port in ports]
+        urls = [f'http://127.0.0.1:{port}' for port in ports]
+
+        try:
+            for url in urls:
+                for _ in range(120):
+                    try:
+                        if httpx.get(f'{url}/-/health').status_code == 200:
+                            break
+                    except httpx.TransportError:
+                        sleep(0.5)
+
+            # client token advertises all nodes
+            response = httpx.get(f'{urls[0]}/-/client-token')
+            payload = jws.get_unverified_claims(response.content)
+            node_url_list = json.loads(payload).get('service_instance_configuration').get('node_url_list')
+            svc_port_set_list = json.loads(payload).get('service_instance_configuration').get('svc_port_set_list')
+            assert [_.get('url') for _ in node_url_list] == ['127.0.0.1'] * 3
+            assert [svc_port_set_list[_.get('svc_port_set_idx')].get('svc_port_map')[0].get('port') for _ in node_url_list] == ports
+
+            # every step on another node
+            origin_ref = str(uuid4())
+            payload = {'candidate_origin_ref': origin_ref, 'environment': {'hostname': 'cluster-host'}}
+            assert httpx.post(f'{urls[0]}/auth/v1/origin', json=payload).status_code == 200
+
+            challenge = b64enc(sha256(SECRET.encode('utf-8')).digest()).rstrip(b'=').decode('utf-8')
+            auth_code = httpx.post(f'{urls[1]}/auth/v1/code', json={'code_challenge': challenge, 'origin_ref': origin_ref}).json().get('auth_code')
+            auth_token = httpx.post(f'{urls[2]}/auth/v1/token', json={'auth_code': auth_code, 'code_verifier': SECRET}).json().get('auth_token')
+            headers = {'authorization': f'Bearer {auth_token}'}
+
+            payload = {'scope_ref_list': [ALLOTMENT_REF], 'lease_proposal_list': [{'product': {'name': 'NVIDIA Virtual Applications'}}]}
+            assert httpx.post(f'{urls[0]}/leasing/v1/lessor', json=payload, headers=headers).status_code == 200
+            active_lease_list = httpx.get(f'{urls[1]}/leasing/v1/lessor/leases', headers=headers).json().get('active_lease_list')
+            assert len(active_lease_list) == 1
+            response = httpx.put(f'{urls[2]}/leasing/v1/lease/{active_lease_list[0]}', json={'client_challenge': 'x'}, headers=headers)
+            assert response.status_code == 200
+            assert httpx.delete(f'{urls[0]}/leasing/v1/lessor/leases', headers=headers).json().get('released_lease_list') == active_lease_list
+        finally:
+            for node in nodes:
+                node.terminate()
+                node.wait(timeout=30)
+
+
+def test_rate_limiter():
+    from util import RecentKeys
+
+    keys = RecentKeys(max_keys=2)
+    keys.add('a'), keys.add('b'), keys.add('a'), keys.add('c')  # bounded, evicts least recently added ("b")
+    assert 'a' in keys and 'b' not in keys and len(keys) == 2
+
+    limiter = RateLimiter.from_string('1/2', max_keys=2)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == 0
+    assert 0 < limiter.acquire('a') <= 1  # burst exhausted
+    assert limiter.acquire('b') == 0  # other key has its own bucket
+
+    limiter.acquire('c')  # bounded, evicts least recently used bucket ("a")
+    assert limiter.acquire('a') == 0
+
+    assert RateLimiter.from_string(None) is None
+    assert RateLimiter.from_string('') is None
+
+
+def test_rate_limit(monkeypatch):
+    monkeypatch.setitem(main.RATE_LIMITS, 'leasing', RateLimiter(rate=0.001, burst=1))
+
+    # unknown origins share the bucket of the client address, the first verified token makes an origin known
+    origin_ref = str(uuid4())
+    response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(origin_ref)})
+    assert response.status_code == 200 and origin_ref in main.KNOWN_ORIGINS
+    response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(str(uuid4()))})
+    assert response.status_code == 429
+
+    response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(origin_ref)})
+    assert response.status_code == 200
+    response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(origin_ref)})
+    assert response.status_code == 429
+    assert int(response.headers.get('Retry-After')) > 0
+
+    main.KNOWN_ORIGINS.add(ORIGIN_REF)
+    response = client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+    assert response.status_code == 200
+
+    response = client.get('/leasing/v1/lessor/leases')
+    assert response.status_code == 400
+
+
+def test_lease_renewal_jitter():
+    lease_refs = [str(uuid4()) for _ in range(1000)]
+    periods = [Lease.calculate_renewal_period(0.15, _, jitter=0.1) for _ in lease_refs]
+    assert all(0.135 <= _ <= 0.165 for _ in periods)
+    assert len(set(periods)) > 900  # spread
+    assert periods == [Lease.calculate_renewal_period(0.15, _, jitter=0.1) for _ in lease_refs]  # deterministic
+    assert Lease.calculate_renewal_period(0.15, lease_refs[0]) == 0.15
+
+    # "lease_renewal" of serialized lease matches "recommended_lease_renewal"
+    cur_time, delta = datetime(2024, 1, 1), relativedelta(days=90)
+    lease = Lease(lease_ref=lease_refs[0], origin_ref=ORIGIN_REF, lease_created=cur_time, lease_expires=cur_time + delta, lease_updated=cur_time)
+    serialized = lease.serialize(renewal_period=0.15, renewal_delta=timedelta(days=90), renewal_jitter=0.1)
+    renewal = datetime.fromisoformat(serialized.get('lease_renewal')).replace(tzinfo=None) - cur_time
+    assert abs(renewal.total_seconds() - periods[0] * timedelta(days=90).total_seconds()) < 1
+
+
+def test_single_flight():
+    import asyncio
+
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        if value == 'error':
+            raise ValueError(value)
+        return value
+
+    async def run():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(*[single_flight.do('a', lambda: compute('a')) for _ in range(10)])
+        assert results == ['a'] * 10 and calls == ['a']
+
+        await single_flight.do('a', lambda: compute('a'))  # no ttl, computed again
+        assert calls == ['a', 'a']
+
+        await single_flight.do('b', lambda: compute('b'), ttl=60)
+        await single_flight.do('b', lambda: compute('b'), ttl=60)  # cached
+        assert calls == ['a', 'a', 'b']
+
+        results = await asyncio.gather(*[single_flight.do('c', lambda: compute('error')) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(_, ValueError) for _ in results)
+        assert calls == ['a', 'a', 'b', 'error']
+        assert single_flight.coalesced == 9 + 1 + 2
+
+    asyncio.run(run())
+
+
 def test_index():
     response = client.get('/')
     assert response.status_code == 200
@@ -100,10 +693,89 @@ def test_health():
     assert response.status_code == 200
     assert response.json().get('status') == 'up'
 
+    response = client.get('/-/health/live')
+    assert response.status_code == 200
+
+
+def test_health_ready(monkeypatch):
+    response = client.get('/-/health/ready')
+    assert response.status_code == 200
+    assert response.json().get('status') == 'up'
+    checks = response.json().get('checks')
+    assert set(checks.keys()) == {'database', 'keys', 'event_loop'}
+    assert all(_.get('status') == 'up' for _ in checks.values())
+    assert checks.get('database').get('latency_ms') >= 0 and checks.get('event_loop').get('lag_ms') >= 0
+
+    # cached within "HEALTH_CACHE_TTL"
+    assert client.get('/-/health/ready').json().get('checked') == response.json().get('checked')
+
+    class BrokenKeys:
+        class si_private_key:
+            @staticmethod
+            def generate_signature(_):
+                raise RuntimeError('no signing key')
+
+    monkeypatch.setattr(main, 'SINGLE_FLIGHT', type(main.SINGLE_FLIGHT)())
+    monkeypatch.setattr(main, 'KEYS', BrokenKeys())
+    response = client.get('/-/health/ready')
+    assert response.status_code == 503
+    assert response.json().get('checks').get('keys').get('detail') == 'no signing key'
+
 
 def test_config():
     response = client.get('/-/config')
     assert response.status_code == 200
+    assert response.json().get('DATABASE_TUNING').get('profile') == 'none'
+
+
+def test_database_tuning():
+    from sqlalchemy import text
+
+    with TemporaryDirectory() as database_path:
+        engine, applied = create_tuned_engine(f'sqlite:///{join(database_path, "db.sqlite")}', profile='balanced')
+        with engine.connect() as connection:
+            assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+            assert connection.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+        with DatabaseLock(engine, 'fastapi-dls-migrate') as lock:  # local database, file lock is sufficient
+            assert not lock.contended and -2 ** 63 <= lock.key < 2 ** 63
+        engine.dispose()
+
+    assert applied.get('dialect') == 'sqlite'
+    assert applied.get('settings').get('journal_mode') == 'wal'
+    assert applied.get('settings').get('synchronous') == 1  # NORMAL
+
+
+def test_read_replica(monkeypatch):
+    metrics = Metrics()
+    metrics.inc('queries_total', engine='primary', statement='select')
+    metrics.inc('queries_total', 2, engine='primary', statement='select')
+    metrics.describe('queries_total', 'Queries')
+    assert metrics.get('queries_total', statement='select', engine='primary') == 3
+    assert metrics.render() == '# HELP queries_total Queries\n# TYPE queries_total counter\nqueries_total{engine="primary",statement="select"} 3\n'
+
+    # replica is the same database here, routing is verified by counted queries per engine
+    replica, _ = create_tuned_engine(str(main.DATABASE))
+    observe_queries(replica, lambda statement: main.METRICS.inc('fastapi_dls_database_queries_total', engine='replica', statement=statement))
+    monkeypatch.setattr(main, 'db_read', replica)
+
+    def queries(engine: str) -> float:
+        return main.METRICS.get('fastapi_dls_database_queries_total', engine=engine, statement='select')
+
+    primary, replicated = queries('primary'), queries('replica')
+    assert client.get('/-/leases/page').status_code == 200
+    assert client.get('/-/origins/search').status_code == 200
+    assert client.get('/-/stats').status_code == 200
+    assert queries('primary') == primary and queries('replica') > replicated
+
+    replicated = queries('replica')
+    headers = {'authorization': __bearer_token(ORIGIN_REF)}
+    assert client.get('/leasing/v1/lessor/leases', headers=headers).status_code == 200
+    assert queries('primary') > primary and queries('replica') == replicated
+
+    response = client.get('/-/metrics')
+    assert response.status_code == 200
+    assert 'fastapi_dls_database_queries_total{engine="replica",statement="select"}' in response.text
+    replica.dispose()
 
 
 def test_config_root_ca():
@@ -117,10 +789,39 @@ def test_readme():
     assert response.status_code == 200
 
 
+def test_compression():
+    assert CompressionMiddleware.negotiate('gzip, deflate, br', ['br', 'gzip']) == 'br'
+    assert CompressionMiddleware.negotiate('gzip;q=1.0, br;q=0.5', ['br', 'gzip']) == 'gzip'
+    assert CompressionMiddleware.negotiate('*', ['gzip']) == 'gzip'
+    assert CompressionMiddleware.negotiate('gzip;q=0, identity', ['br', 'gzip']) is None
+    assert CompressionMiddleware.negotiate('', ['br', 'gzip']) is None
+
+    response = client.get('/-/readme', headers={'accept-encoding': 'gzip'})
+    assert response.status_code == 200 and response.headers.get('content-encoding') == 'gzip'
+    assert 'Accept-Encoding' in response.headers.get('vary')
+    response = client.get('/-/readme', headers={'accept-encoding': 'identity'})
+    assert response.headers.get('content-encoding') is None
+
+    # small and signed protocol responses are never compressed
+    response = client.get('/-/health', headers={'accept-encoding': 'gzip'})
+    assert response.headers.get('content-encoding') is None
+    response = client.post('/leasing/v1/config-token', json={'service_instance_ref': INSTANCE_REF}, headers={'accept-encoding': 'gzip'})
+    assert len(response.content) > main.COMPRESSION_MIN_SIZE and response.headers.get('content-encoding') is None
+
+
 def test_manage():
     response = client.get('/-/manage')
     assert response.status_code == 200
 
+    response = client.get('/-/leases/page?limit=1&sort=lease_expires&order=desc')
+    assert response.status_code == 200
+    assert response.json().get('total') >= len(response.json().get('leases'))
+
+    response = client.get('/-/leases/page?sort=unknown')
+    assert response.status_code == 400
+    response = client.get('/-/leases/page?after=invalid')
+    assert response.status_code == 400
+
 
 def test_client_token():
     response = client.get('/-/client-token')
@@ -178,6 +879,12 @@ def test_lease_delete():
     pass
 
 
+def test_leases_renewals():
+    response = client.get('/-/leases/renewals?buckets=4')
+    assert response.status_code == 200
+    assert response.json().get('leases') == sum(_.get('count') for _ in response.json().get('histogram'))
+
+
 def test_auth_v1_origin():
     payload = {
         "registration_pending": False,
@@ -200,6 +907,110 @@ def test_auth_v1_origin():
 
 
 
+def test_origins_search():
+    response = client.get('/-/origins/search?hostname=myh&fields=hostname,last_activity')
+    assert response.status_code == 200
+    origin = next(_ for _ in response.json().get('origins') if _.get('origin_ref') == ORIGIN_REF)
+    assert set(origin.keys()) == {'origin_ref', 'hostname', 'last_activity'}
+
+    response = client.get('/-/origins/search?fields=unknown')
+    assert response.status_code == 400
+
+
+def test_delete_matching_endpoints():
+    response = client.post('/-/origins/delete', json={})
+    assert response.status_code == 400
+    response = client.post('/-/origins/delete', json={'hostname': f'unknown-{uuid4()}'})
+    assert response.status_code == 200
+    assert response.json() == {'origins': 0, 'leases': 0}
+
+    response = client.post('/-/leases/delete', json={'updated_before': 'yesterday'})
+    assert response.status_code == 400
+    response = client.post('/-/leases/delete', json={'lease_refs': [str(uuid4())]})
+    assert response.status_code == 200
+    assert response.json() == {'leases': 0}
+
+
+def test_lease_cache(monkeypatch):
+    cache = LeaseCache(max_origins=2, ttl=60)
+    monkeypatch.setattr(main, 'LEASE_CACHE', cache)
+    origin_ref = str(uuid4())
+    Origin.create_or_update(main.db, Origin(origin_ref=origin_ref, hostname='cache'))
+    headers = {'authorization': __bearer_token(origin_ref)}
+    payload = {'lease_proposal_list': [{'product': {'name': 'NVIDIA RTX Virtual Workstation'}}], 'scope_ref_list': [ALLOTMENT_REF]}
+
+    def lessor() -> str:
+        return client.post('/leasing/v1/lessor', json=payload, headers=headers).json().get('lease_result_list')[0].get('lease').get('ref')
+
+    def active_leases() -> [str]:
+        return client.get('/leasing/v1/lessor/leases', headers=headers).json().get('active_lease_list')
+
+    # filled on read, updated write-through by create, renew and release
+    assert active_leases() == [] and cache.misses == 1
+    lease_refs = [lessor(), lessor()]
+    assert sorted(active_leases()) == sorted(lease_refs) and cache.hits == 1
+    assert client.put(f'/leasing/v1/lease/{lease_refs[0]}', json={}, headers=headers).status_code == 200
+    assert cache.misses == 1
+    assert client.delete(f'/leasing/v1/lease/{lease_refs[1]}', headers=headers).status_code == 200
+    assert active_leases() == [lease_refs[0]]
+    assert client.delete(f'/leasing/v1/lease/{lease_refs[1]}', headers=headers).status_code == 404
+    assert client.delete(f'/leasing/v1/lease/{lease_refs[0]}', headers={'authorization': __bearer_token(str(uuid4()))}).status_code == 403
+
+    # a lease missing in cache (e.g. created by another worker) is looked up in database
+    lease = Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=datetime.now(UTC), lease_expires=datetime.now(UTC) + timedelta(days=1))
+    Lease.create_or_update(main.db, LeaseCache.copy(lease))
+    assert client.put(f'/leasing/v1/lease/{lease.lease_ref}', json={}, headers=headers).status_code == 200
+
+    # a cached lease deleted elsewhere (e.g. by another worker) is not renewed, but evicted
+    Lease.delete(main.db, lease.lease_ref)
+    assert lease.lease_ref in active_leases()  # stale
+    assert client.put(f'/leasing/v1/lease/{lease.lease_ref}', json={}, headers=headers).status_code == 404
+    assert lease.lease_ref not in active_leases()
+    Lease.create_or_update(main.db, LeaseCache.copy(lease))
+    cache.put(lease)
+
+    # coherent with admin deletes
+    client.delete(f'/-/lease/{lease.lease_ref}')
+    assert active_leases() == [lease_refs[0]]
+    client.post('/-/leases/delete', json={'origin_refs': [origin_ref]})
+    assert active_leases() == []
+    lease_refs = [lessor()]
+    expired = Lease(origin_ref=origin_ref, lease_ref=str(uuid4()), lease_created=datetime.now(UTC), lease_expires=datetime.now(UTC) - timedelta(seconds=1))
+    Lease.create_or_update(main.db, LeaseCache.copy(expired))
+    cache.put(expired)
+    assert sorted(active_leases()) == sorted([lease_refs[0], expired.lease_ref])
+    client.delete('/-/leases/expired')
+    assert active_leases() == lease_refs
+    subscription = main.EVENTS.subscribe(last_event_id=0)
+    main.EVENTS.unsubscribe(subscription)
+    assert [_[2] for _ in subscription.backlog if _[1] == 'lease.expired'][-1] == {'lease_ref': expired.lease_ref, 'origin_ref': origin_ref}
+    lessor()
+    client.post('/-/origins/delete', json={'origin_refs': [origin_ref]})
+    assert active_leases() == []
+    client.delete('/leasing/v1/lessor/leases', headers=headers)
+
+    # a change while an origin is loaded discards only the fill of that origin
+    find_by_origin_ref, other = Lease.find_by_origin_ref, LeaseCache.copy(lease, origin_ref=str(uuid4()))
+    for changed, cached in [(other, True), (lease, False)]:
+        cache.clear()
+        monkeypatch.setattr(Lease, 'find_by_origin_ref', lambda engine, _: (cache.put(changed), find_by_origin_ref(engine, _))[1])
+        cache.find_by_origin_ref(main.db, origin_ref)
+        monkeypatch.setattr(Lease, 'find_by_origin_ref', find_by_origin_ref)
+        hits = cache.hits
+        cache.find_by_origin_ref(main.db, origin_ref)
+        assert (cache.hits == hits + 1) == cached
+
+    # bounded, entries expire after ttl
+    cache.find_by_origin_ref(main.db, str(uuid4())), cache.find_by_origin_ref(main.db, str(uuid4()))
+    hits = cache.hits
+    active_leases()
+    assert cache.hits == hits  # dropped as least recently used
+    monkeypatch.setattr(cache, 'ttl', 0)
+    cache.clear()
+    active_leases(), active_leases()
+    assert cache.hits == hits
+
+
 def auth_v1_origin_update():
     payload = {
         "registration_pending": False,
@@ -291,6 +1102,18 @@ def test_leasing_v1_lessor():
     assert lease_result_list[0]['lease']['product_name'] == 'NVIDIA Virtual Applications'
     assert lease_result_list[0]['lease']['feature_name'] == 'GRID-Virtual-Apps'
 
+    subscription = main.EVENTS.subscribe(last_event_id=0)
+    main.EVENTS.unsubscribe(subscription)
+    events = [_ for _ in subscription.backlog if _[1] == 'lease.created']
+    assert events[-1][2].get('lease_ref') == lease_result_list[0]['lease']['ref']
+
+    response = client.get('/-/stats?hours=1')
+    assert response.status_code == 200
+    usage = {(_.get('product_name'), _.get('driver_branch')): _ for _ in response.json().get('usage')}
+    assert usage.get(('NVIDIA Virtual Applications', '*')).get('active') >= 1
+    assert usage.get(('*', '*')).get('peak') >= usage.get(('*', '*')).get('active')
+    assert len(usage.get(('*', '*')).get('hourly')) == 1
+
 
 
 def test_leasing_v1_lessor_lease():
@@ -368,3 +1191,175 @@ def test_leasing_v1_lessor_lease_remove():
     assert len(released_lease_list) == 1
     assert len(released_lease_list[0]) == 36
     assert released_lease_list[0] == lease_ref
+
+
+def test_event_broadcaster():
+    import asyncio
+
+    async def run():
+        events = EventBroadcaster(history=3, queue_size=2)
+        first = events.publish('lease.created', {'lease_ref': 'a'})
+
+        fast, slow = events.subscribe(), events.subscribe()
+        events.publish('lease.renewed', {'lease_ref': 'a'})
+        assert (await fast.next(timeout=1))[1:] == ('lease.renewed', {'lease_ref': 'a'})
+        events.publish('lease.renewed', {'lease_ref': 'a'})
+        assert (await fast.next(timeout=1))[1] == 'lease.renewed'
+        last = events.publish('lease.released', {'lease_ref': 'a'})
+        assert events.subscribers == 1 and events.dropped == 1  # "slow" queue was full
+
+        assert [(await slow.next(timeout=1))[1] for _ in range(2)] == ['lease.renewed', 'lease.renewed']
+        try:
+            await slow.next(timeout=1)
+            assert False, 'dropped subscriber must end'
+        except EOFError:
+            pass
+        assert await fast.next(timeout=1) == (last, 'lease.released', {'lease_ref': 'a'})
+        assert await fast.next(timeout=0.01) is None
+
+        resumed = events.subscribe(last_event_id=first)  # history holds the last 3 events
+        assert [(await resumed.next(timeout=1))[0] for _ in range(3)] == [first + 1, first + 2, last]
+        assert EventBroadcaster.format(1, 'lease.created', {'a': 1}) == 'id: 1\nevent: lease.created\ndata: {"a":1}\n\n'
+
+    asyncio.run(run())
+
+
+def test_logging():
+    from logging import LogRecord, INFO, WARNING
+    from queue import Queue
+
+    def record(level: int, **extra) -> LogRecord:
+        _ = LogRecord('main', level, __file__, 0, 'lease %s', ('a',), None)
+        _.__dict__.update(extra)
+        return _
+
+    x = json.loads(JsonFormatter().format(record(INFO, route='renew', origin_ref='o')))
+    assert x.get('message') == 'lease a'
+    assert x.get('level') == 'INFO'
+    assert x.get('route') == 'renew'
+    assert x.get('origin_ref') == 'o'
+
+    assert SamplingFilter.parse('leases=0.1, renew=0') == {'leases': 0.1, 'renew': 0}
+    sampling = SamplingFilter({'renew': 0})
+    assert not sampling.filter(record(INFO, route='renew'))
+    assert sampling.filter(record(WARNING, route='renew'))
+    assert sampling.filter(record(INFO, route='leases'))
+    assert sampling.filter(record(INFO))
+
+    handler = DroppingQueueHandler(Queue(maxsize=2))
+    for _ in range(5):
+        handler.handle(record(INFO))
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_tracing(monkeypatch):
+    from util import Tracer, RingBufferExporter, JsonLinesExporter, span
+
+    # disabled, nothing is recorded
+    assert not main.TRACER.enabled
+    assert client.get('/-/debug/traces').status_code == 404
+
+    exporter = RingBufferExporter(size=10)
+    monkeypatch.setattr(main.TRACER, 'sampling', 1)
+    monkeypatch.setattr(main.TRACER, 'exporter', exporter)
+    payload = {'lease_proposal_list': [{'product': {'name': 'NVIDIA Virtual Applications'}}], 'scope_ref_list': [ALLOTMENT_REF]}
+    response = client.post('/leasing/v1/lessor', json=payload, headers={'authorization': __bearer_token(ORIGIN_REF)})
+    assert response.status_code == 200
+
+    trace = exporter.traces[-1]
+    assert trace.get('name') == 'leasing_v1_lessor' and not trace.get('slow')
+    assert trace.get('attributes') == {'method': 'POST', 'path': '/leasing/v1/lessor', 'status_code': 200}
+    spans = {_.get('name'): _ for _ in trace.get('spans')}
+    assert {'parse', 'token', 'product_mapping', 'db', 'sign', 'Origin.find_by_origin_ref', 'Lease.create_or_update'} <= set(spans)
+    assert spans.get('Lease.create_or_update').get('parent') == spans.get('db').get('id')
+    assert spans.get('parse').get('parent') is None
+    assert all(_.get('start_ms') + _.get('duration_ms') <= trace.get('duration_ms') for _ in trace.get('spans'))
+
+    # admin routes are not traced, slow traces are kept
+    assert client.get('/-/debug/traces').json().get('traces') == []
+    response = client.get('/-/debug/traces?sampled=true&limit=1')
+    assert response.status_code == 200 and response.json().get('traces') == [trace]
+    monkeypatch.setattr(main.TRACER, 'sampling', 0)
+    monkeypatch.setattr(main.TRACER, 'slow', 0.001)
+    client.get('/leasing/v1/lessor/leases', headers={'authorization': __bearer_token(ORIGIN_REF)})
+    traces = client.get('/-/debug/traces').json().get('traces')
+    assert traces[0].get('name') == 'leasing_v1_lessor_lease' and traces[0].get('slow')
+
+    # sampling and json lines
+    with TemporaryDirectory() as path:
+        tracer = Tracer(sampling=0.5, exporter=JsonLinesExporter(join(path, 'traces.jsonl')))
+        for _ in range(200):
+            with tracer.trace('test', n=_):
+                with span('outer'):
+                    with span('inner'):
+                        pass
+        tracer.close()
+        lines = [json.loads(_) for _ in open(join(path, 'traces.jsonl'))]
+        assert tracer.traced == 200 and 50 < tracer.exported < 150 and len(lines) == tracer.exported
+        assert [_.get('name') for _ in lines[0].get('spans')] == ['outer', 'inner']
+        assert lines[0].get('spans')[1].get('parent') == lines[0].get('spans')[0].get('id')
+
+    with span('untraced'):  # no current trace
+        pass
+
+
+def test_offline_leases(monkeypatch):
+    from util import OfflineLeasePolicy
+
+    policy = OfflineLeasePolicy.from_strings(None, 'gpu-rack12-, gpu-rack13-', 'NVIDIA Virtual Applications')
+    assert policy.enabled
+    assert policy.applies(str(uuid4()), None, 'NVIDIA Virtual Applications')
+    assert policy.applies(str(uuid4()), 'gpu-rack13-1', 'NVIDIA RTX Virtual Workstation')
+    assert not policy.applies(str(uuid4()), 'gpu-rack14-1', 'NVIDIA RTX Virtual Workstation')
+    assert not OfflineLeasePolicy.from_strings(None, None, None).enabled
+
+    monkeypatch.setattr(main, 'OFFLINE_LEASE_POLICY', OfflineLeasePolicy(product_names=['NVIDIA Virtual Applications']))
+    headers = {'authorization': __bearer_token(ORIGIN_REF)}
+    payload = {'lease_proposal_list': [{'product': {'name': 'NVIDIA Virtual Applications'}}], 'scope_ref_list': [ALLOTMENT_REF]}
+    response = client.post('/leasing/v1/lessor', json=payload, headers=headers)
+    lease = response.json().get('lease_result_list')[0].get('lease')
+    assert lease.get('offline_lease') is True
+    assert lease.get('recommended_lease_renewal') == main.OFFLINE_LEASE_RENEWAL_PERIOD
+    expires = datetime.strptime(lease.get('expires'), '%Y-%m-%dT%H:%M:%S.%fZ')
+    assert expires - datetime.now(UTC).replace(tzinfo=None) > timedelta(days=364)
+
+    response = client.put(f'/leasing/v1/lease/{lease.get("ref")}', json={}, headers=headers)
+    assert response.json().get('offline_lease') is True
+
+    # removed from policy, lease is online again on next renewal
+    monkeypatch.setattr(main, 'OFFLINE_LEASE_POLICY', OfflineLeasePolicy())
+    response = client.put(f'/leasing/v1/lease/{lease.get("ref")}', json={}, headers=headers)
+    assert response.json().get('offline_lease') is False
+    response = client.get(f'/-/leases/page?origin_ref={ORIGIN_REF}')
+    assert next(_ for _ in response.json().get('leases') if _.get('lease_ref') == lease.get('ref')).get('offline_lease') is False
+    client.delete('/leasing/v1/lessor/leases', headers=headers)
+
+    # revoked (deleted) offline lease is rejected on next renewal and release
+    monkeypatch.setattr(main, 'OFFLINE_LEASE_POLICY', OfflineLeasePolicy(product_names=['NVIDIA Virtual Applications']))
+    response = client.post('/leasing/v1/lessor', json=payload, headers=headers)
+    lease_ref = response.json().get('lease_result_list')[0].get('lease').get('ref')
+    response = client.post('/-/leases/delete', json={'lease_refs': [lease_ref]})
+    assert response.json() == {'leases': 1}
+    assert client.put(f'/leasing/v1/lease/{lease_ref}', json={}, headers=headers).status_code == 404
+    assert client.delete(f'/leasing/v1/lease/{lease_ref}', headers=headers).status_code == 404
+
+    # assigned in advance, only to registered origins
+    origin_refs = [str(uuid4()), str(uuid4())]
+    client.post('/auth/v1/origin', json={'candidate_origin_ref': origin_refs[0], 'environment': {'hostname': 'offline-1'}})
+    response = client.post('/-/leases/offline', json={'origin_refs': origin_refs, 'product_name': 'NVIDIA Virtual Applications'})
+    assert response.status_code == 404 and response.json().get('origin_refs') == [origin_refs[1]]
+    assert client.get(f'/-/leases/page?origin_ref={origin_refs[0]}').json().get('leases') == []
+    client.post('/auth/v1/origin', json={'candidate_origin_ref': origin_refs[1], 'environment': {'hostname': 'offline-2'}})
+    response = client.post('/-/leases/offline', json={'origin_refs': origin_refs, 'product_name': 'NVIDIA Virtual Applications'})
+    assert response.status_code == 200
+    assert [_.get('origin_ref') for _ in response.json().get('leases')] == origin_refs
+    response = client.get(f'/-/leases/page?origin_ref={origin_refs[0]}')
+    assert response.json().get('leases')[0].get('offline_lease') is True
+    response = client.post('/-/origins/delete', json={'origin_refs': origin_refs})
+    assert response.json() == {'origins': 2, 'leases': 2}
+
+    response = client.post('/-/leases/offline', json={'origin_refs': ['x'], 'product_name': 'NVIDIA Virtual Applications'})
+    assert response.status_code == 400
+    response = client.post('/-/leases/offline', json={'origin_refs': origin_refs, 'product_name': 'unknown'})
+    assert response.status_code == 400